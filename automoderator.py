@@ -1,23 +1,90 @@
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from functools import partial
+import hashlib
 import logging, logging.config
+import marshal
+import multiprocessing
+import signal
+import sqlite3
+import threading
 from time import sleep, time
 
 import HTMLParser
 import praw
-# import re2 as re
 import re
 import yaml
 from requests.exceptions import HTTPError
 from sqlalchemy.sql import and_
 from sqlalchemy.orm.exc import NoResultFound
 
-from models import cfg_file, path_to_cfg, session
+from models import cfg_file, get_option, get_path_option, path_to_cfg
+from models import session
+from budgets import ConditionBudget, thread_cpu_time
+from caches import LRUCache, ShadowbanCache, UserRankCache
+from grouping import PAGE_SIZE, plan_groups, TrafficStats
+from literals import LiteralSearcher, fold_case, required_literals
+from matching import Matcher, MatchTimeout, supports_time_budget
 from models import Log, StandardCondition, Subreddit
+from pipeline import ActionPipeline
+from polling import PollScheduler
+from ratelimit import BudgetHandler, RequestScheduler
+from sharding import ShardCoordinator
+from replay import ListingRecorder
+from workers import WorkerPool
+import metrics
+
+# the C loader is much faster, if PyYAML was built with libyaml
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 # global reddit session
 r = None
+# shared parser, only used for unescaping html entities
+html_parser = HTMLParser.HTMLParser()
+# global index of actions that have already been performed
+action_index = None
+# global buffer for writing log entries
+log_writer = None
+# global pool for fetching listings in parallel (None if disabled)
+fetch_pool = None
+# the reddit session of each background thread (fetching, actions, etc.)
+thread_sessions = threading.local()
+# global cache of users' shadowbanned status
+shadowban_cache = None
+# global cache of users' karma/age/gold status
+user_profile_cache = None
+# global cache of subreddits' moderators and contributors
+user_rank_cache = None
+# global timings of conditions, and which are quarantined for being slow
+condition_budget = None
+# global pipeline performing actions in the background (None if disabled)
+action_pipeline = None
+# global coordinator of the subreddits shared between workers (None if not)
+shard = None
+# compiled conditions of each subreddit's YAML
+condition_sets = None
+# process pool for validating large wiki pages, and the pending validation
+# for each subreddit
+validation_pool = None
+pending_validations = {}
+# global rates of new items per subreddit, for grouping them
+traffic = TrafficStats()
+# global scheduler that all requests to reddit go through
+request_scheduler = RequestScheduler(
+    get_option('reddit', 'requests_per_minute', 30),
+    get_option('reddit', 'request_burst', 10),
+    get_option('reddit', 'request_reserve', 5))
 
 class Condition(object):
+    """A single condition from a subreddit's YAML definition.
+
+    Conditions are slotted, and values equal to ones in other conditions
+    (strings, compiled patterns and whole definitions) are shared between
+    them until clear_interned() is called, since many subreddits use the
+    same (or standard) conditions. The YAML is only kept as yaml_hash, the
+    yaml property serializes the definition again when it's needed.
+    """
+
     _defaults = {'reports': None,
                  'is_reply': None,
                  'ignore_blockquotes': False,
@@ -34,6 +101,10 @@ class Condition(object):
                  'user_conditions': {},
                  'modifiers': []}
 
+    __slots__ = tuple(_defaults) + ('type', 'yaml_hash', 'match_regexes',
+                                    'match_success', 'pattern_groups',
+                                    'condition_index', '_values')
+
     _match_targets = ['link_id', 'user', 'title', 'domain', 'url', 'body',
                       'media_user', 'media_title', 'media_description',
                       'author_flair_text', 'author_flair_css_class']
@@ -50,23 +121,88 @@ class Condition(object):
                           'media_user': 'full-exact',
                           'author_flair_text': 'full-exact',
                           'author_flair_css_class': 'full-exact'}
+    _pattern_flags = re.DOTALL|re.UNICODE|re.IGNORECASE
 
     @classmethod
     def get_standard_condition(cls, name):
         # if the cache is empty, fill it
-        if not cls._standard_cache:
+        if cls._standard_cache is None:
             cls._standard_cache = {}
-            standards = session.query(StandardCondition).all()
-            for cond in standards:
-                cond_name = cond.name.lower()
-                cls._standard_cache[cond_name] = yaml.safe_load(cond.yaml)
+            cls._standard_versions = {}
+            cls._load_standard_conditions(
+                session.query(StandardCondition).all())
 
         return cls._standard_cache.get(name.lower(), dict())
     _standard_cache = None
+    _standard_versions = None
 
     @classmethod
-    def clear_standard_cache(cls):
-        cls._standard_cache = None
+    def _load_standard_conditions(cls, standards):
+        for cond in standards:
+            cond_name = cond.name.lower()
+            cls._standard_cache[cond_name] = yaml.safe_load(cond.yaml)
+            cls._standard_versions[cond_name] = cls._standard_version(
+                cond.version, cond.updated_at, cond.yaml)
+
+    @staticmethod
+    def _standard_version(version, updated_at, cond_yaml):
+        # the hash catches edits made without bumping the version (or rows
+        # from before it existed, which have no updated_at)
+        return (version, updated_at,
+                hashlib.sha1(cond_yaml.encode('utf-8')).hexdigest())
+
+    @classmethod
+    def get_standard_version(cls, name):
+        """Returns a standard condition's version, None if it's missing."""
+        cls.get_standard_condition(name)
+        return cls._standard_versions.get(name.lower())
+
+    @classmethod
+    def refresh_standard_conditions(cls):
+        """Reloads the standard conditions that changed since being cached.
+
+        A condition has changed if its version, update time or YAML is
+        different, only the changed ones are parsed again. Returns the names
+        of those that changed (including any that were added or deleted).
+        """
+        if cls._standard_cache is None:
+            return set()
+
+        versions = {}
+        for cond in session.query(StandardCondition.name,
+                                  StandardCondition.version,
+                                  StandardCondition.updated_at,
+                                  StandardCondition.yaml):
+            versions[cond.name.lower()] = (cond, cls._standard_version(
+                cond.version, cond.updated_at, cond.yaml))
+
+        changed = set(name for name in cls._standard_versions
+                      if name not in versions)
+        for name in changed:
+            del cls._standard_cache[name]
+            del cls._standard_versions[name]
+
+        reload_conds = [cond for name, (cond, version) in versions.iteritems()
+                        if cls._standard_versions.get(name) != version]
+        cls._load_standard_conditions(reload_conds)
+        changed.update(cond.name.lower() for cond in reload_conds)
+        return changed
+
+    @classmethod
+    def intern_value(cls, value):
+        """Returns an equal string from an earlier condition, if any."""
+        if not isinstance(value, basestring):
+            return value
+        return cls._interned.setdefault(value, value)
+    _interned = {}
+    _definitions = {}
+    _matchers = {}
+
+    @classmethod
+    def clear_interned(cls):
+        cls._interned = {}
+        cls._definitions = {}
+        cls._matchers = {}
 
     @property
     def requests_required(self):
@@ -83,27 +219,41 @@ class Condition(object):
 
         return reqs
 
-    def __init__(self, values):
+    @property
+    def yaml(self):
+        return yaml.dump(self._values)
+
+    @staticmethod
+    def hash_values(values):
+        """Returns the yaml_hash of a condition's (lowercased) values."""
+        return hashlib.sha1(yaml.dump(values)).hexdigest()
+
+    def __init__(self, values, yaml_hash=None):
         # lowercase all keys
         values = {k.lower(): v for k, v in values.iteritems()}
 
-        self.yaml = yaml.dump(values)
+        # the hash is of the same YAML as always, so it matches old log entries
+        self.yaml_hash = intern(yaml_hash or self.hash_values(values))
+        self._values = self._definitions.setdefault(self.yaml_hash, values)
 
         # anything not defined in the "values" dict will be defaulted
-        init = self._defaults.copy()
+        init = dict(self._defaults)
 
         # inherit from standard condition if they specified one
         if 'standard' in values:
             init.update(Condition.get_standard_condition(values['standard']))
 
-        init.update(values)
+        init.update(self._values)
 
-        # convert the dict to attributes
-        self.__dict__.update(init)
+        for key in self._defaults:
+            setattr(self, key, self.intern_value(init[key]))
+        self.type = self.intern_value(init.get('type'))
 
         # set match target/pattern definitions
-        self.match_patterns = {}
+        self.match_regexes = {}
         self.match_success = {}
+        self.pattern_groups = None
+        self.condition_index = None
         match_fields = set()
         for key in [k for k in init
                     if k in self._match_targets or '+' in k]:
@@ -111,7 +261,14 @@ class Condition(object):
                 modifiers = self.modifiers.get(key, [])
             else:
                 modifiers = self.modifiers
-            self.match_patterns[key] = self.get_pattern(key, modifiers)
+            pattern = self.intern_value(self.get_pattern(key, init[key],
+                                                         modifiers))
+            matcher_key = (pattern, self._pattern_flags)
+            if matcher_key not in self._matchers:
+                self._matchers[matcher_key] = Matcher(pattern,
+                                                      self._pattern_flags)
+            key = self.intern_value(key)
+            self.match_regexes[key] = self._matchers[matcher_key]
             if 'inverse' in modifiers:
                 self.match_success[key] = False
             else:
@@ -120,7 +277,7 @@ class Condition(object):
                 match_fields.add(field)
         
         # if type wasn't defined, set based on fields being matched against
-        if not getattr(self, 'type', None):
+        if not self.type:
             if (len(match_fields) > 0 and 
                 all([f in ('title', 'domain', 'url',
                            'media_user', 'media_title', 'media_description')
@@ -129,23 +286,23 @@ class Condition(object):
             else:
                 self.type = 'both'
 
-
-    def get_pattern(self, subject, modifiers):
+    @classmethod
+    def get_pattern(cls, subject, values, modifiers):
         # cast to lists, so we're not splitting a single string
-        if not isinstance(getattr(self, subject), list):
-            setattr(self, subject, [getattr(self, subject)])
+        if not isinstance(values, list):
+            values = [values]
         if not isinstance(modifiers, list):
             modifiers = list(modifiers.split(' '))
 
         # cast all elements to strings in case of any numbers
-        values = [unicode(val) for val in getattr(self, subject)]
+        values = [unicode(val) for val in values]
 
         if 'regex' not in modifiers:
             values = [re.escape(val) for val in values]
         value_str = u'({0})'.format('|'.join(values))
 
         # check if they defined a match modifier
-        for mod in self._match_modifiers:
+        for mod in cls._match_modifiers:
             if mod in modifiers:
                 match_mod = mod
                 break
@@ -154,12 +311,28 @@ class Condition(object):
             if subject == 'domain':
                 value_str = ur'(?:.*?\.)?' + value_str
 
-            match_mod = self._modifier_defaults.get(subject, 'includes-word')
+            match_mod = cls._modifier_defaults.get(subject, 'includes-word')
 
-        return self._match_modifiers[match_mod].format(value_str)
+        return cls._match_modifiers[match_mod].format(value_str)
 
-    def check_item(self, item):
+    @property
+    def backtracking_subjects(self):
+        """The match subjects whose patterns need the backtracking engine."""
+        return sorted(subject
+                      for subject, regex in self.match_regexes.iteritems()
+                      if not regex.linear)
+
+    def could_match(self, view):
+        """Returns False if the item's fields rule out the condition."""
+        if not self.condition_index:
+            return True
+        return self.condition_index.could_match(self, view)
+
+    def check_item(self, item, view=None, check_shadowbanned=False):
         """Checks an item against the condition.
+
+        view is the item's ItemView, shared between conditions if given.
+        Authors are only checked for shadowbans if check_shadowbanned is set.
         
         Returns True if the condition is satisfied, False otherwise.
         """
@@ -171,51 +344,22 @@ class Condition(object):
         if self.is_reply is not None and self.is_reply != is_reply(item):
             return False
 
-        html_parser = HTMLParser.HTMLParser()
+        if view is None:
+            view = ItemView(item)
+
         match = None
-        for subject in self.match_patterns:
+        for subject in self.match_regexes:
             sources = set(subject.split('+'))
             for source in sources:
-                if source == 'user' and item.author:
-                    string = item.author.name
-                elif source == 'link_id':
-                    # trim off the 't3_'
-                    string = getattr(item, 'link_id', '')[3:]
-                elif (source == 'body' and
-                        isinstance(item, praw.objects.Submission)):
-                    string = item.selftext
-                elif (source == 'url' and
-                        getattr(item, 'is_self', False)):
-                    # get rid of the url value for self-posts
-                    string = ''
-                elif (source.startswith('media_') and
-                        getattr(item, 'media', None)):
-                    try:
-                        if source == 'media_user':
-                            string = item.media['oembed']['author_name']
-                        elif source == 'media_title':
-                            string = item.media['oembed']['title']
-                        elif source == 'media_description':
-                            string = item.media['oembed']['description']
-                    except KeyError:
-                        string = ''
-                else:
-                    string = getattr(item, source, '')
+                string = view.get(source, self.ignore_blockquotes)
 
-                if not string:
-                    string = ''
-
-                string = html_parser.unescape(string)
-
-                # remove blockquotes if ignore_blockquotes is enabled
-                if source == 'body' and self.ignore_blockquotes:
-                    string = '\n'.join([line for line in string.splitlines()
-                                        if not line.startswith('> ') and
-                                           len(line) > 0])
-
-                match = re.search(self.match_patterns[subject],
-                                  string,
-                                  re.DOTALL|re.UNICODE|re.IGNORECASE)
+                # skip the search if the combined patterns can't match
+                group = (self.pattern_groups and
+                         self.pattern_groups.get((subject, source)))
+                if group and not group.search(item.name, string):
+                    match = None
+                else:
+                    match = self.match_regexes[subject].search(string)
 
                 if match:
                     break
@@ -224,7 +368,7 @@ class Condition(object):
                 return False
 
         # check user conditions
-        if not self.check_user_conditions(item):
+        if not self.check_user_conditions(item, check_shadowbanned):
             return False
 
         # matched, perform any actions
@@ -232,7 +376,7 @@ class Condition(object):
 
         return True
 
-    def check_user_conditions(self, item):
+    def check_user_conditions(self, item, check_shadowbanned=False):
         """Checks an item's author against the defined requirements."""
         # if no user conditions are set, no need to check at all
         if not self.user_conditions:
@@ -262,20 +406,26 @@ class Condition(object):
                 compare = rank_values[compare]
 
             if user:
-                if attr == 'rank':
-                    value = rank_values[get_user_rank(user, item.subreddit)]
-                elif attr == 'account_age':
-                    user_date = datetime.utcfromtimestamp(user.created_utc)
-                    value = (datetime.utcnow() - user_date).days
-                elif attr == 'combined_karma':
-                    value = user.link_karma + user.comment_karma
-                elif attr == 'is_shadowbanned':
-                    if not self.check_shadowbanned:
-                        value = False
+                with request_scheduler.request_type('user'):
+                    if attr == 'rank':
+                        value = rank_values[get_user_rank(user,
+                                                          item.subreddit)]
+                    elif attr == 'account_age':
+                        profile = get_user_profile(user)
+                        user_date = datetime.utcfromtimestamp(
+                            profile['created_utc'])
+                        value = (datetime.utcnow() - user_date).days
+                    elif attr == 'combined_karma':
+                        profile = get_user_profile(user)
+                        value = (profile['link_karma'] +
+                                 profile['comment_karma'])
+                    elif attr == 'is_shadowbanned':
+                        if not check_shadowbanned:
+                            value = False
+                        else:
+                            value = user_is_shadowbanned(user)
                     else:
-                        value = user_is_shadowbanned(user)
-                else:
-                    value = getattr(user, attr, 0)
+                        value = get_user_profile(user).get(attr, 0)
             else:
                 value = 0
                 
@@ -300,72 +450,96 @@ class Condition(object):
         """Performs the action(s) for the condition.
         
         Also sends any comment/messages (if set) and creates a log entry.
+        With the action pipeline enabled, they're only queued to be done.
         """
-        if self.action or self.comment or self.modmail or self.message:
-            log_actions = [self.action]
-        else:
-            log_actions = []
+        steps = self.plan_actions(item, match)
+        log_actions = [step[0] for step in steps]
+
+        if action_pipeline:
+            # indexed now so they aren't repeated while waiting in the queue
+            index_actions(item, log_actions, self.yaml_hash,
+                          datetime.utcnow())
+            action_pipeline.submit(item, self.yaml_hash, steps)
+            return
+
+        performed = []
+        deferred = []
+        for log_action, req_type, func, args in steps:
+            # modmail and messages are sent later if the budget is low, and
+            # only logged once they've actually been sent
+            if req_type in ('modmail', 'message'):
+                done = partial(finish_deferred, item, log_action,
+                               self.yaml_hash)
+                if request_scheduler.defer(req_type, func, *args, done=done):
+                    deferred.append(log_action)
+                    continue
+            else:
+                with request_scheduler.request_type(req_type):
+                    func(*args)
+            performed.append(log_action)
+
+        log_time = datetime.utcnow()
+        index_actions(item, performed, self.yaml_hash, log_time)
+        if deferred:
+            # so the item doesn't queue them again while they're waiting
+            action_index.add_condition(item.name, self.yaml_hash, log_time)
+        if performed or not deferred:
+            record_actions(item, performed, self.yaml_hash, log_time)
+
+    def plan_actions(self, item, match):
+        """Returns the steps to perform for a match, in order.
+
+        Each step is a (log action, request type, function, args) tuple.
+        """
+        steps = []
 
-        # perform the action
+        # the action
         if self.action == 'remove':
-            item.remove(False)
+            steps.append(('remove', 'remove', item.remove, (False,)))
         elif self.action == 'spam':
-            item.remove(True)
+            steps.append(('spam', 'spam', item.remove, (True,)))
         elif self.action == 'approve':
-            item.approve()
+            steps.append(('approve', 'approve', item.approve, ()))
         elif self.action == 'report':
-            item.report()
+            steps.append(('report', 'report', item.report, ()))
 
-        # set flairs
+        # flairs
         if (isinstance(item, praw.objects.Submission) and 
                 (self.link_flair_text or self.link_flair_class)):
             text = replace_placeholders(self.link_flair_text, item, match)
-            css_class = replace_placeholders(self.link_flair_class, item, match)
-            item.set_flair(text, css_class.lower())
-            log_actions.append('link_flair')
+            css_class = replace_placeholders(self.link_flair_class,
+                                             item, match)
+            steps.append(('link_flair', 'flair', item.set_flair,
+                          (text, css_class.lower())))
         if (self.user_flair_text or self.user_flair_class):
             text = replace_placeholders(self.user_flair_text, item, match)
-            css_class = replace_placeholders(self.user_flair_class, item, match)
-            item.subreddit.set_flair(item.author, text, css_class.lower())
-            log_actions.append('user_flair')
+            css_class = replace_placeholders(self.user_flair_class,
+                                             item, match)
+            steps.append(('user_flair', 'flair', item.subreddit.set_flair,
+                          (item.author, text, css_class.lower())))
 
         if self.comment:
             comment = self.build_message(self.comment, item, match,
                                          disclaimer=True, intro=True)
-            if isinstance(item, praw.objects.Submission):
-                response = item.add_comment(comment)
-            elif isinstance(item, praw.objects.Comment):
-                response = item.reply(comment)
-            response.distinguish()
+            steps.append(('comment', 'comment', post_comment,
+                          (item, comment)))
 
         if self.modmail:
             message = self.build_message(self.modmail, item, match,
                                          permalink=True)
             subject = replace_placeholders(self.modmail_subject, item, match)
-            r.send_message('/r/'+item.subreddit.display_name, subject, message)
+            steps.append(('modmail', 'modmail', r.send_message,
+                          ('/r/'+item.subreddit.display_name,
+                           subject, message)))
 
         if self.message and item.author:
             message = self.build_message(self.message, item, match,
                                          disclaimer=True, permalink=True, intro=True)
             subject = replace_placeholders(self.message_subject, item, match)
-            r.send_message(item.author.name, subject, message)
+            steps.append(('message', 'message', r.send_message,
+                          (item.author.name, subject, message)))
 
-        log_entry = Log()
-        log_entry.item_fullname = item.name
-        log_entry.condition_yaml = self.yaml
-        log_entry.datetime = datetime.utcnow()
-
-        for entry in log_actions:
-            log_entry.action = entry
-            session.add(log_entry)
-
-        session.commit()
-
-        item_time = datetime.utcfromtimestamp(item.created_utc)
-        logging.info('Matched {0}, actions: {1} (age: {2})'
-                     .format(get_permalink(item).encode('ascii', 'ignore'),
-                             log_actions,
-                             datetime.utcnow() - item_time))
+        return steps
 
     def build_message(self, text, item, match,
                       disclaimer=False, permalink=False, intro=False):
@@ -384,13 +558,468 @@ class Condition(object):
         return message
 
 
+def post_comment(item, text):
+    """Posts a distinguished comment on a submission, or a reply to a comment."""
+    if isinstance(item, praw.objects.Submission):
+        response = item.add_comment(text)
+    elif isinstance(item, praw.objects.Comment):
+        response = item.reply(text)
+    response.distinguish()
+
+
+def index_actions(item, actions, yaml_hash, logged):
+    """Adds the actions done for a matched condition to the action index."""
+    for action in actions:
+        action_index.add_action(item.name, action, logged)
+    if actions:
+        action_index.add_condition(item.name, yaml_hash, logged)
+
+
+def record_actions(item, actions, yaml_hash, logged):
+    """Logs the actions done for a matched condition."""
+    for action in actions:
+        log_writer.add(item.name, action, yaml_hash, logged)
+        metrics.actions.inc(action)
+    log_writer.commit()
+
+    item_time = datetime.utcfromtimestamp(item.created_utc)
+    item_age = datetime.utcnow() - item_time
+    metrics.item_age_at_action_seconds.observe(item_age.total_seconds())
+    logging.info('Matched {0}, actions: {1} (age: {2})'
+                 .format(get_permalink(item).encode('ascii', 'ignore'),
+                         actions,
+                         item_age))
+
+
+def finish_deferred(item, action, yaml_hash, error):
+    """Logs a deferred modmail or message once it's been sent.
+
+    If sending it failed, it's left out of the action index so the item can
+    match the condition again.
+    """
+    if error:
+        action_index.discard_condition(item.name, yaml_hash)
+        return
+    log_time = datetime.utcnow()
+    index_actions(item, [action], yaml_hash, log_time)
+    record_actions(item, [action], yaml_hash, log_time)
+
+
+def process_completed_actions():
+    """Logs the actions that the action pipeline has finished.
+
+    Actions that failed are removed from the action index again, so they're
+    retried if the item is checked again.
+    """
+    if not action_pipeline:
+        return
+
+    for job in action_pipeline.completed():
+        if job.error:
+            logging.error('ERROR: actions on {0} failed: {1}'
+                          .format(job.item.name, job.error))
+            for step in job.steps:
+                if step[0] not in job.performed:
+                    action_index.discard_action(job.item.name, step[0])
+            action_index.discard_condition(job.item.name, job.yaml_hash)
+        if job.performed:
+            record_actions(job.item, job.performed, job.yaml_hash,
+                           datetime.utcnow())
+
+
+class ItemView(object):
+    """The values of an item's fields that conditions match against.
+
+    Each field is extracted and unescaped the first time it's needed, and
+    then shared by all the conditions checked against the item.
+    """
+
+    def __init__(self, item):
+        self.item = item
+        self._fields = {}
+        # CPU seconds spent checking conditions against the item
+        self.cpu_time = 0.0
+
+    def get(self, source, ignore_blockquotes=False):
+        """Returns the field's value, blockquotes are only removed from body."""
+        ignore_blockquotes = ignore_blockquotes and source == 'body'
+        key = (source, ignore_blockquotes)
+        if key not in self._fields:
+            if ignore_blockquotes:
+                string = '\n'.join([line
+                                    for line in self.get('body').splitlines()
+                                    if not line.startswith('> ') and
+                                       len(line) > 0])
+            else:
+                string = html_parser.unescape(self._extract(source))
+            self._fields[key] = string
+        return self._fields[key]
+
+    def _extract(self, source):
+        item = self.item
+        if source == 'user' and item.author:
+            string = item.author.name
+        elif source == 'link_id':
+            # trim off the 't3_'
+            string = getattr(item, 'link_id', '')[3:]
+        elif (source == 'body' and
+                isinstance(item, praw.objects.Submission)):
+            string = item.selftext
+        elif (source == 'url' and
+                getattr(item, 'is_self', False)):
+            # get rid of the url value for self-posts
+            string = ''
+        elif (source.startswith('media_') and
+                getattr(item, 'media', None)):
+            try:
+                if source == 'media_user':
+                    string = item.media['oembed']['author_name']
+                elif source == 'media_title':
+                    string = item.media['oembed']['title']
+                elif source == 'media_description':
+                    string = item.media['oembed']['description']
+            except KeyError:
+                string = ''
+        else:
+            string = getattr(item, source, '')
+
+        if not string:
+            string = ''
+        return string
+
+
+class PatternGroup(object):
+    """Combines the patterns of many conditions on a single source field.
+
+    Used as a prefilter: if none of the combined patterns match a field, the
+    individual patterns don't need to be searched at all, so in the common
+    case each field is only scanned once per item. If it does match, the
+    conditions still search with their own pattern, so the exact set of
+    matching conditions and their match groups are unaffected.
+    """
+    # python's re module only supports 100 groups per pattern
+    _max_groups = 99
+    # backreferences, named groups, conditionals and inline flags can't
+    # be safely moved into a combined pattern
+    _uncombinable = re.compile(r'\\[1-9]|\(\?P|\(\?\(|\(\?[iLmsux]')
+
+    @classmethod
+    def can_combine(cls, pattern):
+        return not cls._uncombinable.search(pattern)
+
+    def __init__(self, regexes):
+        self.regexes = []
+        chunk = []
+        num_groups = 0
+        for regex in regexes:
+            if chunk and num_groups + regex.groups > self._max_groups:
+                self.regexes.append(self._compile(chunk))
+                chunk = []
+                num_groups = 0
+            chunk.append(regex.pattern)
+            num_groups += regex.groups
+        if chunk:
+            self.regexes.append(self._compile(chunk))
+
+        self._item_name = None
+        self._results = {}
+
+    def _compile(self, patterns):
+        return Matcher(u'|'.join([u'(?:{0})'.format(p) for p in patterns]),
+                       Condition._pattern_flags)
+
+    def search(self, item_name, string):
+        """Returns True if any of the combined patterns match the string.
+
+        Results are remembered for the current item, since the same field is
+        checked once for every condition in the group.
+        """
+        if item_name != self._item_name:
+            self._item_name = item_name
+            self._results = {}
+
+        if string not in self._results:
+            self._results[string] = any(regex.search(string)
+                                        for regex in self.regexes)
+        return self._results[string]
+
+
+class ConditionIndex(object):
+    """Rules out conditions for an item based on the literals in its fields.
+
+    For each (non-inverse) match subject of a condition, the literal strings
+    that any match of its pattern has to contain are extracted. The fields
+    of an item are scanned for all of the subreddit's literals at once, and
+    a condition can only match if, for each of those subjects, one of its
+    literals was found in one of the subject's fields. Conditions without
+    any usable literals are always checked, so the results are the same as
+    checking every condition.
+    """
+
+    def __init__(self, conditions):
+        literal_ids = {}
+        self._requirements = {}
+        for condition in conditions:
+            requirements = []
+            for subject, regex in condition.match_regexes.iteritems():
+                if not condition.match_success[subject]:
+                    continue
+                literals = required_literals(regex.pattern, regex.flags)
+                if not literals:
+                    continue
+                ids = frozenset(literal_ids.setdefault(l, len(literal_ids))
+                                for l in literals)
+                requirements.append((tuple(set(subject.split('+'))),
+                                     condition.ignore_blockquotes,
+                                     ids))
+            if requirements:
+                self._requirements[condition] = requirements
+                condition.condition_index = self
+
+        literals = sorted(literal_ids, key=literal_ids.get)
+        self.searcher = LiteralSearcher(literals)
+
+        self._view = None
+        self._found = {}
+
+    def __len__(self):
+        return len(self._requirements)
+
+    def _literals_in(self, view, source, ignore_blockquotes):
+        # keyed by the view rather than the item's name, an edited item that's
+        # checked again gets a new view of its current text
+        if view is not self._view:
+            self._view = view
+            self._found = {}
+
+        key = (source, ignore_blockquotes and source == 'body')
+        if key not in self._found:
+            string = view.get(source, ignore_blockquotes)
+            self._found[key] = self.searcher.search(fold_case(string))
+        return self._found[key]
+
+    def could_match(self, condition, view):
+        for sources, ignore_blockquotes, ids in self._requirements[condition]:
+            if not any(ids & self._literals_in(view, source,
+                                               ignore_blockquotes)
+                       for source in sources):
+                return False
+        return True
+
+
+class ConditionPlan(object):
+    """A subreddit's conditions for one queue, in the order they're checked.
+
+    Built when the conditions are loaded, so checking an item doesn't have
+    to filter or sort them again.
+
+    conditions - all of the queue's conditions, cheapest first
+    submission, comment - (removal conditions, other conditions) to check
+        each kind of item with, cheapest first
+    check_shadowbanned - True if authors' shadowbans need to be checked
+    """
+
+    __slots__ = ('conditions', 'submission', 'comment', 'check_shadowbanned')
+
+    def __init__(self, conditions, check_shadowbanned=False):
+        # check the conditions needing the fewest requests first
+        self.conditions = tuple(sorted(conditions,
+                                       key=lambda c: c.requests_required))
+        self.submission = self._split('submission')
+        self.comment = self._split('comment')
+        self.check_shadowbanned = check_shadowbanned
+
+    def _split(self, kind):
+        conditions = [c for c in self.conditions
+                      if c.type in (kind, 'both')]
+        return (tuple(c for c in conditions
+                      if c.action in ('remove', 'spam')),
+                tuple(c for c in conditions
+                      if c.action not in ('remove', 'spam')))
+
+    def __len__(self):
+        return len(self.conditions)
+
+    def __iter__(self):
+        return iter(self.conditions)
+
+    def for_item(self, item):
+        """Returns the (removal, other) conditions to check the item with."""
+        if isinstance(item, praw.objects.Submission):
+            return self.submission
+        return self.comment
+
+
+class ConditionSetCache(object):
+    """Keeps the compiled conditions of each subreddit's YAML.
+
+    A set is reused as long as its YAML and the versions of the standard
+    conditions it includes are unchanged, so a reload only rebuilds the
+    subreddits whose conditions changed. Subreddits with the same YAML
+    share a set. Sets that haven't been used since the last prune() are
+    dropped by it.
+
+    If path is set, the parsed definitions are also stored (marshalled, so
+    loading them can't run code) in a sqlite database there, so they don't
+    need to be parsed again after a restart. Entries are removed after
+    max_age seconds.
+    """
+
+    def __init__(self, path=None, max_age=30*86400):
+        self.hits = 0
+        self.misses = 0
+        self._sets = {}
+        self._parsed = {}
+        self._used = set()
+        self._db = None
+
+        if path:
+            self._db = sqlite3.connect(path)
+            self._db.execute('CREATE TABLE IF NOT EXISTS condition_sets ('
+                             'yaml_hash TEXT PRIMARY KEY, '
+                             'definitions BLOB NOT NULL, '
+                             'stored REAL NOT NULL)')
+            self._db.execute('DELETE FROM condition_sets WHERE stored < ?',
+                             (time() - max_age,))
+            self._db.commit()
+
+    @staticmethod
+    def _key(conditions_yaml):
+        return hashlib.sha1(
+            (conditions_yaml or '').encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _is_current(standards):
+        return all(Condition.get_standard_version(name) == version
+                   for name, version in standards)
+
+    def get(self, sr_name, conditions_yaml):
+        """Returns the conditions for the YAML, compiling them if needed."""
+        key = self._key(conditions_yaml)
+        self._used.add(key)
+
+        if key in self._sets:
+            conditions, standards = self._sets[key]
+            if self._is_current(standards):
+                self.hits += 1
+                return conditions
+
+        self.misses += 1
+        definitions = self._get_definitions(key, conditions_yaml)
+        conditions = compile_conditions(sr_name, definitions)
+        self._sets[key] = (conditions, self._standards(definitions))
+        return conditions
+
+    def install(self, conditions_yaml, definitions, conditions=None):
+        """Adds conditions that were already validated.
+
+        Without the compiled conditions, only the definitions are kept and
+        the conditions are compiled the first time they're used.
+        """
+        key = self._key(conditions_yaml)
+        self._store_definitions(key, definitions)
+        if conditions is None:
+            self._parsed[key] = definitions
+            self._sets.pop(key, None)
+        else:
+            self._sets[key] = (conditions, self._standards(definitions))
+
+    @staticmethod
+    def _standards(definitions):
+        names = set(unicode(values['standard']).lower()
+                    for values, _ in definitions if 'standard' in values)
+        return tuple((name, Condition.get_standard_version(name))
+                     for name in sorted(names))
+
+    def _get_definitions(self, key, conditions_yaml):
+        if key in self._parsed:
+            return self._parsed.pop(key)
+        if self._db:
+            row = self._db.execute('SELECT definitions FROM condition_sets '
+                                   'WHERE yaml_hash = ?', (key,)).fetchone()
+            if row:
+                try:
+                    return marshal.loads(str(row[0]))
+                except (EOFError, ValueError, TypeError):
+                    logging.warning('Unreadable cached conditions {0}, '
+                                    'parsing them again'.format(key))
+
+        definitions = parse_conditions(conditions_yaml)
+        self._store_definitions(key, definitions)
+        return definitions
+
+    def _store_definitions(self, key, definitions):
+        if not self._db:
+            return
+        try:
+            data = marshal.dumps(definitions)
+        except ValueError:
+            # values marshal can't store (e.g. dates), parsed every time
+            return
+        self._db.execute('INSERT OR REPLACE INTO condition_sets '
+                         'VALUES (?, ?, ?)',
+                         (key, sqlite3.Binary(data), time()))
+        self._db.commit()
+
+    def is_stale(self, conditions_yaml):
+        """Returns True if standard conditions in the YAML's set changed."""
+        entry = self._sets.get(self._key(conditions_yaml))
+        return bool(entry) and not self._is_current(entry[1])
+
+    def prune(self):
+        """Drops the sets that haven't been used since the last prune."""
+        for key in set(self._sets) - self._used:
+            del self._sets[key]
+        self._used = set()
+
+    def stats(self):
+        return 'hits: {0}, misses: {1}, size: {2}'.format(
+            self.hits, self.misses, len(self._sets))
+
+
+def build_pattern_groups(conditions):
+    """Combines the conditions' patterns into a PatternGroup per field."""
+    regexes = {}
+    members = {}
+    for condition in conditions:
+        for subject, regex in condition.match_regexes.iteritems():
+            # only linear-time patterns, so one slow pattern can't make
+            # every search on the field slow
+            if not regex.linear or not PatternGroup.can_combine(regex.pattern):
+                continue
+            for source in set(subject.split('+')):
+                regexes.setdefault(source, {})[regex.pattern] = regex
+                members.setdefault(source, []).append((condition, subject))
+
+    for source in regexes:
+        try:
+            group = PatternGroup(regexes[source].values())
+        except Exception as e:
+            logging.error('Unable to combine {0} patterns: {1}'
+                          .format(source, e))
+            continue
+        for condition, subject in members[source]:
+            if condition.pattern_groups is None:
+                condition.pattern_groups = {}
+            condition.pattern_groups[(subject, source)] = group
+
+
 def update_from_wiki(subreddit, requester):
-    """Updates conditions from the subreddit's wiki."""
+    """Updates conditions from the subreddit's wiki.
+
+    Large pages are validated in the validation pool if there is one, and
+    installed later by finish_wiki_updates(). Any validation still pending
+    for the subreddit is dropped, so older pages can't replace newer ones.
+
+    Returns True if the subreddit's conditions were updated.
+    """
     global r
     username = cfg_file.get('reddit', 'username')
 
     try:
-        page = subreddit.get_wiki_page(cfg_file.get('reddit', 'wiki_page_name'))
+        with request_scheduler.request_type('wiki'):
+            page = subreddit.get_wiki_page(cfg_file.get('reddit',
+                                                        'wiki_page_name'))
     except Exception:
         send_error_message(requester, subreddit.display_name,
             'The wiki page could not be accessed. Please ensure the page '
@@ -399,31 +1028,66 @@ def update_from_wiki(subreddit, requester):
             .format(subreddit.display_name,
                     cfg_file.get('reddit', 'wiki_page_name'),
                     username))
-        return
+        return False
 
-    html_parser = HTMLParser.HTMLParser()
     page_content = html_parser.unescape(page.content_md)
 
+    if pending_validations.pop(subreddit.display_name.lower(), None):
+        logging.info('Dropped the pending validation for /r/{0}, the wiki '
+                     'was updated again'.format(subreddit.display_name))
+
+    if (validation_pool and
+            len(page_content) >= get_option('performance',
+                                            'validation_min_size', 50000)):
+        # make sure the standard conditions are loaded to pass them on
+        Condition.get_standard_condition('')
+        standards = (Condition._standard_cache, Condition._standard_versions)
+        pending_validations[subreddit.display_name.lower()] = (
+            subreddit.display_name, requester, page_content,
+            validation_pool.apply_async(validate_in_worker,
+                                        (page_content, standards)))
+        logging.info('Validating /r/{0} conditions in the background'
+                     .format(subreddit.display_name))
+        return False
+
+    try:
+        definitions, conditions = validate_conditions(page_content)
+    except ValueError as e:
+        send_error_message(requester, subreddit.display_name, e.args[0])
+        return False
+
+    index_conditions(conditions)
+    install_conditions(subreddit.display_name, requester, page_content,
+                       definitions, conditions)
+    return True
+
+
+def validate_conditions(page_content):
+    """Checks that the conditions on a wiki page are all valid.
+
+    Returns the (values, yaml_hash) pair and compiled Condition for each
+    of them, raises ValueError with the message for the moderators if
+    any aren't valid.
+    """
     # check that all the conditions are valid yaml
-    condition_defs = yaml.safe_load_all(page_content)
+    condition_defs = []
     condition_num = 1
     try:
-        for cond_def in condition_defs:
+        for cond_def in yaml.load_all(page_content, Loader=yaml_loader):
+            condition_defs.append(cond_def)
             condition_num += 1
     except Exception as e:
         indented = ''
         for line in str(e).split('\n'):
             indented += '    {0}\n'.format(line)
-        send_error_message(requester, subreddit.display_name,
-            'Error when reading conditions from wiki - '
-            'Syntax invalid in section #{0}:\n\n{1}'
-            .format(condition_num, indented))
-        return
+        raise ValueError('Error when reading conditions from wiki - '
+                         'Syntax invalid in section #{0}:\n\n{1}'
+                         .format(condition_num, indented))
 
-    # reload and actually process the conditions
-    condition_defs = yaml.safe_load_all(page_content)
+    # process the conditions
     condition_num = 1
-    kept_sections = []
+    definitions = []
+    conditions = []
     for cond_def in condition_defs:
         # ignore any non-dict sections (can be used as comments, etc.)
         if not isinstance(cond_def, dict):
@@ -433,37 +1097,108 @@ def update_from_wiki(subreddit, requester):
         cond_def = {k.lower(): v for k, v in cond_def.iteritems()}
 
         try:
-            check_condition_valid(cond_def)
+            # checked on a copy, since standard conditions are merged in
+            check_condition_valid(dict(cond_def))
         except ValueError as e:
-            send_error_message(requester, subreddit.display_name,
-                'Invalid condition in section #{0} - {1}'
-                .format(condition_num, e))
-            return
+            raise ValueError('Invalid condition in section #{0} - {1}'
+                             .format(condition_num, e))
 
-        # create a condition for final checks
-        condition = Condition(cond_def)
-
-        # test to make sure that the final regex(es) are valid
-        for pattern in condition.match_patterns.values():
-            try:
-                re.compile(pattern)
-            except Exception as e:
-                send_error_message(requester, subreddit.display_name,
-                    'Generated an invalid regex from section #{0} - {1}'
-                    .format(condition_num, e))
-                return
+        # create a condition for final checks, this compiles the regex(es)
+        # so it also makes sure that they are valid
+        yaml_hash = Condition.hash_values(cond_def)
+        try:
+            condition = Condition(cond_def, yaml_hash)
+        except Exception as e:
+            raise ValueError('Generated an invalid regex from section #{0} '
+                             '- {1}'.format(condition_num, e))
 
         condition_num += 1
-        kept_sections.append(cond_def)
+        definitions.append((cond_def, yaml_hash))
+        conditions.append(condition)
+
+    return definitions, conditions
+
+
+def validate_in_worker(page_content, standards):
+    """Runs validate_conditions() in a validation pool process.
+
+    standards - the bot's cached standard conditions and their versions,
+        so the process doesn't need the database
+
+    Compiled patterns can't be sent back to the bot, so only the parsed
+    definitions and backtracking sections are returned, with the error
+    message (or None) for the moderators.
+    """
+    # the process is reused, so drop what the last page's conditions shared
+    Condition.clear_interned()
+    Condition._standard_cache, Condition._standard_versions = standards
+    try:
+        definitions, conditions = validate_conditions(page_content)
+    except ValueError as e:
+        return None, None, e.args[0]
+    return definitions, backtracking_sections(conditions), None
+
+
+def backtracking_sections(conditions):
+    """Lists the conditions with regexes that need backtracking."""
+    return ['* section #{0}: {1}'.format(
+                condition_num, ', '.join(condition.backtracking_subjects))
+            for condition_num, condition in enumerate(conditions, 1)
+            if condition.backtracking_subjects]
+
+
+def finish_wiki_updates():
+    """Installs the conditions validated in the background that are done.
+
+    The compiled patterns can't be sent back from the pool, and compiling
+    them here would block the main loop, so only the definitions are
+    installed and the conditions are compiled once by the next reload.
+
+    Returns True if any subreddit's conditions were updated.
+    """
+    changes_made = False
+    for key, pending in pending_validations.items():
+        sr_name, requester, page_content, result = pending
+        if not result.ready():
+            continue
+        del pending_validations[key]
+
+        try:
+            definitions, backtracking, error = result.get()
+        except Exception as e:
+            logging.error('ERROR: validating /r/{0}: {1}'.format(sr_name, e))
+            error = 'The conditions could not be checked, please try again.'
+        if error:
+            send_error_message(requester, sr_name, error)
+            continue
+
+        install_conditions(sr_name, requester, page_content, definitions,
+                           None, backtracking)
+        changes_made = True
+    return changes_made
+
+
+def install_conditions(sr_name, requester, page_content, definitions,
+                       conditions, backtracking=None):
+    """Saves validated conditions, so they're used from the next reload.
+
+    The parsed definitions, and the compiled conditions if given, go
+    straight into the condition set cache, so initialize() doesn't need to
+    parse or compile them again.
+    """
+    username = cfg_file.get('reddit', 'username')
+
+    if condition_sets:
+        condition_sets.install(page_content, definitions, conditions)
 
     # Update the subreddit, or add it if necessary
     try:
         db_subreddit = (session.query(Subreddit)
-                       .filter(Subreddit.name == subreddit.display_name.lower())
+                       .filter(Subreddit.name == sr_name.lower())
                        .one())
     except NoResultFound:
         db_subreddit = Subreddit()
-        db_subreddit.name = subreddit.display_name.lower()
+        db_subreddit.name = sr_name.lower()
         db_subreddit.last_submission = datetime.utcnow() - timedelta(days=1)
         db_subreddit.last_spam = datetime.utcnow() - timedelta(days=1)
         db_subreddit.last_comment = datetime.utcnow() - timedelta(days=1)
@@ -472,10 +1207,18 @@ def update_from_wiki(subreddit, requester):
     db_subreddit.conditions_yaml = page_content
     session.commit()
 
+    if backtracking is None:
+        backtracking = backtracking_sections(conditions)
+    message = ("{0}'s conditions were successfully updated for /r/{1}"
+               .format(username, sr_name))
+    if backtracking:
+        message += ('\n\nThe regexes for the following can\'t be checked in '
+                    'linear time (they use backreferences, lookarounds or '
+                    'conditionals), so any check taking too long will be '
+                    'abandoned:\n\n{0}'.format('\n'.join(backtracking)))
     r.send_message(requester,
                    '{0} conditions updated'.format(username),
-                   "{0}'s conditions were successfully updated for /r/{1}"
-                   .format(username, subreddit.display_name))
+                   message)
 
 
 def check_condition_valid(cond):
@@ -602,11 +1345,12 @@ def validate_regex(check, key, pattern):
         raise ValueError('Invalid {0}: {1}'.format(key, check[key]))
 
 
-def send_error_message(user, sr_name, error):
+def send_error_message(user, sr_name, error,
+                       subject='Error updating from wiki in /r/{0}'):
     """Sends an error message to the user if a wiki update failed."""
     global r
     r.send_message(user,
-                   'Error updating from wiki in /r/{0}'.format(sr_name),
+                   subject.format(sr_name),
                    'Encountered the following error:\n\n{0}'.format(error))
 
 
@@ -614,6 +1358,9 @@ def process_messages():
     """Processes the bot's messages looking for invites/commands."""
     global r
     stop_time = int(cfg_file.get('reddit', 'last_message'))
+    if shard:
+        # kept in the database, so it's shared by this account's workers
+        stop_time = shard.get_last_message(stop_time)
     new_last_message = None
     changes_made = False
 
@@ -657,8 +1404,8 @@ def process_messages():
                     if message.author in subreddit.get_moderators():
                         logging.info('Updating from wiki in /r/{0}'
                                      .format(sr_name))
-                        update_from_wiki(subreddit, message.author)
-                        changes_made = True
+                        if update_from_wiki(subreddit, message.author):
+                            changes_made = True
                     else:
                         send_error_message(message.author, sr_name,
                             'You are not a moderator of that subreddit.')
@@ -673,7 +1420,9 @@ def process_messages():
         raise
     finally:
         # update cfg with new last_message value
-        if new_last_message:
+        if new_last_message and shard:
+            shard.set_last_message(new_last_message)
+        elif new_last_message:
             cfg_file.set('reddit', 'last_message', str(new_last_message))
             cfg_file.write(open(path_to_cfg, 'w'))
 
@@ -709,15 +1458,26 @@ def replace_placeholders(string, item, match):
     return string
 
 
-def check_items(queue, items, stop_time, sr_dict, cond_dict):
-    """Checks the items generator for any matching conditions."""
-    item_count = 0
-    start_time = time()
-    last_updates = {}
+def is_checked(item, last_time, last_id):
+    """Returns True if the item is no newer than a checkpoint.
+
+    Fullnames of the same kind are compared by their base36 ids, which
+    increase with every new item, otherwise the item's time is compared.
+    """
+    if last_id and last_id[:3] == item.name[:3]:
+        return int(item.id, 36) <= int(last_id[3:], 36)
+    return datetime.utcfromtimestamp(item.created_utc) < last_time
 
-    logging.debug('Checking {0} queue'.format(queue))
 
+def new_items(queue, items, checkpoints):
+    """Yields the items that need to be checked.
+
+    checkpoints - dict of subreddit name: (last time, last fullname) for
+        the subreddits in the listing. Reading stops at the oldest
+        checkpoint, and items before their own subreddit's are skipped.
+    """
     bot_username = cfg_file.get('reddit', 'username')
+    stop_time = min(last_time for last_time, _ in checkpoints.values())
     for item in items:
         # skip non-removed (reported) items when checking spam
         if queue == 'spam' and not item.banned_by:
@@ -727,45 +1487,162 @@ def check_items(queue, items, stop_time, sr_dict, cond_dict):
         if item.author and item.author.name.lower() == bot_username.lower():
             continue
 
+        # approved submissions can show up again out of order
+        if queue == 'submission' and item.approved_by:
+            yield item
+            continue
+
         item_time = datetime.utcfromtimestamp(item.created_utc)
-        if (item_time < stop_time and
-                (queue != 'submission' or not item.approved_by)):
+        if item_time < stop_time:
             break
 
+        sr_name = item.subreddit.display_name.lower()
+        last_time, last_id = checkpoints.get(sr_name, (stop_time, None))
+        if is_checked(item, last_time, last_id):
+            continue
+
+        yield item
+
+
+def fetch_items(queue, items, checkpoints):
+    """Reads all the items that need to be checked from a listing."""
+    start_time = time()
+    items_read = [0]
+
+    def count_items(items):
+        for item in items:
+            items_read[0] += 1
+            yield item
+
+    fetched = list(new_items(queue, count_items(items), checkpoints))
+    metrics.queue_fetch_seconds.observe(time() - start_time, queue)
+    traffic.record_fetch(items_read[0], len(fetched))
+    metrics.listing_pages.inc(queue, amount=items_read[0] // PAGE_SIZE + 1)
+    metrics.listing_items_skipped.inc(queue,
+                                      amount=items_read[0] - len(fetched))
+    if fetch_items.recorder:
+        fetch_items.recorder.record(queue, fetched)
+    logging.debug('Fetched {0} {1} items in {2}'
+                  .format(len(fetched), queue, elapsed_since(start_time)))
+    return fetched
+fetch_items.recorder = None
+
+
+def thread_session():
+    """Returns the calling background thread's own reddit session.
+
+    praw's sessions aren't thread-safe, so each background thread makes
+    its requests through its own, logged in by copying the global session's
+    cookies and modhash and going through the same request scheduler.
+    """
+    if getattr(thread_sessions, 'parent', None) is not r:
+        session = praw.Reddit(user_agent=cfg_file.get('reddit', 'user_agent'),
+                              handler=BudgetHandler(request_scheduler))
+        session.config = r.config
+        session.http.cookies.update(r.http.cookies)
+        session.modhash = r.modhash
+        session._authentication = r._authentication
+        session.user = r.user
+        thread_sessions.parent = r
+        thread_sessions.reddit = session
+    return thread_sessions.reddit
+
+
+def bind_to_thread(obj):
+    """Returns obj for use on the calling thread's own reddit session.
+
+    The global session is replaced by the thread's, and reddit objects by
+    a copy that makes its requests through it, so the original can still
+    be used on the main thread. Anything else is returned unchanged.
+    """
+    if obj is r:
+        return thread_session()
+    if not isinstance(obj, praw.objects.RedditContentObject):
+        return obj
+    # copied without going through praw's __getattr__, which would load
+    # objects that haven't been fetched
+    bound = object.__new__(type(obj))
+    bound.__dict__.update(vars(obj))
+    bound.__dict__['reddit_session'] = thread_session()
+    return bound
+
+
+def fetch_listing(queue, multi, queue_func, checkpoints):
+    """Fetches a listing in a fetch thread, with the thread's own session.
+
+    The items are handed back to the global session, since that's the one
+    the calling thread checks them and performs the actions with.
+    """
+    queue_subreddit = thread_session().get_subreddit('+'.join(multi))
+    listing = getattr(queue_subreddit, queue_func)(limit=None)
+    items = fetch_items(queue, listing, checkpoints)
+    for item in items:
+        attrs = vars(item)
+        for obj in (item, attrs.get('author'), attrs.get('subreddit')):
+            if obj is not None:
+                obj.reddit_session = r
+    return items
+
+
+def fetch_user_profile(username):
+    """Fetches a user's profile in a fetch thread, see get_user_profile()."""
+    return get_user_profile(thread_session().get_redditor(username,
+                                                          fetch=False))
+
+
+def check_items(queue, items, checkpoints, sr_dict, cond_dict):
+    """Checks the items generator for any matching conditions.
+
+    checkpoints - the listing's subreddits' checkpoints, see new_items()
+    """
+    item_count = 0
+    start_time = time()
+    last_updates = {}
+    newest_time = None
+    sr_counts = {}
+
+    logging.debug('Checking {0} queue'.format(queue))
+
+    for item in new_items(queue, items, checkpoints):
+        item_time = datetime.utcfromtimestamp(item.created_utc)
         sr_name = item.subreddit.display_name.lower()
         subreddit = sr_dict[sr_name]
-        conditions = cond_dict[sr_name][queue]
+        plan = cond_dict[sr_name][queue]
+
+        # another worker may have taken the subreddit over if this one's
+        # lease ran out, it checks the items from the checkpoint instead
+        if shard and not shard.owns(sr_name):
+            continue
 
         if (queue != 'report' and
-                (queue != 'submission' or not item.approved_by) and
-                sr_name not in last_updates):
-            last_updates[sr_name] = item_time
-
-        # don't need to check for shadowbanned unless we're in spam
-        # and the subreddit doesn't exclude shadowbanned posts
-        if queue == 'spam' and not subreddit.exclude_banned_modqueue:
-            for condition in conditions:
-                condition.check_shadowbanned = True
-        else:
-            for condition in conditions:
-                condition.check_shadowbanned = False
+                (queue != 'submission' or not item.approved_by)):
+            if sr_name not in last_updates:
+                last_updates[sr_name] = (item_time, item.name)
+            if not newest_time or item_time > newest_time:
+                newest_time = item_time
 
         item_count += 1
+        sr_counts[sr_name] = sr_counts.get(sr_name, 0) + 1
+        metrics.items_checked.inc(queue, sr_name)
 
         logging.debug('Checking item %s', get_permalink(item))
 
+        # fields are shared by all of the item's conditions
+        view = ItemView(item)
+
+        removals, others = plan.for_item(item)
+
+        item_start = time()
         try:
             # check removal conditions, stop checking if any matched
-            if check_conditions(subreddit, item,
-                                [c for c in conditions
-                                 if c.action in ('remove', 'spam')],
-                                stop_after_match=True):
+            if check_conditions(subreddit, item, removals,
+                                stop_after_match=True, view=view,
+                                check_shadowbanned=plan.check_shadowbanned):
                 continue
 
             # check all other conditions
-            check_conditions(subreddit, item,
-                             [c for c in conditions
-                              if c.action not in ('remove', 'spam')])
+            check_conditions(subreddit, item, others, view=view,
+                             check_shadowbanned=plan.check_shadowbanned)
         except (praw.errors.ModeratorRequired,
                 praw.errors.ModeratorOrScopeRequired,
                 HTTPError) as e:
@@ -775,63 +1652,77 @@ def check_items(queue, items, stop_time, sr_dict, cond_dict):
             raise
         except Exception as e:
             logging.error('ERROR: {0}'.format(e))
+        finally:
+            metrics.item_check_seconds.observe(time() - item_start, queue)
 
     # Update "last_" entries in db
-    for sr in last_updates:
-        setattr(sr_dict[sr], 'last_'+queue, last_updates[sr])
-    session.commit()
+    for sr, (item_time, fullname) in last_updates.iteritems():
+        setattr(sr_dict[sr], 'last_'+queue+'_id', fullname)
+        setattr(sr_dict[sr], 'last_'+queue, item_time)
+    # the whole listing was read back to the other subreddits' checkpoints,
+    # so they can move up too and the next read doesn't go as deep
+    if newest_time:
+        for sr in checkpoints:
+            if sr not in last_updates and sr in sr_dict:
+                setattr(sr_dict[sr], 'last_'+queue,
+                        max(getattr(sr_dict[sr], 'last_'+queue), newest_time))
+    traffic.record_items(queue, sr_counts)
+    process_completed_actions()
+    log_writer.commit()
 
     logging.debug('Checked {0} items in {1}'
                  .format(item_count, elapsed_since(start_time)))
+    return item_count
 
 
-def check_conditions(subreddit, item, conditions, stop_after_match=False):
+def check_conditions(subreddit, item, conditions, stop_after_match=False,
+                     view=None, check_shadowbanned=False):
     """Checks an item against a list of conditions.
 
+    The conditions are checked in order, so should be the ones for the
+    item's kind from a ConditionPlan.
+
     Returns True if any conditions matched, False otherwise.
     """
-    if isinstance(item, praw.objects.Submission):
-        conditions = [c for c in conditions
-                          if c.type in ('submission', 'both')]
-    elif isinstance(item, praw.objects.Comment):
-        conditions = [c for c in conditions
-                          if c.type in ('comment', 'both')]
-
-    # sort the conditions so the easiest ones are checked first
-    conditions.sort(key=lambda c: c.requests_required)
+    if view is None:
+        view = ItemView(item)
 
     any_matched = False
     for condition in conditions:
+        if condition_budget.over_item_budget(view.cpu_time):
+            logging.warning('Stopped checking {0} in /r/{1} after {2:.2f}s'
+                            .format(item.name, subreddit.name, view.cpu_time))
+            break
+
+        # skip conditions that can't match any of the item's fields
+        if not condition.could_match(view):
+            continue
+
+        # skip conditions that have been quarantined for being too slow
+        budget_key = (subreddit.name, condition.yaml_hash)
+        if condition_budget.is_quarantined(budget_key):
+            continue
+
         # never remove anything if it's been approved by a mod
         if condition.action in ('remove', 'spam') and item.approved_by:
             continue
 
         # don't approve shadowbanned users' posts unless specifically defined
         if (condition.action == 'approve' and
-                condition.check_shadowbanned and
+                check_shadowbanned and
                 not condition.user_conditions.get('is_shadowbanned') and
                 user_is_shadowbanned(item.author)):
             continue
 
         # don't bother checking condition if this action has already been done
-        if condition.action:
-            try:
-                session.query(Log).filter(
-                    and_(Log.item_fullname == item.name,
-                         Log.action == condition.action)).one()
-                continue
-            except NoResultFound:
-                pass
+        if (condition.action and
+                action_index.has_action(item, condition.action)):
+            continue
 
         # don't send repeat messages for the same item
-        if condition.comment or condition.modmail or condition.message:
-            try:
-                session.query(Log).filter(
-                    and_(Log.item_fullname == item.name,
-                         Log.condition_yaml == condition.yaml)).one()
-                continue
-            except NoResultFound:
-                pass
+        if ((condition.comment or condition.modmail or condition.message) and
+                action_index.has_condition(item, condition)):
+            continue
 
         # don't overwrite existing flair
         if ((condition.link_flair_text or condition.link_flair_class) and
@@ -844,19 +1735,32 @@ def check_conditions(subreddit, item, conditions, stop_after_match=False):
 
         try:
             start_time = time()
-            match = condition.check_item(item)
-            logging.debug('{0}\n  Result {1} in {2}'
-                          .format(condition.yaml,
+            start_cpu = thread_cpu_time()
+            match = condition.check_item(item, view, check_shadowbanned)
+            logging.debug('Condition {0}: result {1} in {2}'
+                          .format(condition.yaml_hash[:10],
                                   match,
                                   elapsed_since(start_time)))
         except (praw.errors.ModeratorRequired,
                 praw.errors.ModeratorOrScopeRequired,
                 HTTPError) as e:
             raise
+        except MatchTimeout as e:
+            logging.warning('Gave up matching {0} in /r/{1}: {2}\n{3}'
+                            .format(item.name, subreddit.name, e,
+                                    condition.yaml))
+            match = False
         except Exception as e:
             logging.error('ERROR: {0}\n{1}'.format(e, condition.yaml))
             match = False
-
+        finally:
+            elapsed = thread_cpu_time() - start_cpu
+            view.cpu_time += elapsed
+            if condition_budget.record(budget_key, elapsed):
+                quarantine_condition(subreddit, condition)
+
+        if match:
+            metrics.matches.inc(subreddit.name)
         any_matched = (any_matched or match)
         if stop_after_match and any_matched:
             break
@@ -864,6 +1768,170 @@ def check_conditions(subreddit, item, conditions, stop_after_match=False):
     return any_matched
 
 
+class ActionIndex(object):
+    """In-memory index of the actions already performed on items.
+
+    Answers "has this already been done?" without querying the log table.
+    Entries are kept in the order they were logged and evicted once they
+    are older than max_age or the index grows past max_size. The horizon is
+    the time before which entries may have been evicted, any action on an
+    item created after it must have been logged after it too, so the index
+    is only incomplete for items older than that. Those fall back to
+    querying the database.
+    """
+
+    def __init__(self, max_age, max_size):
+        self.max_age = max_age
+        self.max_size = max_size
+        self.horizon = datetime.utcnow() - max_age
+        self._entries = OrderedDict()
+
+    def load(self):
+        """Fills the index with the recent entries from the log table."""
+        self._entries = OrderedDict()
+        self.horizon = datetime.utcnow() - self.max_age
+
+        rows = (session.query(Log.item_fullname, Log.action,
+                              Log.condition_hash, Log.datetime)
+                       .filter(Log.datetime >= self.horizon)
+                       .order_by(Log.datetime))
+        for fullname, action, condition_hash, logged in rows:
+            if action:
+                self._add(('action', fullname, action), logged)
+            if condition_hash:
+                self._add(('condition', fullname, condition_hash), logged)
+        self._evict()
+
+        logging.info('Loaded {0} entries into the action index'
+                     .format(len(self._entries)))
+
+    def _add(self, key, logged):
+        self._entries.pop(key, None)
+        self._entries[key] = logged
+
+    def _evict(self):
+        cutoff = datetime.utcnow() - self.max_age
+        if cutoff > self.horizon:
+            self.horizon = cutoff
+
+        while self._entries:
+            key, logged = next(self._entries.iteritems())
+            if logged >= cutoff and len(self._entries) <= self.max_size:
+                break
+            del self._entries[key]
+            if logged > self.horizon:
+                self.horizon = logged
+
+    def add_action(self, fullname, action, logged):
+        if action:
+            self._add(('action', fullname, action), logged)
+            self._evict()
+
+    def add_condition(self, fullname, yaml_hash, logged):
+        self._add(('condition', fullname, yaml_hash), logged)
+        self._evict()
+
+    def discard_action(self, fullname, action):
+        self._entries.pop(('action', fullname, action), None)
+
+    def discard_condition(self, fullname, yaml_hash):
+        self._entries.pop(('condition', fullname, yaml_hash), None)
+
+    def covers(self, item):
+        """Returns True if the index has all of the item's log entries."""
+        return datetime.utcfromtimestamp(item.created_utc) > self.horizon
+
+    def has_action(self, item, action):
+        """Returns True if the action was already performed on the item."""
+        if ('action', item.name, action) in self._entries:
+            return True
+        if self.covers(item):
+            return False
+
+        return (session.query(Log.id)
+                       .filter(and_(Log.item_fullname == item.name,
+                                    Log.action == action))
+                       .first() is not None)
+
+    def has_condition(self, item, condition):
+        """Returns True if the condition already matched the item."""
+        if ('condition', item.name, condition.yaml_hash) in self._entries:
+            return True
+        if self.covers(item):
+            return False
+
+        return (session.query(Log.id)
+                       .filter(and_(Log.item_fullname == item.name,
+                                    Log.condition_hash == condition.yaml_hash))
+                       .first() is not None)
+
+
+class LogWriter(object):
+    """Buffers log entries and writes them to the database in batches.
+
+    durability - 'sync' writes entries (and commits) before execute_actions
+        returns, 'batched' only writes once max_rows entries are buffered or
+        max_seconds have passed since the last write, so at most that many
+        entries can be lost if the bot crashes.
+    """
+
+    def __init__(self, durability, max_rows, max_seconds):
+        if durability not in ('sync', 'batched'):
+            raise ValueError('Invalid log_durability: {0}'.format(durability))
+        self.durability = durability
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.last_flush = time()
+        self._rows = []
+
+    def add(self, item_fullname, action, condition_hash, logged):
+        self._rows.append({'item_fullname': item_fullname,
+                           'action': action,
+                           'condition_hash': condition_hash,
+                           'datetime': logged})
+
+    def flush_due(self):
+        return (self.durability == 'sync' or
+                len(self._rows) >= self.max_rows or
+                time() - self.last_flush >= self.max_seconds)
+
+    def commit(self):
+        """Commits the session, in batched mode only once a flush is due."""
+        if self.flush_due():
+            self.flush()
+
+    def flush(self):
+        """Inserts all buffered entries with a single executemany."""
+        start_time = time()
+        if self._rows:
+            session.execute(Log.__table__.insert(), self._rows)
+        session.commit()
+        metrics.db_commit_seconds.observe(time() - start_time)
+
+        logging.debug('Wrote {0} log entries'.format(len(self._rows)))
+        self._rows = []
+        self.last_flush = time()
+
+
+def quarantine_condition(subreddit, condition):
+    """Notifies the subreddit's mods that a condition was quarantined."""
+    logging.warning('Quarantined slow condition in /r/{0}:\n{1}'
+                    .format(subreddit.name, condition.yaml))
+
+    indented = ''
+    for line in condition.yaml.split('\n'):
+        indented += '    {0}\n'.format(line)
+    request_scheduler.defer('modmail', send_error_message,
+        '/r/'+subreddit.name, subreddit.name,
+        'The following condition took more than {0}s to check {1} times '
+        'in {2} minutes, so it will not be checked for the next {3} '
+        'minutes. Simplifying its regexes should fix this.\n\n{4}'
+        .format(condition_budget.condition_budget, condition_budget.strikes,
+                condition_budget.window // 60, condition_budget.cooldown // 60,
+                indented),
+        'Slow condition disabled in /r/{0}')
+
+
 def filter_conditions(conditions, queue):
     """Filters a list of conditions based on the queue's needs."""
     if queue == 'spam':
@@ -891,57 +1959,81 @@ def filter_conditions(conditions, queue):
 
 def get_user_rank(user, subreddit):
     """Returns the user's rank in the subreddit."""
-    sr_name = subreddit.display_name.lower()
-
-    # fetch mod/contrib lists if necessary
-    cached = False
-    if sr_name in get_user_rank.moderator_cache:
-        cache_age = datetime.utcnow() - get_user_rank.cache_time[sr_name] 
-        if cache_age < timedelta(hours=1):
-            cached = True
-
-    if not cached:
-        get_user_rank.cache_time[sr_name] = datetime.utcnow()
-
-        mod_list = set()
-        for mod in subreddit.get_moderators():
-            mod_list.add(mod.name)
-        get_user_rank.moderator_cache[sr_name] = mod_list
-
-        contrib_list = set()
-        try:
-            for contrib in subreddit.get_contributors():
-                contrib_list.add(contrib.name)
-        except HTTPError as e:
-            if e.response.status_code != 404:
-                raise
-        get_user_rank.contributor_cache[sr_name] = contrib_list
-
-    if user.name in get_user_rank.moderator_cache[sr_name]:
-        return 'moderator'
-    elif user.name in get_user_rank.contributor_cache[sr_name]:
-        return 'contributor'
-    else:
-        return 'user'
-get_user_rank.moderator_cache = {}
-get_user_rank.contributor_cache = {}
-get_user_rank.cache_time = {}
+    return user_rank_cache.get_rank(subreddit, user.name)
 
 
 def user_is_shadowbanned(user):
     """Returns True if the user is shadowbanned."""
     global r
 
+    banned = shadowban_cache.get(user.name)
+    if banned is not None:
+        return banned
+
+    banned = False
     try: # try to get user overview
-        list(user.get_overview(limit=1))
+        with request_scheduler.request_type('user'):
+            list(user.get_overview(limit=1))
     except HTTPError as e:
         # if that failed, they're probably shadowbanned
         if e.response.status_code == 404:
-            return True
+            banned = True
         else:
             raise
 
-    return False
+    shadowban_cache.set(user.name, banned)
+    return banned
+
+
+def get_user_profile(user):
+    """Returns a dict of the user's karma, creation time and gold status.
+
+    Cached by username, so each user's /about is only fetched once per TTL.
+    """
+    profile = user_profile_cache.get(user.name.lower())
+    if profile is None:
+        with request_scheduler.request_type('user'):
+            profile = {attr: getattr(user, attr, 0)
+                       for attr in get_user_profile.attrs}
+        user_profile_cache.set(user.name.lower(), profile,
+                               get_user_profile.ttl)
+    return profile
+get_user_profile.attrs = ('link_karma', 'comment_karma', 'created_utc',
+                          'is_gold')
+get_user_profile.ttl = 3600
+
+
+def prefetch_user_profiles(queue, items, cond_dict):
+    """Fetches the profiles of all the listing's authors in parallel.
+
+    Only done for subreddits with conditions in the queue that need them,
+    and only for authors that aren't already cached.
+    """
+    profile_conditions = set(['account_age', 'combined_karma', 'comment_karma',
+                              'link_karma', 'is_gold'])
+    usernames = set()
+    for item in items:
+        if not item.author or item.author.name.lower() in usernames:
+            continue
+        sr_name = item.subreddit.display_name.lower()
+        if not any(profile_conditions.intersection(c.user_conditions)
+                   for c in cond_dict[sr_name][queue]):
+            continue
+        if user_profile_cache.get(item.author.name.lower()) is None:
+            usernames.add(item.author.name.lower())
+
+    jobs = []
+    for username in usernames:
+        jobs.append(fetch_pool.submit(fetch_user_profile, username))
+    for job in jobs:
+        try:
+            job.result()
+        except HTTPError:
+            # will be retried (and handled) when checking the item
+            pass
+
+    if jobs:
+        logging.debug('Prefetched {0} user profiles'.format(len(jobs)))
 
 
 def get_permalink(item):
@@ -974,49 +2066,91 @@ def elapsed_since(start_time):
     return timedelta(seconds=elapsed)
 
 
-def build_multireddit_groups(subreddits):
-    """Splits a subreddit list into groups if necessary (due to url length)."""
-    multireddits = []
-    current_multi = []
-    current_len = 0
-    for sub in subreddits:
-        if current_len > 3000:
-            multireddits.append(current_multi)
-            current_multi = []
-            current_len = 0
-        current_multi.append(sub)
-        current_len += len(sub) + 1
-    multireddits.append(current_multi)
-
-    return multireddits
+def get_poll_targets(queue_funcs, sr_dict, cond_dict):
+    """Returns a (queue, multireddit) pair for each listing to check.
 
+    Subreddits are grouped by how busy they are, using the rates seen so
+    far, or assuming one item since the last one checked if there are none.
+    """
+    poll_interval = get_option('polling', 'max_interval', 300)
+    now = datetime.utcnow()
 
-def check_queues(queue_funcs, sr_dict, cond_dict):
-    """Checks all the queues for new items to process."""
-    global r
-    
+    targets = []
     for queue in queue_funcs:
         subreddits = [s for s in sr_dict if len(cond_dict[s][queue]) > 0]
         if len(subreddits) == 0:
             continue
 
-        multireddits = build_multireddit_groups(subreddits)
-
-        # fetch and process the items for each multireddit
-        for multi in multireddits:
-            if queue == 'report':
-                limit = cfg_file.get('reddit', 'report_backlog_limit_hours')
-                stop_time = datetime.utcnow() - timedelta(hours=int(limit))
+        rates = {}
+        for sr_name in subreddits:
+            last_item = getattr(sr_dict[sr_name], 'last_'+queue, None)
+            if last_item:
+                default = 1.0 / max((now - last_item).total_seconds(), 1)
             else:
-                stop_time = max([getattr(sr, 'last_'+queue)
-                                 for sr in sr_dict.values()
-                                 if sr.name in multi])
+                default = 0.0
+            rates[sr_name] = traffic.rate(queue, sr_name, default)
 
+        for multi in plan_groups(rates, poll_interval):
+            targets.append((queue, tuple(multi)))
+    return targets
+
+
+def check_queues(queue_funcs, sr_dict, cond_dict, targets=None):
+    """Checks the queues for new items to process.
+
+    targets - the (queue, multireddit) pairs to check, all of them if None
+
+    If the fetch pool is enabled, the listings for all the queues and
+    multireddits are fetched in parallel, but the items are still checked
+    one listing at a time, in order, by the calling thread.
+
+    Returns a dict of the number of new items checked for each target, and
+    a dict of the exception for each target that failed. A target failing
+    doesn't stop the others from being checked.
+    """
+    global r
+
+    if targets is None:
+        targets = get_poll_targets(queue_funcs, sr_dict, cond_dict)
+
+    listings = []
+    for queue, multi in targets:
+        if queue == 'report':
+            limit = cfg_file.get('reddit', 'report_backlog_limit_hours')
+            stop_time = datetime.utcnow() - timedelta(hours=int(limit))
+            checkpoints = dict((sr_name, (stop_time, None))
+                               for sr_name in multi)
+        else:
+            checkpoints = dict((sr.name, (getattr(sr, 'last_'+queue),
+                                          getattr(sr, 'last_'+queue+'_id')))
+                               for sr in sr_dict.values()
+                               if sr.name in multi)
+
+        if fetch_pool:
+            items = fetch_pool.submit(fetch_listing, queue, multi,
+                                      queue_funcs[queue], checkpoints)
+        else:
             queue_subreddit = r.get_subreddit('+'.join(multi))
-            if queue_subreddit:
-                queue_func = getattr(queue_subreddit, queue_funcs[queue])
-                items = queue_func(limit=None)
-                check_items(queue, items, stop_time, sr_dict, cond_dict)
+            items = getattr(queue_subreddit, queue_funcs[queue])(limit=None)
+        listings.append(((queue, multi), items, checkpoints))
+
+    counts = {}
+    errors = {}
+    for target, items, checkpoints in listings:
+        queue = target[0]
+        try:
+            if fetch_pool:
+                items = items.result()
+                prefetch_user_profiles(queue, items, cond_dict)
+            else:
+                items = fetch_items(queue, items, checkpoints)
+            counts[target] = check_items(queue, items, checkpoints,
+                                         sr_dict, cond_dict)
+        except Exception as e:
+            logging.warning('Checking the {0} queue of /r/{1} failed: {2}'
+                            .format(queue, '+'.join(target[1]), e))
+            errors[target] = e
+    return counts, errors
 
 
 def initialize(queues, reload_mod_subs=True):
@@ -1038,26 +2172,141 @@ def initialize(queues, reload_mod_subs=True):
     # get rid of any subreddits the bot doesn't moderate
     subreddits = [s for s in subreddits if s.name in modded_subs]
 
+    # and any that other workers are responsible for
+    if shard:
+        shard.set_moderated(modded_subs)
+        subreddits = [s for s in subreddits if shard.owns(s.name)]
+        logging.info('Worker {0} is checking {1} subreddits'
+                     .format(shard.worker_id, len(subreddits)))
+
+    # values are only shared between conditions compiled by the same load,
+    # so the tables don't keep the ones of replaced conditions alive
+    Condition.clear_interned()
+
     sr_dict = {}
     cond_dict = {}
     for sr in subreddits:
         sr_dict[sr.name] = sr
-        cond_dict[sr.name] = {}
-
-        conditions = [Condition(d)
-                      for d in yaml.safe_load_all(sr.conditions_yaml)
-                      if isinstance(d, dict)]
-        for queue in queues:
-            cond_dict[sr.name][queue] = filter_conditions(conditions, queue)
+        cond_dict[sr.name] = load_conditions(sr.name, sr.conditions_yaml,
+                                             queues,
+                                             sr.exclude_banned_modqueue)
+
+    if condition_sets:
+        condition_sets.prune()
+        logging.info('Condition sets: {0}'.format(condition_sets.stats()))
+    if condition_budget:
+        condition_budget.prune((sr_name, condition.yaml_hash)
+                               for sr_name, plans in cond_dict.iteritems()
+                               for plan in plans.values()
+                               for condition in plan)
 
     return (sr_dict, cond_dict)
 
 
+def load_conditions(sr_name, conditions_yaml, queues,
+                    exclude_banned_modqueue=False):
+    """Builds a subreddit's conditions, returns a ConditionPlan per queue."""
+    if condition_sets:
+        conditions = condition_sets.get(sr_name, conditions_yaml)
+    else:
+        conditions = compile_conditions(sr_name,
+                                        parse_conditions(conditions_yaml))
+
+    # don't need to check for shadowbanned unless we're in spam
+    # and the subreddit doesn't exclude shadowbanned posts
+    return {queue: ConditionPlan(filter_conditions(conditions, queue),
+                                 queue == 'spam' and
+                                 not exclude_banned_modqueue)
+            for queue in queues}
+
+
+def reload_standard_conditions(queues, sr_dict, cond_dict):
+    """Recompiles the subreddits whose standard conditions have changed.
+
+    Returns the new cond_dict, the old one is left as it was.
+    """
+    changed = Condition.refresh_standard_conditions()
+    if not changed:
+        return cond_dict
+
+    # find them all first, subreddits with the same YAML share a set
+    stale = [sr for sr in sr_dict.values()
+             if condition_sets.is_stale(sr.conditions_yaml)]
+    logging.info('Standard conditions changed: {0}, recompiling {1} '
+                 'subreddits'.format(', '.join(sorted(changed)), len(stale)))
+
+    cond_dict = dict(cond_dict)
+    for sr in stale:
+        cond_dict[sr.name] = load_conditions(sr.name, sr.conditions_yaml,
+                                             queues,
+                                             sr.exclude_banned_modqueue)
+    return cond_dict
+
+
+def parse_conditions(conditions_yaml):
+    """Returns a (values, yaml_hash) pair for each condition in the YAML."""
+    definitions = []
+    for d in yaml.load_all(conditions_yaml or '', Loader=yaml_loader):
+        if not isinstance(d, dict):
+            continue
+        values = {k.lower(): v for k, v in d.iteritems()}
+        definitions.append((values, Condition.hash_values(values)))
+    return definitions
+
+
+def compile_conditions(sr_name, definitions):
+    """Builds the conditions from their (values, yaml_hash) pairs."""
+    conditions = []
+    for values, yaml_hash in definitions:
+        try:
+            condition = Condition(values, yaml_hash)
+        except Exception as e:
+            logging.error('Invalid condition in /r/{0}: {1}\n{2}'
+                          .format(sr_name, e, values))
+            continue
+        conditions.append(condition)
+
+        if condition.backtracking_subjects:
+            logging.info('Backtracking regex for {0} in /r/{1}:\n{2}'
+                         .format(', '.join(condition.backtracking_subjects),
+                                 sr_name, condition.yaml))
+
+    index_conditions(conditions)
+    return conditions
+
+
+def index_conditions(conditions):
+    """Sets up the pattern groups and index for a subreddit's conditions."""
+    if get_option('performance', 'combine_patterns', False):
+        build_pattern_groups(conditions)
+    if get_option('performance', 'literal_prefilter', True):
+        ConditionIndex(conditions)
+
+
+def exit_on_sigterm(signum, frame):
+    """Exits through main()'s cleanup, so buffered log rows are written."""
+    logging.info('Stopping on SIGTERM')
+    raise SystemExit()
+
+
 def main():
-    global r
+    global r, action_index, log_writer, fetch_pool
+    global shadowban_cache, user_profile_cache, user_rank_cache
+    global condition_budget, action_pipeline, shard, condition_sets
+    global validation_pool
     logging.config.fileConfig(path_to_cfg)
-    # the below only works with re2
-    # re.set_fallback_notification(re.FALLBACK_EXCEPTION)
+
+    # started before any threads, since the processes are forked
+    validation_processes = get_option('performance', 'validation_processes',
+                                      0)
+    if validation_processes:
+        validation_pool = multiprocessing.Pool(validation_processes)
+    # after forking the pool, which is stopped with SIGTERM itself
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    Matcher.time_budget = get_option('performance', 'regex_time_budget', 1.0)
+    if Matcher.time_budget and not supports_time_budget():
+        logging.warning('The regex module isn\'t installed, slow regex '
+                        'searches will only be logged, not stopped')
 
     # which queues to check and the function to call
     queue_funcs = {'report': 'get_reports',
@@ -1065,9 +2314,76 @@ def main():
                    'submission': 'get_new',
                    'comment': 'get_comments'}
 
+    action_index = ActionIndex(
+        timedelta(hours=get_option('performance', 'action_index_hours', 48)),
+        get_option('performance', 'action_index_size', 200000))
+    action_index.load()
+    log_writer = LogWriter(
+        get_option('database', 'log_durability', 'sync'),
+        get_option('database', 'log_batch_rows', 100),
+        get_option('database', 'log_batch_seconds', 10))
+
+    shadowban_cache = ShadowbanCache(
+        get_option('performance', 'shadowban_cache_size', 10000),
+        get_option('performance', 'shadowban_positive_ttl', 86400),
+        get_option('performance', 'shadowban_negative_ttl', 600),
+        get_path_option('performance', 'shadowban_cache_file'))
+
+    condition_budget = ConditionBudget(
+        get_option('performance', 'condition_cpu_budget', 0.5),
+        get_option('performance', 'item_cpu_budget', 5.0),
+        get_option('performance', 'quarantine_strikes', 3),
+        get_option('performance', 'quarantine_window', 3600),
+        get_option('performance', 'quarantine_cooldown', 3600))
+
+    condition_sets = ConditionSetCache(
+        get_path_option('performance', 'condition_cache_file'))
+
+    user_profile_cache = LRUCache(
+        get_option('performance', 'user_cache_size', 10000))
+    get_user_profile.ttl = get_option('performance', 'user_cache_ttl', 3600)
+
+    user_rank_cache = UserRankCache(
+        WorkerPool(1, 'ranks'), request_scheduler,
+        get_option('performance', 'rank_cache_names', 500000),
+        get_option('performance', 'rank_cache_ttl', 3600),
+        get_option('performance', 'rank_full_refresh', 86400),
+        thread_session)
+
+    fetch_workers = get_option('performance', 'fetch_workers', 1)
+    if fetch_workers > 1:
+        fetch_pool = WorkerPool(fetch_workers, 'fetch')
+
+    if get_option('performance', 'action_pipeline', False):
+        action_pipeline = ActionPipeline(
+            request_scheduler,
+            get_option('performance', 'fast_action_workers', 2),
+            get_option('performance', 'slow_action_workers', 2),
+            get_option('performance', 'action_queue_size', 500),
+            bind_to_thread)
+
+    if get_option('sharding', 'enabled', False):
+        shard = ShardCoordinator(get_option('sharding', 'worker_id', ''),
+                                 get_option('sharding', 'lease_seconds', 60),
+                                 username=cfg_file.get('reddit', 'username'))
+        shard.heartbeat()
+        shard.start()
+
+    record_dir = get_option('benchmark', 'record_dir', '')
+    if record_dir:
+        fetch_items.recorder = ListingRecorder(record_dir)
+
+    metrics_port = get_option('metrics', 'port', 0)
+    if metrics_port:
+        metrics.start_server(metrics_port,
+                             get_option('metrics', 'host', '127.0.0.1'))
+
     while True:
         try:
-            r = praw.Reddit(user_agent=cfg_file.get('reddit', 'user_agent'))
+            r = praw.Reddit(user_agent=cfg_file.get('reddit', 'user_agent'),
+                            handler=BudgetHandler(request_scheduler))
+            if fetch_items.recorder:
+                r.config.store_json_result = True
             logging.info('Logging in as {0}'
                          .format(cfg_file.get('reddit', 'username')))
             r.login(cfg_file.get('reddit', 'username'),
@@ -1077,36 +2393,151 @@ def main():
         except Exception as e:
             logging.error('ERROR: {0}'.format(e))
     
-    run_counter = 0
-    while True:
-        run_counter += 1
+    try:
+        run(queue_funcs, sr_dict, cond_dict)
+    finally:
+        # let queued actions finish, so they're logged
+        if action_pipeline:
+            logging.info('Waiting for queued actions ({0})'
+                         .format(action_pipeline.stats()))
+            action_pipeline.join()
+            process_completed_actions()
+
+        if request_scheduler.num_deferred():
+            logging.warning('Exiting with {0} deferred messages unsent'
+                            .format(request_scheduler.num_deferred()))
+
+        # make sure any buffered log entries are written before exiting
         try:
-            # only check reports every 10 runs
-            # sleep afterwards in case ^C is needed
-            if run_counter % 10 == 0:
-                check_queues(queue_funcs, sr_dict, cond_dict)
+            log_writer.flush()
+        except Exception:
+            session.rollback()
+            log_writer.flush()
 
-                Condition.clear_standard_cache()
-                if process_messages():
-                    sr_dict, cond_dict = initialize(queue_funcs.keys(),
-                                                    reload_mod_subs=False)
-                logging.info('Sleeping ({0})'.format(datetime.now()))
-                sleep(5)
-                run_counter = 0
-            else:
-                check_queues({q: queue_funcs[q]
-                              for q in queue_funcs
-                              if q != 'report'},
-                             sr_dict, cond_dict)
-                if process_messages():
+        if shard:
+            shard.release()
+
+        if validation_pool:
+            validation_pool.terminate()
+
+
+def schedule_polls(poll_scheduler, queue_funcs, sr_dict, cond_dict):
+    """Sets the listings for the scheduler to poll after (re)initializing."""
+    report_interval = get_option('polling', 'report_interval', 60)
+    targets = get_poll_targets(queue_funcs, sr_dict, cond_dict)
+
+    fixed = {'messages': get_option('polling', 'message_interval', 30),
+             'housekeeping': report_interval}
+    if shard:
+        fixed['heartbeat'] = shard.lease_seconds / 3.0
+    for target in targets:
+        if target[0] == 'report':
+            fixed[target] = report_interval
+    poll_scheduler.set_targets([t for t in targets if t[0] != 'report'],
+                               fixed)
+
+
+def run(queue_funcs, sr_dict, cond_dict):
+    """The main loop, polls each listing whenever it's due until interrupted.
+
+    Reports, messages and housekeeping (logging stats, recompiling any
+    changed standard conditions) happen on fixed intervals, the other
+    queues' listings are polled more or less often depending on how busy
+    they are.
+    """
+    poll_scheduler = PollScheduler(
+        get_option('polling', 'min_interval', 5),
+        get_option('polling', 'max_interval', 300),
+        get_option('polling', 'target_items', 5),
+        get_option('polling', 'backoff', 1.5),
+        get_option('polling', 'idle_fraction', 0.25),
+        get_option('polling', 'jitter', 0.1))
+    schedule_polls(poll_scheduler, queue_funcs, sr_dict, cond_dict)
+
+    while True:
+        try:
+            # send any modmail/messages that were deferred
+            request_scheduler.run_deferred()
+            process_completed_actions()
+
+            due = poll_scheduler.due()
+            targets = [t for t in due
+                       if t not in ('messages', 'housekeeping', 'heartbeat')]
+            if targets:
+                counts, errors = check_queues(queue_funcs, sr_dict,
+                                              cond_dict, targets)
+                # only the listings that failed back off
+                for target in targets:
+                    if target in errors:
+                        poll_scheduler.failed(target)
+                    else:
+                        poll_scheduler.polled(target, counts.get(target, 0))
+                if errors:
+                    # handled below, e.g. re-initializing on lost permissions
+                    raise errors.values()[0]
+
+            if 'housekeeping' in due:
+                poll_scheduler.polled('housekeeping', 0)
+                cond_dict = reload_standard_conditions(queue_funcs.keys(),
+                                                       sr_dict, cond_dict)
+
+                # regroup the subreddits by their latest rates
+                schedule_polls(poll_scheduler, queue_funcs,
+                               sr_dict, cond_dict)
+                logging.info('Polling: {0}'.format(poll_scheduler.stats()))
+                logging.info('Listings: {0}'.format(traffic.report()))
+                logging.info('Requests made: {0}'
+                             .format(request_scheduler.stats()))
+                if action_pipeline:
+                    logging.info('Action pipeline: {0}'
+                                 .format(action_pipeline.stats()))
+                logging.info('Shadowban cache: {0}'
+                             .format(shadowban_cache.stats()))
+                logging.info('User cache: {0}'
+                             .format(user_profile_cache.stats()))
+                logging.info('Quarantined conditions: {0}'
+                             .format(condition_budget.num_quarantined()))
+                for (sr_name, yaml_hash), histogram in \
+                        condition_budget.slowest():
+                    logging.info('Slow condition {0} in /r/{1}: {2}'
+                                 .format(yaml_hash[:10], sr_name,
+                                         histogram.summary()))
+
+            # take over any subreddits from workers that have stopped
+            if 'heartbeat' in due:
+                poll_scheduler.polled('heartbeat', 0)
+                if shard.heartbeat():
+                    action_index.load()
+                    sr_dict, cond_dict = initialize(queue_funcs.keys())
+                    schedule_polls(poll_scheduler, queue_funcs,
+                                   sr_dict, cond_dict)
+
+            # only the account's leader handles messages when sharded
+            if 'messages' in due and (not shard or shard.is_leader()):
+                poll_scheduler.polled('messages', 0)
+                changes_made = process_messages()
+                changes_made = finish_wiki_updates() or changes_made
+                if changes_made:
+                    if shard:
+                        shard.request_reload()
                     sr_dict, cond_dict = initialize(queue_funcs.keys(),
                                                     reload_mod_subs=False)
+                    schedule_polls(poll_scheduler, queue_funcs,
+                                   sr_dict, cond_dict)
+            elif 'messages' in due:
+                poll_scheduler.polled('messages', 0)
+
+            # wake up at least every min_interval for deferred messages
+            sleep(min(poll_scheduler.seconds_until_due(),
+                      poll_scheduler.min_interval))
         except (praw.errors.ModeratorRequired,
                 praw.errors.ModeratorOrScopeRequired,
                 HTTPError) as e:
             if not isinstance(e, HTTPError) or e.response.status_code == 403:
                 logging.info('Re-initializing due to {0}'.format(e))
                 sr_dict, cond_dict = initialize(queue_funcs.keys())
+                schedule_polls(poll_scheduler, queue_funcs,
+                               sr_dict, cond_dict)
         except KeyboardInterrupt:
             raise
         except Exception as e:
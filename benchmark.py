@@ -0,0 +1,307 @@
+"""Benchmarks checking items against conditions, without reddit.
+
+Replays listings recorded by the bot (see record_dir in the [benchmark]
+section of the config) or synthetic items through check_items, with a
+throwaway in-memory database and every action stubbed out, for each of
+the given condition sets (YAML files in the wiki page format) or a few
+synthetic ones.
+
+    python benchmark.py --listings recorded/ rules/pics.yaml rules/news.yaml
+
+With --memory, the memory used by the condition sets loaded for that
+many subreddits is measured instead, compared to keeping each condition's
+attributes and YAML in a dict as they were before Condition was slotted.
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import gc
+import hashlib
+import logging
+import random
+import sys
+from time import time
+import types
+
+from sqlalchemy import create_engine, event
+import yaml
+
+import automoderator as am
+from budgets import ConditionBudget
+from caches import LRUCache, ShadowbanCache
+from matching import Matcher
+from models import Base, get_option, session, Subreddit
+from replay import (load_listings, ReplayReddit, synthetic_listings,
+                    synthetic_profile, WORDS)
+
+
+class StaticRanks(object):
+
+    """Stands in for UserRankCache, every author is a regular user."""
+
+    def get_rank(self, subreddit, username):
+        return 'user'
+
+
+def synthetic_conditions(count, seed=0):
+    """Generates a condition set in the wiki page YAML format."""
+    rand = random.Random(seed)
+    sections = []
+    for i in range(count):
+        kind = rand.random()
+        words = ', '.join(rand.sample(WORDS, rand.randint(1, 6)))
+        if kind < 0.4:
+            section = 'title: [{0}]\naction: report'.format(words)
+        elif kind < 0.7:
+            section = ('body: [{0}]\nmodifiers: [includes-word]\n'
+                       'action: remove'.format(words))
+        elif kind < 0.8:
+            section = ('title+body: [\'{0}\\s+{1}\', \'(\\d+)\\s*{2}\']\n'
+                       'modifiers: [regex]\naction: report'
+                       .format(rand.choice(WORDS), rand.choice(WORDS),
+                               rand.choice(WORDS)))
+        elif kind < 0.9:
+            section = ('domain: [{0}.com]\naction: spam'
+                       .format(rand.choice(WORDS)))
+        else:
+            section = ('title: [{0}]\nuser_conditions:\n'
+                       '    combined_karma: "< {1}"\n'
+                       'action: remove'.format(words, rand.randint(1, 1000)))
+        sections.append('# synthetic condition {0}\n{1}'.format(i, section))
+    return '\n---\n'.join(sections)
+
+
+def use_memory_database():
+    """Points the session at a new in-memory database and returns it."""
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session.close()
+    session.bind = engine
+    am.Condition.refresh_standard_conditions()
+    return engine
+
+
+def deep_size(roots, skip_types=()):
+    """Returns the bytes used by everything reachable from the roots.
+
+    Each object is counted once. Classes, modules and functions aren't
+    counted, nor are instances of skip_types or anything past them.
+    """
+    skip_types = (type, types.ModuleType, types.FunctionType) + skip_types
+    seen = set()
+    size = 0
+    pending = list(roots)
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, skip_types):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+
+def condition_dict(values):
+    """Returns the attributes a condition used to keep in its __dict__.
+
+    The compiled patterns are left out, like they are when measuring the
+    Condition objects.
+    """
+    values = {k.lower(): v for k, v in values.iteritems()}
+    attrs = am.Condition._defaults.copy()
+    if 'standard' in values:
+        attrs.update(am.Condition.get_standard_condition(values['standard']))
+    attrs.update(values)
+    attrs['yaml'] = yaml.dump(values)
+    attrs['yaml_hash'] = hashlib.sha1(attrs['yaml']).hexdigest()
+    attrs['match_patterns'] = {}
+    attrs['match_success'] = {}
+    attrs['pattern_groups'] = {}
+    attrs['condition_index'] = None
+    for key in [k for k in attrs
+                if k in am.Condition._match_targets or '+' in k]:
+        if isinstance(attrs['modifiers'], dict):
+            modifiers = attrs['modifiers'].get(key, [])
+        else:
+            modifiers = attrs['modifiers']
+        attrs['match_patterns'][key] = am.Condition.get_pattern(
+            key, attrs[key], modifiers)
+        attrs['match_success'][key] = 'inverse' not in modifiers
+    attrs['match_regexes'] = dict.fromkeys(attrs['match_patterns'])
+    return attrs
+
+
+def measure_memory(name, conditions_yaml, subreddits):
+    """Loads the conditions for a number of subreddits both ways.
+
+    Each subreddit's YAML is parsed separately, as it is by the bot.
+    """
+    use_memory_database()
+    definitions = [d for _ in range(subreddits)
+                   for d in yaml.safe_load_all(conditions_yaml)
+                   if isinstance(d, dict)]
+
+    dicts = [condition_dict(d) for d in definitions]
+    dicts_size = deep_size(dicts)
+    dicts_patterns = sum(len(d['match_patterns']) for d in dicts)
+    del dicts
+
+    am.Condition.clear_interned()
+    conditions = [am.Condition(d) for d in definitions]
+    del definitions
+    gc.collect()
+    return {'name': name,
+            'subreddits': subreddits,
+            'conditions': len(conditions),
+            'dicts_kb': dicts_size / 1024.0,
+            'slotted_kb': deep_size(conditions, (Matcher,)) / 1024.0,
+            'dicts_patterns': dicts_patterns,
+            'slotted_patterns': len(am.Condition._matchers)}
+
+
+def run_benchmark(name, conditions_yaml, reddit, listings):
+    """Checks all the items against the conditions, returns the results."""
+    engine = use_memory_database()
+    queries = [0]
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_query(*args):
+        queries[0] += 1
+
+    reddit.performed = []
+    am.r = reddit
+    am.action_index = am.ActionIndex(timedelta(hours=48), 200000)
+    am.action_index.load()
+    am.log_writer = am.LogWriter(
+        get_option('database', 'log_durability', 'sync'),
+        get_option('database', 'log_batch_rows', 100),
+        get_option('database', 'log_batch_seconds', 10))
+    am.condition_budget = ConditionBudget(0, 0)
+    am.user_rank_cache = StaticRanks()
+
+    # nothing is fetched about users, they're all in the caches
+    items = [item for queue_items in listings.values()
+             for item in queue_items]
+    am.shadowban_cache = ShadowbanCache(len(items) + 1, 86400, 86400)
+    am.user_profile_cache = LRUCache(len(items) + 1)
+    for item in items:
+        if item.author:
+            am.shadowban_cache.set(item.author.name, False)
+            am.user_profile_cache.set(item.author.name.lower(),
+                                      synthetic_profile(item.author.name),
+                                      86400)
+
+    sr_dict = {}
+    cond_dict = {}
+    long_ago = datetime.utcnow() - timedelta(days=3650)
+    for sr_name in set(i.subreddit.display_name.lower() for i in items):
+        sr = Subreddit(name=sr_name, enabled=True,
+                       conditions_yaml=conditions_yaml,
+                       last_submission=long_ago, last_spam=long_ago,
+                       last_comment=long_ago)
+        session.add(sr)
+        sr_dict[sr_name] = sr
+        cond_dict[sr_name] = am.load_conditions(sr_name, conditions_yaml,
+                                                listings.keys())
+    session.commit()
+    num_conditions = max([len(set(c for queue_conds in conds.values()
+                                  for c in queue_conds))
+                          for conds in cond_dict.values()] or [0])
+
+    # time each item by the check_conditions calls made for it
+    item_times = {}
+    check_conditions = am.check_conditions
+
+    def timed_check_conditions(subreddit, item, *args, **kwargs):
+        start_time = time()
+        try:
+            return check_conditions(subreddit, item, *args, **kwargs)
+        finally:
+            item_times[item.name] = (item_times.get(item.name, 0) +
+                                     time() - start_time)
+
+    checkpoints = dict((sr_name, (long_ago, None)) for sr_name in sr_dict)
+
+    am.check_conditions = timed_check_conditions
+    queries[0] = 0
+    start_time = time()
+    try:
+        for queue, queue_items in listings.iteritems():
+            am.check_items(queue, queue_items, checkpoints, sr_dict,
+                           cond_dict)
+        am.log_writer.flush()
+    finally:
+        am.check_conditions = check_conditions
+    elapsed = time() - start_time
+
+    latencies = sorted(item_times.values()) or [0]
+    return {'name': name,
+            'conditions': num_conditions,
+            'items': len(item_times),
+            'items_per_sec': len(item_times) / elapsed if elapsed else 0,
+            'p50': latencies[len(latencies) // 2],
+            'p99': latencies[min(len(latencies) - 1,
+                                 int(len(latencies) * 0.99))],
+            'queries_per_item': queries[0] / float(len(item_times) or 1),
+            'actions': len(reddit.performed)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('condition_sets', nargs='*', metavar='YAML_FILE',
+                        help='condition sets to benchmark')
+    parser.add_argument('--listings', metavar='DIR',
+                        help='directory of recorded listings to replay')
+    parser.add_argument('--items', type=int, default=2000,
+                        help='number of synthetic items, if not replaying')
+    parser.add_argument('--synthetic', default='10,100,500',
+                        help='sizes of the synthetic condition sets to add')
+    parser.add_argument('--memory', type=int, metavar='SUBREDDITS',
+                        help='measure the memory used by the conditions '
+                             'loaded for this many subreddits instead')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+
+    condition_sets = []
+    for path in args.condition_sets:
+        with open(path) as f:
+            condition_sets.append((path, f.read()))
+    for size in [int(s) for s in args.synthetic.split(',') if s.strip()]:
+        condition_sets.append(('synthetic-{0}'.format(size),
+                               synthetic_conditions(size, seed=size)))
+
+    if args.memory:
+        print ('{0:<30} {1:>6} {2:>7} {3:>10} {4:>10} {5:>10} {6:>10}'
+               .format('condition set', 'subs', 'conds', 'dicts KB',
+                       'slotted KB', 'dict pats', 'slot pats'))
+        for name, conditions_yaml in condition_sets:
+            result = measure_memory(name, conditions_yaml, args.memory)
+            print ('{name:<30} {subreddits:>6} {conditions:>7} '
+                   '{dicts_kb:>10.1f} {slotted_kb:>10.1f} '
+                   '{dicts_patterns:>10} {slotted_patterns:>10}'
+                   .format(**result))
+        return
+
+    reddit = ReplayReddit()
+    if args.listings:
+        listings = load_listings(reddit, args.listings)
+    else:
+        listings = synthetic_listings(reddit, args.items)
+
+    print ('{0:<30} {1:>6} {2:>7} {3:>10} {4:>10} {5:>10} {6:>9} {7:>8}'
+           .format('condition set', 'conds', 'items', 'items/sec',
+                   'p50 ms', 'p99 ms', 'queries', 'actions'))
+    for name, conditions_yaml in condition_sets:
+        result = run_benchmark(name, conditions_yaml, reddit, listings)
+        print ('{name:<30} {conditions:>6} {items:>7} {items_per_sec:>10.1f} '
+               '{p50_ms:>10.3f} {p99_ms:>10.3f} {queries_per_item:>9.2f} '
+               '{actions:>8}'.format(p50_ms=result['p50'] * 1000,
+                                     p99_ms=result['p99'] * 1000,
+                                     **result))
+
+
+if __name__ == '__main__':
+    main()
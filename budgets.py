@@ -0,0 +1,151 @@
+"""Tracks how long conditions take to check and quarantines slow ones."""
+
+from bisect import bisect_left
+from collections import deque
+import sys
+from threading import Lock
+from time import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# getrusage() can report on just the calling thread on linux, python 2's
+# resource module works with it but doesn't define the constant
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD',
+                        1 if sys.platform.startswith('linux') else None)
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02,
+                   0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, float('inf'))
+
+
+def thread_cpu_time():
+    """Returns the CPU seconds used by the calling thread so far.
+
+    Falls back to wall clock time where there's no per-thread CPU clock,
+    time.clock() can't be used since it counts all of the threads.
+    """
+    if resource and RUSAGE_THREAD is not None:
+        usage = resource.getrusage(RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    return time()
+
+
+class LatencyHistogram(object):
+
+    """Counts of observed durations in fixed, roughly logarithmic buckets."""
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket the percentile falls in."""
+        if not self.count:
+            return 0.0
+        target = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return 'n: {0}, p50: {1:.4f}s, p99: {2:.4f}s, max: {3:.4f}s'.format(
+            self.count, self.percentile(50), self.percentile(99), self.max)
+
+
+class ConditionBudget(object):
+
+    """Per-condition latency histograms and quarantine of slow conditions.
+
+    Conditions are identified by a key that stays the same when they're
+    reloaded, e.g. (subreddit name, yaml hash). A check taking longer than
+    condition_budget seconds is a strike, and a condition with strikes
+    strikes in the last window seconds is quarantined for cooldown seconds.
+    A budget of 0 disables the quarantine, the histograms are still kept.
+    """
+
+    def __init__(self, condition_budget, item_budget, strikes=3,
+                 window=3600, cooldown=3600):
+        self.condition_budget = condition_budget
+        self.item_budget = item_budget
+        self.strikes = strikes
+        self.window = window
+        self.cooldown = cooldown
+        self.histograms = {}
+        self._strikes = {}
+        self._quarantined = {}
+        self._lock = Lock()
+
+    def is_quarantined(self, key):
+        """Returns True if the condition shouldn't be checked right now."""
+        until = self._quarantined.get(key)
+        if until is None:
+            return False
+        if until > time():
+            return True
+        with self._lock:
+            self._quarantined.pop(key, None)
+        return False
+
+    def over_item_budget(self, elapsed):
+        return bool(self.item_budget) and elapsed > self.item_budget
+
+    def record(self, key, elapsed):
+        """Records a check of the condition that took elapsed seconds.
+
+        Returns True if the condition was quarantined because of it.
+        """
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.observe(elapsed)
+
+            if not self.condition_budget or elapsed <= self.condition_budget:
+                return False
+
+            now = time()
+            strikes = self._strikes.setdefault(key, deque())
+            strikes.append(now)
+            while strikes and strikes[0] < now - self.window:
+                strikes.popleft()
+            if len(strikes) < self.strikes:
+                return False
+
+            del self._strikes[key]
+            self._quarantined[key] = now + self.cooldown
+            return True
+
+    def prune(self, keys):
+        """Forgets the conditions that aren't in keys, e.g. after a reload."""
+        keys = set(keys)
+        with self._lock:
+            for table in (self.histograms, self._strikes, self._quarantined):
+                for key in set(table) - keys:
+                    del table[key]
+
+    def num_quarantined(self):
+        now = time()
+        return sum(1 for until in self._quarantined.values() if until > now)
+
+    def slowest(self, count=5):
+        """Returns the (key, histogram) pairs with the highest p99s."""
+        with self._lock:
+            items = self.histograms.items()
+        items.sort(key=lambda i: i[1].percentile(99), reverse=True)
+        return items[:count]
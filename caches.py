@@ -0,0 +1,284 @@
+"""Caches for data fetched from reddit."""
+
+from collections import OrderedDict
+import logging
+import sqlite3
+from threading import Lock
+from time import time
+
+from requests.exceptions import HTTPError
+
+
+class LRUCache(object):
+
+    """Bounded least-recently-used cache, each entry has its own TTL.
+
+    Safe to use from multiple threads, and keeps hit/miss statistics.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """Returns the cached value for key, or default if missing/expired."""
+        with self._lock:
+            try:
+                value, expires = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires < time():
+                self.misses += 1
+                return default
+
+            self._entries[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time() + ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return 'hits: {0}, misses: {1}, size: {2}'.format(
+            self.hits, self.misses, len(self._entries))
+
+
+class ShadowbanCache(object):
+
+    """Caches whether users are shadowbanned, keyed by username.
+
+    Shadowbanned results are kept for positive_ttl seconds and others for
+    negative_ttl. If path is set, results are also stored in a sqlite
+    database there so they survive restarts.
+    """
+
+    def __init__(self, max_size, positive_ttl, negative_ttl, path=None):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self._cache = LRUCache(max_size)
+        self._db = None
+        self._db_lock = Lock()
+
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS shadowbans ('
+                             'username TEXT PRIMARY KEY, '
+                             'banned INTEGER NOT NULL, '
+                             'expires REAL NOT NULL)')
+            self._db.execute('DELETE FROM shadowbans WHERE expires < ?',
+                             (time(),))
+            self._db.commit()
+
+    def get(self, username):
+        """Returns True/False if the result is cached, None otherwise."""
+        username = username.lower()
+        banned = self._cache.get(username)
+        if banned is not None or not self._db:
+            return banned
+
+        with self._db_lock:
+            row = self._db.execute('SELECT banned, expires FROM shadowbans '
+                                   'WHERE username = ? AND expires >= ?',
+                                   (username, time())).fetchone()
+        if row is None:
+            return None
+
+        banned = bool(row[0])
+        self._cache.set(username, banned, row[1] - time())
+        return banned
+
+    def set(self, username, banned):
+        username = username.lower()
+        if banned:
+            ttl = self.positive_ttl
+        else:
+            ttl = self.negative_ttl
+        self._cache.set(username, banned, ttl)
+
+        if self._db:
+            with self._db_lock:
+                self._db.execute('INSERT OR REPLACE INTO shadowbans '
+                                 'VALUES (?, ?, ?)',
+                                 (username, int(banned), time() + ttl))
+                self._db.commit()
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class SubredditRanks(object):
+
+    """A subreddit's moderators and contributors, as held by UserRankCache.
+
+    loaded - when the moderators (and contributors) were last refreshed
+    full_loaded - when the full contributor list was last downloaded
+    last_modlog - created_utc of the newest contributor mod log entry seen
+    """
+
+    __slots__ = ('moderators', 'contributors', 'loaded', 'full_loaded',
+                 'last_modlog')
+
+    def __init__(self, moderators, contributors, loaded, full_loaded,
+                 last_modlog):
+        self.moderators = moderators
+        self.contributors = contributors
+        self.loaded = loaded
+        self.full_loaded = full_loaded
+        self.last_modlog = last_modlog
+
+
+class UserRankCache(object):
+
+    """Caches subreddits' moderator and contributor lists for user ranks.
+
+    Lists older than max_age are served as-is while being refreshed in the
+    background (stale-while-revalidate), only a subreddit's very first load
+    blocks. Refreshes re-download the (short) moderator list, but only
+    apply the contributor changes from the mod log, unless the full list is
+    older than full_refresh_age or the mod log can't be read.
+
+    Whole subreddits are evicted, least recently used first, to keep the
+    total number of cached names under max_names.
+
+    praw's sessions aren't thread-safe, so if thread_session is given, the
+    background refreshes load the lists through the reddit session it
+    returns for the pool's thread, instead of the one the subreddit is from.
+    """
+
+    def __init__(self, pool, scheduler, max_names=500000, max_age=3600,
+                 full_refresh_age=86400, thread_session=None):
+        self.pool = pool
+        self.scheduler = scheduler
+        self.thread_session = thread_session
+        self.max_names = max_names
+        self.max_age = max_age
+        self.full_refresh_age = full_refresh_age
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = Lock()
+
+    def get_rank(self, subreddit, username):
+        """Returns 'moderator', 'contributor' or 'user'."""
+        sr_name = subreddit.display_name.lower()
+        with self._lock:
+            entry = self._entries.pop(sr_name, None)
+            if entry:
+                self._entries[sr_name] = entry
+
+        if not entry:
+            entry = self._load(subreddit, None)
+        elif time() - entry.loaded > self.max_age:
+            self._schedule_refresh(subreddit, sr_name)
+
+        if username in entry.moderators:
+            return 'moderator'
+        elif username in entry.contributors:
+            return 'contributor'
+        return 'user'
+
+    def _schedule_refresh(self, subreddit, sr_name):
+        with self._lock:
+            if sr_name in self._refreshing:
+                return
+            self._refreshing.add(sr_name)
+        self.pool.submit(self._refresh, subreddit, sr_name)
+
+    def _refresh(self, subreddit, sr_name):
+        try:
+            if self.thread_session:
+                subreddit = self.thread_session().get_subreddit(sr_name)
+            with self._lock:
+                entry = self._entries.get(sr_name)
+            self._load(subreddit, entry)
+        except Exception as e:
+            logging.error('ERROR: refreshing ranks for /r/{0}: {1}'
+                          .format(sr_name, e))
+        finally:
+            with self._lock:
+                self._refreshing.discard(sr_name)
+
+    def _load(self, subreddit, entry):
+        """Loads/refreshes the subreddit's lists and stores the new entry."""
+        sr_name = subreddit.display_name.lower()
+        now = time()
+
+        with self.scheduler.request_type('user'):
+            moderators = frozenset(mod.name
+                                   for mod in subreddit.get_moderators())
+
+            contributors = None
+            last_modlog = entry.last_modlog if entry else now
+            full_loaded = entry.full_loaded if entry else now
+            if entry and now - entry.full_loaded < self.full_refresh_age:
+                try:
+                    contributors, last_modlog = self._apply_modlog(
+                        subreddit, entry)
+                except HTTPError as e:
+                    logging.debug('Unable to read mod log of /r/{0}: {1}'
+                                  .format(sr_name, e))
+
+            if contributors is None:
+                contributors = self._download_contributors(subreddit)
+                full_loaded = now
+
+        entry = SubredditRanks(moderators, contributors, now, full_loaded,
+                               last_modlog)
+        with self._lock:
+            self._entries.pop(sr_name, None)
+            self._entries[sr_name] = entry
+            self._evict()
+        return entry
+
+    def _download_contributors(self, subreddit):
+        contributors = set()
+        try:
+            for contrib in subreddit.get_contributors(limit=None):
+                contributors.add(contrib.name)
+        except HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+        return frozenset(contributors)
+
+    def _apply_modlog(self, subreddit, entry):
+        """Applies contributor changes made since the entry was loaded."""
+        changes = []
+        for action in ('addcontributor', 'removecontributor'):
+            for log_entry in subreddit.get_mod_log(action=action, limit=None):
+                if log_entry.created_utc < entry.last_modlog:
+                    break
+                changes.append((log_entry.created_utc, action,
+                                log_entry.target_author))
+
+        if not changes:
+            return entry.contributors, entry.last_modlog
+
+        contributors = set(entry.contributors)
+        for _, action, name in sorted(changes):
+            if action == 'addcontributor':
+                contributors.add(name)
+            else:
+                contributors.discard(name)
+        return frozenset(contributors), max(c[0] for c in changes)
+
+    def _evict(self):
+        total = sum(len(e.moderators) + len(e.contributors)
+                    for e in self._entries.itervalues())
+        while total > self.max_names and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            total -= len(entry.moderators) + len(entry.contributors)
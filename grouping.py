@@ -0,0 +1,99 @@
+"""Groups subreddits into multireddits based on how busy they are."""
+
+from math import exp, floor, log
+from threading import Lock
+from time import time
+
+# number of items reddit returns per page of a listing
+PAGE_SIZE = 100
+
+
+class TrafficStats(object):
+
+    """Tracks how fast new items arrive in each subreddit's queues.
+
+    Rates are exponentially decaying averages over about window seconds.
+    Also counts the listing pages fetched and the items read from them that
+    didn't need checking, reported and reset by report().
+    """
+
+    def __init__(self, window=3600):
+        self.window = window
+        self.pages_fetched = 0
+        self.items_skipped = 0
+        self._counts = {}
+        self._lock = Lock()
+
+    def record_items(self, queue, counts):
+        """Adds the number of new items seen in each subreddit."""
+        now = time()
+        with self._lock:
+            for sr_name, count in counts.iteritems():
+                value, updated = self._counts.get((queue, sr_name), (0.0, now))
+                value = value * exp((updated - now) / self.window) + count
+                self._counts[(queue, sr_name)] = (value, now)
+
+    def record_fetch(self, items_read, items_checked):
+        with self._lock:
+            self.pages_fetched += items_read // PAGE_SIZE + 1
+            self.items_skipped += items_read - items_checked
+
+    def rate(self, queue, sr_name, default=0.0):
+        """Returns the items per second, or default if none seen yet."""
+        try:
+            value, updated = self._counts[(queue, sr_name)]
+        except KeyError:
+            return default
+        return value * exp((updated - time()) / self.window) / self.window
+
+    def report(self):
+        with self._lock:
+            report = 'pages fetched: {0}, items skipped: {1}'.format(
+                self.pages_fetched, self.items_skipped)
+            self.pages_fetched = 0
+            self.items_skipped = 0
+        return report
+
+
+def plan_groups(rates, poll_interval, max_url_length=3000):
+    """Splits subreddits into multireddits, returns a list of name lists.
+
+    rates - dict of subreddit name: expected new items per second
+    poll_interval - the longest time expected between polls of a group
+
+    Subreddits expected to fill more than a page of the listing between
+    polls get a multireddit of their own, since otherwise every subreddit
+    grouped with them would be paged through as deeply. The others are
+    packed into as few groups as possible (first fit, busiest first) that
+    are each expected to fit in a single page. Rates are rounded to powers
+    of two for the ordering, so groups don't change with small variations.
+    """
+    def bucket(name):
+        expected = rates[name] * poll_interval
+        if expected <= 0:
+            return float('-inf')
+        return floor(log(expected, 2))
+
+    names = sorted(rates, key=lambda n: (-bucket(n), n))
+
+    groups = []
+    packed = []
+    for name in names:
+        expected = rates[name] * poll_interval
+        if expected > PAGE_SIZE:
+            groups.append([name])
+            continue
+
+        for group in packed:
+            if (group['expected'] + expected <= PAGE_SIZE and
+                    group['length'] + len(name) + 1 <= max_url_length):
+                break
+        else:
+            group = {'names': [], 'expected': 0.0, 'length': 0}
+            packed.append(group)
+        group['names'].append(name)
+        group['expected'] += expected
+        group['length'] += len(name) + 1
+
+    groups.extend(sorted(g['names']) for g in packed)
+    return groups
@@ -0,0 +1,213 @@
+"""Extracts required literal strings from regexes and searches for them."""
+
+import sre_compile
+import sre_constants as c
+import sre_parse
+
+# limit on the number of alternatives tracked for a single part of a regex
+MAX_ALTERNATIVES = 64
+
+# characters that match each other case-insensitively in either engine the
+# matcher may use, mapped to one member of their group. sre also treats some
+# characters that lowercase differently as equal (s and long s, the greek
+# sigmas, etc.), and the regex module folds case with unicode's simple case
+# folding (e.g. the kelvin sign, and dotted and dotless i), so the groups
+# join both. Grouping more characters than an engine does only lets more
+# strings through the prefilter, never fewer.
+def _case_groups():
+    parent = {}
+
+    def find(char):
+        while parent.get(char, char) != char:
+            char = parent[char]
+        return char
+
+    def join(a, b):
+        a, b = find(a), find(b)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    for code in xrange(0x10000):
+        char = unichr(code)
+        for other in (char.lower(), char.upper(), char.upper().lower()):
+            if len(other) == 1 and other != char:
+                join(char, other)
+    for code, others in getattr(sre_compile, '_ignorecase_fixes',
+                                {}).items():
+        for other in others:
+            join(unichr(code), unichr(other))
+
+    # keyed by code point for unicode.translate
+    return dict((ord(char), find(char)) for char in parent
+                if find(char) != char)
+
+_CASE_FIXES = _case_groups()
+
+
+def fold_case(string):
+    """Returns string with its case folded for comparing characters.
+
+    Two characters match each other case-insensitively in a regex only if
+    they fold to the same character, so literals and the text they're
+    searched for in both need folding with this.
+    """
+    if isinstance(string, str):
+        # sre treats each byte as the code point with the same value
+        string = string.decode('latin-1')
+    return string.lower().translate(_CASE_FIXES)
+
+
+def required_literals(pattern, flags=0):
+    """Returns a set of strings, one of which must be in any match.
+
+    The strings are case folded, so the text being searched needs to be
+    folded with fold_case too.
+    Returns None if no such set could be determined (or it would contain
+    the empty string). Only sound for patterns compiled with IGNORECASE,
+    since the case of the literals is discarded.
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return None
+
+    _, required = _sequence(parsed)
+    if not required or '' in required:
+        return None
+    return required
+
+
+def _score(literals):
+    """Rates how selective a set of alternative literals is."""
+    if not literals:
+        return (0, 0)
+    return (min(len(l) for l in literals), -len(literals))
+
+
+def _concat(left, right):
+    if len(left) * len(right) > MAX_ALTERNATIVES:
+        return None
+    return set(l + r for l in left for r in right)
+
+
+def _sequence(subpattern):
+    """Returns (exact, required) for a sequence of regex nodes.
+
+    exact - the set of strings the sequence matches, if it's a finite set
+        of literals, otherwise None
+    required - a set of strings, one of which is in anything the sequence
+        matches, otherwise None
+    """
+    exact = set([''])
+    run = set([''])
+    candidates = []
+    for op, av in subpattern:
+        node_exact, node_required = _node(op, av)
+
+        if exact is not None and node_exact is not None:
+            exact = _concat(exact, node_exact)
+        else:
+            exact = None
+
+        if node_exact is not None:
+            run = _concat(run, node_exact)
+            if run is None:
+                # too many alternatives, start a new run from this node
+                run = set(node_exact)
+        else:
+            candidates.append(run)
+            run = set([''])
+            if node_required:
+                candidates.append(node_required)
+    candidates.append(run)
+
+    if exact is not None:
+        return exact, exact
+    return None, max(candidates, key=_score)
+
+
+def _node(op, av):
+    """Returns (exact, required) for a single regex node."""
+    if op == c.LITERAL:
+        return set([fold_case(unichr(av))]), None
+    elif op == c.SUBPATTERN:
+        # (group, subpattern), python 3 adds flags before the subpattern
+        return _sequence(av[-1])
+    elif op == c.BRANCH:
+        results = [_sequence(branch) for branch in av[1]]
+        exact = None
+        if all(e is not None for e, _ in results):
+            exact = set().union(*[e for e, _ in results])
+            if len(exact) > MAX_ALTERNATIVES:
+                exact = None
+        required = None
+        if all(r for _, r in results):
+            required = set().union(*[r for _, r in results])
+        return exact, required
+    elif op in (c.MAX_REPEAT, c.MIN_REPEAT):
+        min_repeat, max_repeat, subpattern = av
+        inner_exact, inner_required = _sequence(subpattern)
+        if min_repeat == 0:
+            return None, None
+        if min_repeat == max_repeat == 1:
+            return inner_exact, inner_required
+        return None, inner_required
+    elif op in (c.AT, c.ASSERT, c.ASSERT_NOT):
+        # zero-width, they don't add anything to the matched string
+        return set(['']), None
+    return None, None
+
+
+class LiteralSearcher(object):
+
+    """Finds which of a set of literals occur in a string (Aho-Corasick).
+
+    All the literals are found in a single pass over the string, however
+    many there are.
+    """
+
+    def __init__(self, literals):
+        self.literals = list(literals)
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [set()]
+
+        for literal_id, literal in enumerate(self.literals):
+            state = 0
+            for char in literal:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(set())
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._output[state].add(literal_id)
+
+        # breadth-first to set the failure links
+        queue = list(self._goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            for char, next_state in self._goto[state].iteritems():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                if self._fail[next_state] == next_state:
+                    self._fail[next_state] = 0
+                self._output[next_state] |= self._output[self._fail[next_state]]
+
+    def search(self, string):
+        """Returns the set of ids (positions) of the literals in string."""
+        found = set()
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        state = 0
+        for char in string:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found |= output[state]
+        return found
@@ -0,0 +1,191 @@
+"""Regex matching with a linear-time engine where the pattern allows it.
+
+If the re2 module is installed, patterns without backreferences,
+lookarounds or conditionals are searched with RE2, which can't backtrack
+catastrophically, and its match objects are returned directly. RE2 only
+differs from python's re in a few places, and those strings are left to
+the backtracking engine instead:
+
+- \\w, \\b, \\d and \\s are ascii-only in RE2, so patterns using them only
+  use RE2 for ascii strings
+- RE2 and re fold case differently for a handful of characters (dotted
+  and dotless i, long s and the kelvin sign), so case-insensitive patterns
+  need to be ascii and strings containing those use re
+- RE2's $ only matches at the very end, re's also matches before a
+  trailing newline, so strings ending in a newline use re
+
+Searches on the backtracking engine are stopped after a time budget, which
+needs the regex module (it supports timeouts).
+"""
+
+import logging
+import re
+import sre_constants as c
+import sre_parse
+from time import time
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+try:
+    import regex
+except ImportError:
+    regex = None
+
+# features that need a backtracking engine
+_BACKTRACKING_OPS = (c.GROUPREF, c.GROUPREF_EXISTS, c.ASSERT, c.ASSERT_NOT)
+# RE2's character classes are ascii-only, python's are unicode-aware
+_UNICODE_CLASSES = re.compile(r'\\[wWbBdDsS]')
+# characters RE2 and re disagree on case-insensitively
+_FOLDS_DIFFERENTLY = re.compile(u'[\u0130\u0131\u017f\u212a]')
+_NON_ASCII = re.compile(u'[^\x00-\x7f]')
+_RE2_FLAGS = ((re.IGNORECASE, 'i'), (re.DOTALL, 's'), (re.MULTILINE, 'm'))
+
+
+class MatchTimeout(Exception):
+    pass
+
+
+def supports_time_budget():
+    """Returns True if searches on the backtracking engine can be stopped."""
+    return regex is not None
+
+
+def is_linear(pattern, flags=0):
+    """Returns True if a linear-time engine can match the pattern."""
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return False
+    return not any(op in _BACKTRACKING_OPS for op, _ in _nodes(parsed))
+
+
+def _has_end_anchor(pattern, flags=0):
+    """Returns True if the pattern uses $ outside of multiline mode."""
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return True
+    # includes any inline flags
+    if parsed.pattern.flags & re.MULTILINE:
+        return False
+    return any(op == c.AT and av == c.AT_END for op, av in _nodes(parsed))
+
+
+def _nodes(subpattern):
+    """Yields all the (op, av) nodes of a parsed regex."""
+    for op, av in subpattern:
+        yield op, av
+        if op == c.SUBPATTERN:
+            for node in _nodes(av[-1]):
+                yield node
+        elif op == c.BRANCH:
+            for branch in av[1]:
+                for node in _nodes(branch):
+                    yield node
+        elif op in (c.MAX_REPEAT, c.MIN_REPEAT):
+            for node in _nodes(av[2]):
+                yield node
+
+
+def _is_ascii(string):
+    try:
+        string.encode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+class RE2Match(object):
+
+    """An RE2 match object, with expand() working the way re's does."""
+
+    def __init__(self, match, regex):
+        self._match = match
+        self.re = regex
+
+    def __getattr__(self, name):
+        return getattr(self._match, name)
+
+    def expand(self, template):
+        template = sre_parse.parse_template(template, self.re)
+        return sre_parse.expand_template(template, self._match)
+
+
+class Matcher(object):
+
+    """A compiled pattern, searched with the safest available engine.
+
+    Has the same pattern, flags and groups attributes as a compiled re
+    pattern, and search() returns match objects with re's interface.
+    """
+
+    # maximum seconds for a single search on the backtracking engine
+    time_budget = 1.0
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+        self.regex = re.compile(pattern, flags)
+        self.groups = self.regex.groups
+        self.linear = is_linear(pattern, flags)
+        self.slow_searches = 0
+
+        self._re2 = None
+        self._re2_unsafe = None
+        self._end_anchor = False
+        if (self.linear and re2 and
+                (not flags & re.IGNORECASE or _is_ascii(pattern))):
+            inline = ''.join(f for flag, f in _RE2_FLAGS if flags & flag)
+            try:
+                self._re2 = re2.compile(u'(?{0})'.format(inline) + pattern
+                                        if inline else pattern)
+            except Exception:
+                self._re2 = None
+        if self._re2:
+            if flags & re.UNICODE and _UNICODE_CLASSES.search(pattern):
+                self._re2_unsafe = _NON_ASCII
+            elif flags & re.IGNORECASE:
+                self._re2_unsafe = _FOLDS_DIFFERENTLY
+            self._end_anchor = _has_end_anchor(pattern, flags)
+
+        self._timed = None
+        if regex and (not self._re2 or self._re2_unsafe or
+                      self._end_anchor):
+            self._timed = regex.compile(pattern, flags)
+
+    @property
+    def backend(self):
+        if self._re2:
+            return 're2'
+        elif self._timed:
+            return 'regex'
+        return 're'
+
+    def _re2_agrees(self, string):
+        """Returns True if RE2 matches string the same way re would."""
+        if self._re2_unsafe and self._re2_unsafe.search(string):
+            return False
+        return not (self._end_anchor and string.endswith('\n'))
+
+    def search(self, string):
+        if self._re2 and self._re2_agrees(string):
+            match = self._re2.search(string)
+            return RE2Match(match, self.regex) if match else None
+
+        if self._timed and self.time_budget:
+            try:
+                return self._timed.search(string, timeout=self.time_budget)
+            except Exception as e:
+                raise MatchTimeout('Pattern took more than {0}s: {1}'
+                                   .format(self.time_budget, e))
+
+        start_time = time()
+        match = self.regex.search(string)
+        if self.time_budget and time() - start_time > self.time_budget:
+            self.slow_searches += 1
+            logging.warning('Slow regex search ({0:.2f}s): {1}'
+                            .format(time() - start_time, self.pattern))
+        return match
@@ -0,0 +1,186 @@
+"""Counters and histograms served over HTTP in the Prometheus text format."""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from bisect import bisect_left
+import logging
+from threading import Lock, Thread
+
+# upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+_registry = []
+
+
+def _escape(value):
+    return (unicode(value).replace('\\', r'\\').replace('\n', r'\n')
+                          .replace('"', r'\"'))
+
+
+def _format_labels(names, values, extra=''):
+    pairs = ['{0}="{1}"'.format(name, _escape(value))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+
+    """A count that only goes up, one per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+        _registry.append(self)
+
+    def inc(self, *label_values, **kwargs):
+        """Adds amount (default 1) for the given label values, in order."""
+        amount = kwargs.get('amount', 1)
+        with self._lock:
+            self._values[label_values] = (self._values.get(label_values, 0) +
+                                          amount)
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield (self.name + _format_labels(self.labels, label_values),
+                   value)
+
+
+class Histogram(object):
+
+    """Counts of observations in cumulative buckets, plus their sum."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+        self._lock = Lock()
+        _registry.append(self)
+
+    def observe(self, value, *label_values):
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # a count per bucket, followed by the sum
+                counts = self._values[label_values] = [0] * len(self.buckets)
+                counts.append(0.0)
+            counts[bucket] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.iteritems())
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="{0}"'.format(_format_value(bound))
+                yield (self.name + '_bucket' +
+                       _format_labels(self.labels, label_values, le),
+                       cumulative)
+            labels = _format_labels(self.labels, label_values)
+            yield self.name + '_sum' + labels, counts[-1]
+            yield self.name + '_count' + labels, cumulative
+
+
+def render():
+    """Returns all the metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.append('# HELP {0} {1}'.format(metric.name,
+                                             metric.documentation))
+        lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+        for name, value in metric.samples():
+            lines.append(u'{0} {1}'.format(name, _format_value(value)))
+    return u'\n'.join(lines).encode('utf-8') + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        output = render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, format, *args):
+        logging.debug('Metrics request: ' + format % args)
+
+
+def start_server(port, host='127.0.0.1'):
+    """Serves the metrics from a background thread."""
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    logging.info('Serving metrics on http://{0}:{1}/metrics'
+                 .format(host, port))
+    return server
+
+
+items_checked = Counter(
+    'automoderator_items_checked_total',
+    'Items checked against conditions.', ('queue', 'subreddit'))
+matches = Counter(
+    'automoderator_matches_total',
+    'Conditions that matched an item.', ('subreddit',))
+actions = Counter(
+    'automoderator_actions_total',
+    'Actions performed on matched items.', ('action',))
+api_requests = Counter(
+    'automoderator_requests_total',
+    'Requests made to reddit.', ('type',))
+api_errors = Counter(
+    'automoderator_request_errors_total',
+    'Requests to reddit that failed or returned an error status.', ('type',))
+listing_pages = Counter(
+    'automoderator_listing_pages_total',
+    'Pages of queue listings fetched (estimated from the items read).',
+    ('queue',))
+listing_items_skipped = Counter(
+    'automoderator_listing_items_skipped_total',
+    'Items read from queue listings that didn\'t need checking.', ('queue',))
+queue_fetch_seconds = Histogram(
+    'automoderator_queue_fetch_seconds',
+    'Time taken to fetch the new items of a queue listing.', ('queue',))
+item_check_seconds = Histogram(
+    'automoderator_item_check_seconds',
+    'Time taken to check an item against all its conditions.', ('queue',))
+db_commit_seconds = Histogram(
+    'automoderator_db_commit_seconds',
+    'Time taken to write buffered log entries and commit.')
+item_age_at_action_seconds = Histogram(
+    'automoderator_item_age_at_action_seconds',
+    'Age of items when the actions for a matched condition were done.',
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 21600,
+             86400))
@@ -0,0 +1,90 @@
+"""Run after upgrading to create any new tables and migrate existing data."""
+
+import hashlib
+from sqlalchemy import inspect, MetaData, Table
+from models import (Base, engine, Log, LOG_ACTIONS, session,
+                    StandardCondition, Subreddit, WorkerLease)
+
+
+def main():
+    Base.metadata.create_all(engine)
+    migrate_log()
+    add_missing_columns(Subreddit)
+    add_missing_columns(StandardCondition)
+    add_missing_columns(WorkerLease)
+
+
+def migrate_log(batch_size=1000):
+    """Copies entries from the old "log" table into action_log.
+
+    The old table stored the full condition YAML and could only hold one
+    action per match, entries are converted to the hashed form and the old
+    table is dropped afterwards.
+    """
+    if not engine.has_table('log'):
+        return
+    if session.query(Log.id).first() is not None:
+        print 'action_log already contains entries, not migrating log table'
+        return
+
+    old_log = Table('log', MetaData(), autoload=True, autoload_with=engine)
+
+    yaml_hashes = {}
+    copied = 0
+    last_id = 0
+    while True:
+        rows = engine.execute(old_log.select()
+                                     .where(old_log.c.id > last_id)
+                                     .order_by(old_log.c.id)
+                                     .limit(batch_size)).fetchall()
+        if not rows:
+            break
+
+        entries = []
+        for row in rows:
+            last_id = row.id
+            condition_hash = None
+            if row.condition_yaml:
+                if row.condition_yaml not in yaml_hashes:
+                    yaml_hashes[row.condition_yaml] = hashlib.sha1(
+                        row.condition_yaml.encode('utf-8')).hexdigest()
+                condition_hash = yaml_hashes[row.condition_yaml]
+            action = row.action if row.action in LOG_ACTIONS else None
+            entries.append({'item_fullname': row.item_fullname,
+                            'action': action,
+                            'condition_hash': condition_hash,
+                            'datetime': row.datetime})
+
+        session.execute(Log.__table__.insert(), entries)
+        session.commit()
+        copied += len(entries)
+
+    old_log.drop(engine)
+    if engine.dialect.name == 'postgresql':
+        engine.execute('DROP TYPE IF EXISTS log_action')
+    print 'Migrated {0} log rows'.format(copied)
+
+
+def add_missing_columns(model):
+    """Adds any of the model's columns that an existing table is missing.
+
+    Only works for columns that are nullable or have a server default.
+    """
+    table = model.__table__
+    existing = set(c['name'] for c in inspect(engine).get_columns(table.name))
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        definition = '{0} {1}'.format(column.name,
+                                      column.type.compile(engine.dialect))
+        if column.server_default is not None:
+            definition += ' DEFAULT {0}'.format(column.server_default.arg)
+        if not column.nullable:
+            definition += ' NOT NULL'
+        engine.execute('ALTER TABLE {0} ADD COLUMN {1}'
+                       .format(table.name, definition))
+        print 'Added {0} column to {1}'.format(column.name, table.name)
+
+
+if __name__ == '__main__':
+    main()
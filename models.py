@@ -1,8 +1,11 @@
+from datetime import datetime
 import sys, os
 from ConfigParser import SafeConfigParser
 
-from sqlalchemy import create_engine
-from sqlalchemy import Boolean, Column, DateTime, Enum, Integer, String, Text
+from sqlalchemy import create_engine, text
+from sqlalchemy import Boolean, Column, DateTime, Index, Integer, SmallInteger
+from sqlalchemy import String, Text
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -10,8 +13,36 @@ from sqlalchemy.ext.declarative import declarative_base
 cfg_file = SafeConfigParser()
 path_to_cfg = os.path.abspath(os.path.dirname(sys.argv[0]))
 path_to_cfg = os.path.join(path_to_cfg, 'automoderator.cfg')
+# can be overridden to run several workers from the same directory
+path_to_cfg = os.environ.get('AUTOMODERATOR_CFG', path_to_cfg)
 cfg_file.read(path_to_cfg)
 
+
+def get_option(section, option, default=None):
+    """Returns an optional config value, or default if it isn't set.
+
+    The type of the default is used to convert the value (bool/int/float).
+    """
+    if not cfg_file.has_option(section, option):
+        return default
+
+    if isinstance(default, bool):
+        return cfg_file.getboolean(section, option)
+    elif isinstance(default, int):
+        return cfg_file.getint(section, option)
+    elif isinstance(default, float):
+        return cfg_file.getfloat(section, option)
+    return cfg_file.get(section, option)
+
+
+def get_path_option(section, option, default=None):
+    """Returns an optional file path, relative to the config file's folder."""
+    path = get_option(section, option, default)
+    if not path:
+        return path
+    return os.path.join(os.path.dirname(path_to_cfg),
+                        os.path.expanduser(path))
+
 if cfg_file.get('database', 'system').lower() == 'sqlite':
     engine = create_engine(
         cfg_file.get('database', 'system')+':///'+\
@@ -38,6 +69,9 @@ class Subreddit(Base):
     last_submission - The newest unfiltered submission the bot has seen
     last_spam - The newest filtered submission the bot has seen
     last_comment - The newest comment the bot has seen
+    last_submission_id, last_spam_id, last_comment_id - Fullnames of the
+        newest items of each queue that the bot has checked, so items posted
+        in the same second as the newest one aren't missed or checked twice
     exclude_banned_modqueue - Should mirror the same setting's value on the
         subreddit. Used to determine if it's necessary to check whether
         submitters in the modqueue are shadowbanned or not.
@@ -52,36 +86,127 @@ class Subreddit(Base):
     last_submission = Column(DateTime, nullable=False)
     last_spam = Column(DateTime, nullable=False)
     last_comment = Column(DateTime, nullable=False)
+    last_submission_id = Column(String(20))
+    last_spam_id = Column(String(20))
+    last_comment_id = Column(String(20))
     exclude_banned_modqueue = Column(Boolean, nullable=False, default=False)
 
 
+class WorkerLease(Base):
+
+    """Table containing the bot processes sharing the subreddits between them.
+
+    worker_id - Unique name of the worker process
+    heartbeat - When the worker last renewed its lease, workers that haven't
+        renewed it in a while are considered dead and their subreddits are
+        reassigned
+    needs_reload - Set when the worker should reload its conditions and list
+        of subreddits, e.g. after another worker updated them from a wiki
+    username - The reddit account the worker runs as
+    moderated - Names of the subreddits the worker's account moderates, one
+        per line, only those are assigned to it
+    """
+
+    __tablename__ = 'worker_leases'
+
+    worker_id = Column(String(255), primary_key=True)
+    heartbeat = Column(DateTime, nullable=False)
+    needs_reload = Column(Boolean, nullable=False, default=False)
+    username = Column(String(255))
+    moderated = Column(Text)
+
+
+class InboxState(Base):
+
+    """Table containing how far each account's inbox has been processed.
+
+    Only used when sharded, so whichever worker takes over an account's
+    messages carries on from where the last one stopped.
+
+    username - The reddit account
+    last_message - UTC timestamp of the newest message processed
+    """
+
+    __tablename__ = 'inbox_state'
+
+    username = Column(String(255), primary_key=True)
+    last_message = Column(Integer, nullable=False)
+
+
 class StandardCondition(Base):
 
     """Table containing standard conditions that can be included by subreddits.
 
     name - A name identifying the condition (used to include that condition)
     yaml - The YAML definition of the standard condition
+    version - Incremented whenever the condition is updated through the ORM,
+        must also be incremented (or updated_at set) when editing by hand
+    updated_at - When the condition was last updated
     """
 
     __tablename__ = 'standard_conditions'
 
     name = Column(String(255), primary_key=True)
     yaml = Column(Text)
+    version = Column(Integer, nullable=False, server_default=text('1'))
+    updated_at = Column(DateTime, default=datetime.utcnow,
+                        onupdate=datetime.utcnow)
+
+    __mapper_args__ = {'version_id_col': version}
+
+
+# actions that can be logged, stored in the log table by their position
+LOG_ACTIONS = ('approve',
+               'remove',
+               'spam',
+               'report',
+               'link_flair',
+               'user_flair',
+               'comment',
+               'modmail',
+               'message')
+
+
+class LogAction(TypeDecorator):
+
+    """An action from LOG_ACTIONS, stored as a small integer."""
+
+    impl = SmallInteger
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return LOG_ACTIONS.index(value) + 1
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return LOG_ACTIONS[value - 1]
 
 
 class Log(Base):
-    """Table containing a log of the bot's actions."""
 
-    __tablename__ = 'log'
+    """Table containing a log of the bot's actions.
+
+    item_fullname - The fullname of the item the action was performed on
+    action - The action performed, one row per action
+    condition_hash - SHA-1 of the YAML of the condition that matched
+    datetime - When the action was performed
+
+    Replaces the older "log" table, which stored a single action per match
+    and the full condition YAML, see migrate.py.
+    """
+
+    __tablename__ = 'action_log'
+    __table_args__ = (Index('ix_action_log_item_action',
+                            'item_fullname', 'action'),
+                      Index('ix_action_log_item_condition',
+                            'item_fullname', 'condition_hash'),
+                      Index('ix_action_log_datetime', 'datetime'))
 
     id = Column(Integer, primary_key=True)
     item_fullname = Column(String(255), nullable=False)
-    action = Column(Enum('approve',
-                         'remove',
-                         'report',
-                         'link_flair',
-                         'user_flair',
-                         name='log_action'))
-    condition_yaml = Column(Text)
+    action = Column(LogAction)
+    condition_hash = Column(String(40))
     datetime = Column(DateTime)
 
@@ -0,0 +1,167 @@
+"""Performs the actions for matched conditions in background threads.
+
+Moderation actions (remove, spam, approve, report) go through a fast lane
+and everything else (flair, comments, modmail, messages) through a slow
+lane, so a backlog of messages can't hold up removals. Each lane has its
+own workers, each with a bounded queue. Submitting blocks while the
+queue is full, which holds up checking any more items until the lane
+catches up. All of an item's jobs go to the same worker in each lane, so
+they run in order. A match's slow job also waits for its fast job. If
+that fails, the slow job is skipped, as it would be without the pipeline.
+
+Finished jobs are collected by the main thread with completed(), which
+keeps the database session and the action index on a single thread.
+
+The steps are planned on the main thread, with its reddit session. Each
+worker passes a step's object and arguments through bind() before running
+it, which can swap them for ones using the worker's own session.
+"""
+
+import logging
+from Queue import Empty, Full, Queue
+from threading import Event, Thread
+
+FAST_ACTIONS = ('remove', 'spam', 'approve', 'report')
+
+
+class ActionJob(object):
+
+    """Some of the steps for a matched condition, run in order.
+
+    steps - (log action, request type, function, args) tuples
+    after - a job that has to finish (successfully) before this one runs
+    performed - the log actions of the steps that have been done
+    """
+
+    def __init__(self, item, yaml_hash, steps, after=None):
+        self.item = item
+        self.yaml_hash = yaml_hash
+        self.steps = steps
+        self.after = after
+        self.performed = []
+        self.error = None
+        self.done = Event()
+
+    def run(self, scheduler, bind):
+        try:
+            if self.after:
+                self.after.done.wait()
+                if self.after.error:
+                    self.error = 'skipped, {0} failed'.format(
+                        ', '.join(s[0] for s in self.after.steps))
+                    return
+
+            for log_action, req_type, func, args in self.steps:
+                func, args = _bind_step(bind, func, args)
+                with scheduler.request_type(req_type):
+                    func(*args)
+                self.performed.append(log_action)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+
+def _bind_step(bind, func, args):
+    """Returns a step's function and args, passed through bind()."""
+    owner = getattr(func, '__self__', None)
+    if owner is not None:
+        bound = bind(owner)
+        if bound is not owner:
+            func = getattr(bound, func.__name__)
+    return func, tuple(bind(arg) for arg in args)
+
+
+class Lane(object):
+
+    """Worker threads with a bounded queue each, jobs are routed by key."""
+
+    def __init__(self, name, num_workers, max_queued, scheduler, results,
+                 bind):
+        self.scheduler = scheduler
+        self.results = results
+        self.bind = bind
+        self._queues = []
+        for i in range(num_workers):
+            jobs = Queue(max(1, max_queued // num_workers))
+            self._queues.append(jobs)
+            thread = Thread(target=self._work, args=(jobs,),
+                            name='{0}-{1}'.format(name, i))
+            thread.daemon = True
+            thread.start()
+
+    def _work(self, jobs):
+        while True:
+            job = jobs.get()
+            try:
+                job.run(self.scheduler, self.bind)
+                self.results.put(job)
+            except Exception as e:
+                logging.error('ERROR: {0}'.format(e))
+            finally:
+                jobs.task_done()
+
+    def submit(self, key, job):
+        """Queues the job, blocking while the key's worker is backed up."""
+        jobs = self._queues[hash(key) % len(self._queues)]
+        # wait in short intervals so KeyboardInterrupt is still handled
+        while True:
+            try:
+                jobs.put(job, timeout=1)
+                return
+            except Full:
+                pass
+
+    def pending(self):
+        return sum(jobs.qsize() for jobs in self._queues)
+
+    def join(self):
+        # Queue.join() can't be interrupted, so this waits the same way in
+        # short intervals
+        for jobs in self._queues:
+            with jobs.all_tasks_done:
+                while jobs.unfinished_tasks:
+                    jobs.all_tasks_done.wait(1)
+
+
+class ActionPipeline(object):
+
+    def __init__(self, scheduler, fast_workers=2, slow_workers=2,
+                 max_queued=500, bind=None):
+        self._results = Queue()
+        bind = bind or (lambda obj: obj)
+        self.fast = Lane('fast', fast_workers, max_queued, scheduler,
+                         self._results, bind)
+        self.slow = Lane('slow', slow_workers, max_queued, scheduler,
+                         self._results, bind)
+
+    def submit(self, item, yaml_hash, steps):
+        """Splits a match's steps between the lanes and queues them."""
+        fast_steps = [s for s in steps if s[0] in FAST_ACTIONS]
+        slow_steps = [s for s in steps if s[0] not in FAST_ACTIONS]
+
+        fast_job = None
+        if fast_steps:
+            fast_job = ActionJob(item, yaml_hash, fast_steps)
+            self.fast.submit(item.name, fast_job)
+        if slow_steps:
+            self.slow.submit(item.name,
+                             ActionJob(item, yaml_hash, slow_steps, fast_job))
+
+    def completed(self):
+        """Returns the jobs that have finished since the last call."""
+        jobs = []
+        while True:
+            try:
+                jobs.append(self._results.get_nowait())
+            except Empty:
+                return jobs
+
+    def join(self):
+        """Waits for all the queued jobs to finish."""
+        self.fast.join()
+        self.slow.join()
+
+    def stats(self):
+        return 'fast lane: {0} queued, slow lane: {1} queued'.format(
+            self.fast.pending(), self.slow.pending())
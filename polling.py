@@ -0,0 +1,151 @@
+"""Decides when each queue listing should next be polled."""
+
+import random
+from time import time
+
+
+class PollState(object):
+
+    """What the scheduler knows about polling a single listing.
+
+    interval - seconds between polls, before jitter
+    fixed - True if the interval never changes
+    rate - moving average of new items per second
+    last_poll, last_item, next_poll - times of the last poll, the last poll
+        that found new items and when the next poll is due
+    """
+
+    __slots__ = ('interval', 'fixed', 'rate', 'last_poll', 'last_item',
+                 'next_poll')
+
+    def __init__(self, interval, fixed=False):
+        self.interval = interval
+        self.fixed = fixed
+        self.rate = None
+        self.last_poll = None
+        self.last_item = None
+        self.next_poll = 0
+
+
+class PollScheduler(object):
+
+    """Gives each listing its own poll interval, adapted to its traffic.
+
+    After a poll that found new items, the interval is set so that about
+    target_items new items will be waiting at the next poll, going by the
+    average arrival rate. After an empty poll the interval grows by backoff,
+    and to at least idle_fraction of the time since the last new item, so
+    quiet listings are polled less and less. Failed polls also back off.
+    Intervals stay between min_interval and max_interval, and are randomly
+    varied by +/- jitter (a fraction) so polls don't bunch up.
+
+    Fixed listings (e.g. reports) are always polled every interval seconds,
+    only jitter applies. clock returns the current time in seconds, it can
+    be replaced for testing.
+    """
+
+    def __init__(self, min_interval=5, max_interval=300, target_items=5,
+                 backoff=1.5, idle_fraction=0.25, jitter=0.1, smoothing=0.3,
+                 clock=time):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_items = target_items
+        self.backoff = backoff
+        self.idle_fraction = idle_fraction
+        self.jitter = jitter
+        self.smoothing = smoothing
+        self.clock = clock
+        self._states = {}
+
+    def set_targets(self, adaptive, fixed=None):
+        """Sets the listings to poll, keeping the state of existing ones.
+
+        adaptive - keys of the listings to poll on an adaptive interval
+        fixed - dict of key: interval for listings with a fixed interval
+        """
+        fixed = fixed or {}
+        states = {}
+        for key in adaptive:
+            state = self._states.get(key)
+            if not state or state.fixed:
+                state = PollState(self.min_interval)
+            states[key] = state
+        for key, interval in fixed.iteritems():
+            state = self._states.get(key)
+            if not state or not state.fixed:
+                state = PollState(interval, fixed=True)
+            state.interval = interval
+            states[key] = state
+        self._states = states
+
+    def due(self):
+        """Returns the keys of the listings that should be polled now."""
+        now = self.clock()
+        return [key for key, state in self._states.iteritems()
+                if state.next_poll <= now]
+
+    def seconds_until_due(self):
+        if not self._states:
+            return self.max_interval
+        now = self.clock()
+        return max(0, min(s.next_poll for s in self._states.itervalues()) -
+                      now)
+
+    def polled(self, key, new_items):
+        """Records that a listing was polled and how many items were new."""
+        state = self._states.get(key)
+        if not state:
+            return
+        now = self.clock()
+
+        if not state.fixed:
+            if state.last_poll:
+                rate = new_items / max(now - state.last_poll, 1e-3)
+                if state.rate is None:
+                    state.rate = rate
+                else:
+                    state.rate = (self.smoothing * rate +
+                                  (1 - self.smoothing) * state.rate)
+
+            if new_items:
+                state.last_item = now
+                if state.rate:
+                    interval = self.target_items / state.rate
+                else:
+                    interval = self.min_interval
+            else:
+                interval = state.interval * self.backoff
+                if state.last_item:
+                    interval = max(interval,
+                                   (now - state.last_item)*self.idle_fraction)
+            state.interval = self._clamp(interval)
+
+        state.last_poll = now
+        self._schedule(state, now)
+
+    def failed(self, key):
+        """Records that polling a listing failed, so it's retried later."""
+        state = self._states.get(key)
+        if not state:
+            return
+        if not state.fixed:
+            state.interval = self._clamp(state.interval * self.backoff)
+        self._schedule(state, self.clock())
+
+    def _clamp(self, interval):
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def _schedule(self, state, now):
+        jitter = random.uniform(1 - self.jitter, 1 + self.jitter)
+        state.next_poll = now + state.interval * jitter
+
+    def stats(self):
+        """Returns a summary of the listings' intervals, for logging."""
+        intervals = sorted(s.interval for s in self._states.itervalues()
+                           if not s.fixed)
+        if not intervals:
+            return 'no adaptive listings'
+        return 'listings: {0}, interval min: {1:.0f}s, median: {2:.0f}s, ' \
+               'max: {3:.0f}s'.format(len(intervals), intervals[0],
+                                      intervals[len(intervals) // 2],
+                                      intervals[-1])
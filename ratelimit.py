@@ -0,0 +1,191 @@
+"""Schedules the requests made to reddit across all threads."""
+
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import logging
+from threading import Condition, local
+from time import time
+
+from praw.handlers import DefaultHandler
+
+import metrics
+
+# priority of each type of request, lower values go first
+REQUEST_PRIORITIES = {'remove': 0,
+                      'spam': 0,
+                      'approve': 0,
+                      'report': 0,
+                      'fetch': 1,
+                      'user': 1,
+                      'flair': 2,
+                      'comment': 3,
+                      'wiki': 3,
+                      'modmail': 4,
+                      'message': 4}
+# requests of at least this priority are deferred when the budget runs low
+DEFERRABLE_PRIORITY = 4
+
+
+class RequestScheduler(object):
+
+    """Token bucket shared by all the requests made to reddit.
+
+    Tokens are added at requests_per_minute and up to burst can be saved
+    up. Every request takes a token, waiting if there are none, and a
+    request only gets a token if no more urgent request is waiting for one.
+    Low priority requests (modmail and messages) are queued by defer() while
+    fewer than reserve tokens are available and sent by run_deferred()
+    once the budget has recovered.
+
+    The type of a request is set per-thread with request_type(), anything
+    made outside of it is counted as 'fetch'. clock returns the current
+    time in seconds, it can be replaced for testing.
+    """
+
+    def __init__(self, requests_per_minute, burst=10, reserve=5, clock=time):
+        if requests_per_minute < 0:
+            raise ValueError('requests_per_minute must be 0 or more')
+        if burst < 1:
+            raise ValueError('request_burst must be at least 1')
+        if not 0 <= reserve <= burst:
+            raise ValueError('request_reserve must be between 0 and '
+                             'request_burst')
+        self.rate = requests_per_minute / 60.0
+        self.burst = burst
+        self.reserve = reserve
+        self.tokens = float(burst)
+        self.clock = clock
+        self.last_refill = clock()
+        self.counts = defaultdict(int)
+        self.deferred_counts = defaultdict(int)
+
+        self._local = local()
+        self._cond = Condition()
+        self._waiting = defaultdict(int)
+        self._deferred = deque()
+
+    @contextmanager
+    def request_type(self, req_type):
+        """Sets the type of requests made by this thread inside the block."""
+        previous = self.current_type()
+        self._local.req_type = req_type
+        try:
+            yield
+        finally:
+            self._local.req_type = previous
+
+    def current_type(self):
+        return getattr(self._local, 'req_type', 'fetch')
+
+    def _refill(self):
+        now = self.clock()
+        if self.rate <= 0:
+            self.tokens = float(self.burst)
+        else:
+            self.tokens = min(float(self.burst),
+                              self.tokens + (now - self.last_refill)*self.rate)
+        self.last_refill = now
+
+    def _more_urgent_waiting(self, priority):
+        return any(count for p, count in self._waiting.iteritems()
+                   if p < priority)
+
+    def acquire(self):
+        """Blocks until a token is available for this thread's request."""
+        req_type = self.current_type()
+        priority = REQUEST_PRIORITIES.get(req_type, 1)
+
+        with self._cond:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    self._refill()
+                    if (self.tokens >= 1 and
+                            not self._more_urgent_waiting(priority)):
+                        break
+                    if self.tokens >= 1:
+                        # woken up once the more urgent request is sent
+                        self._cond.wait(1)
+                    else:
+                        self._cond.wait((1 - self.tokens) / self.rate)
+                self.tokens -= 1
+                self.counts[req_type] += 1
+            finally:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+
+    def budget_low(self):
+        with self._cond:
+            self._refill()
+            return self.tokens < self.reserve
+
+    def defer(self, req_type, func, *args, **kwargs):
+        """Calls func(*args) now, or queues it if the budget is running low.
+
+        Returns True if the call was deferred. Calls already in the queue go
+        first, so deferred requests are still sent in order. If the call is
+        deferred, done(error) (passed as a keyword argument) is called once
+        it's been made, with the exception if it failed or None.
+        """
+        done = kwargs.pop('done', None)
+        if (REQUEST_PRIORITIES.get(req_type, 1) >= DEFERRABLE_PRIORITY and
+                (self._deferred or self.budget_low())):
+            self._deferred.append((req_type, func, args, done))
+            self.deferred_counts[req_type] += 1
+            return True
+
+        with self.request_type(req_type):
+            func(*args)
+        return False
+
+    def run_deferred(self):
+        """Sends deferred requests for as long as the budget allows."""
+        while self._deferred and not self.budget_low():
+            req_type, func, args, done = self._deferred.popleft()
+            error = None
+            try:
+                with self.request_type(req_type):
+                    func(*args)
+            except Exception as e:
+                logging.error('ERROR: deferred {0} failed: {1}'
+                              .format(req_type, e))
+                error = e
+            if done:
+                done(error)
+
+    def num_deferred(self):
+        return len(self._deferred)
+
+    def stats(self):
+        """Returns a summary of the requests made, for logging."""
+        return ', '.join('{0}: {1}'.format(req_type, self.counts[req_type])
+                         for req_type in sorted(self.counts))
+
+
+class BudgetHandler(DefaultHandler):
+
+    """praw handler that makes its requests through a RequestScheduler.
+
+    Unlike praw's own rate limiting, no lock is held for the duration of
+    the request, so requests from different threads can be in flight at
+    the same time.
+    """
+
+    def __init__(self, scheduler):
+        super(BudgetHandler, self).__init__()
+        self.scheduler = scheduler
+
+    def _send(self, request, proxies, timeout, **_):
+        req_type = self.scheduler.current_type()
+        self.scheduler.acquire()
+        metrics.api_requests.inc(req_type)
+        try:
+            response = self.http.send(request, proxies=proxies,
+                                      timeout=timeout, allow_redirects=False)
+        except Exception:
+            metrics.api_errors.inc(req_type)
+            raise
+        if response.status_code >= 400:
+            metrics.api_errors.inc(req_type)
+        return response
+BudgetHandler.request = DefaultHandler.with_cache(BudgetHandler._send)
@@ -0,0 +1,241 @@
+"""Records fetched listings to disk and replays them without reddit.
+
+The recorder is enabled by setting record_dir in the [benchmark] section
+of the config, and writes the items of each queue to <queue>.jsonl in
+that directory. The replay objects are used by benchmark.py to check the
+recorded items again offline, with every action stubbed out.
+"""
+
+from hashlib import md5
+import json
+import logging
+import os
+import random
+from threading import Lock
+from time import time
+
+import praw
+from praw.handlers import DefaultHandler
+from praw.objects import Comment, Submission, Subreddit
+
+# words used to generate synthetic items and conditions
+WORDS = ('spam', 'eggs', 'free', 'offer', 'buy', 'cheap', 'video', 'pics',
+         'question', 'help', 'meta', 'weekly', 'thread', 'discussion',
+         'giveaway', 'link', 'karma', 'upvote', 'follow', 'subscribe',
+         'promo', 'code', 'deal', 'sale', 'news', 'update', 'review', 'guide',
+         'hello', 'world', 'python', 'reddit', 'moderator', 'rules', 'banned')
+
+
+class ListingRecorder(object):
+
+    """Appends the items fetched from each queue to <queue>.jsonl.
+
+    Items are written once per queue, however many times they're fetched.
+    Needs store_json_result set in the reddit session's config, so the
+    items keep the JSON they were built from.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._seen = set()
+        self._lock = Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def record(self, queue, items):
+        lines = []
+        for item in items:
+            if (queue, item.name) in self._seen:
+                continue
+            if not getattr(item, 'json_dict', None):
+                logging.warning('Unable to record {0}, store_json_result '
+                                'is not set'.format(item.name))
+                return
+            self._seen.add((queue, item.name))
+            lines.append(json.dumps({'kind': item.name[:2],
+                                     'recorded': time(),
+                                     'data': item.json_dict}))
+
+        if lines:
+            path = os.path.join(self.directory, queue + '.jsonl')
+            with self._lock:
+                with open(path, 'a') as f:
+                    f.write('\n'.join(lines) + '\n')
+
+
+class OfflineHandler(DefaultHandler):
+
+    """Handler that fails any request, so a replay can't reach reddit."""
+
+    def request(self, request, *args, **kwargs):
+        raise RuntimeError('Request made while replaying: {0}'
+                           .format(request.url))
+
+
+class ReplayReddit(praw.Reddit):
+
+    """An offline reddit session that records messages instead of sending."""
+
+    def __init__(self):
+        super(ReplayReddit, self).__init__(user_agent='AutoModerator replay',
+                                           handler=OfflineHandler())
+        self.performed = []
+
+    def send_message(self, recipient, subject, message, *args, **kwargs):
+        self.performed.append(('message', unicode(recipient)))
+
+
+class ReplaySubreddit(Subreddit):
+
+    def set_flair(self, item, *args, **kwargs):
+        self.reddit_session.performed.append(('user_flair', unicode(item)))
+
+
+class ReplayReply(object):
+
+    def distinguish(self):
+        pass
+
+
+class _ReplayActions(object):
+
+    """Stubs out the actions that conditions can perform on an item."""
+
+    def __init__(self, reddit_session, json_dict):
+        super(_ReplayActions, self).__init__(reddit_session, json_dict)
+        object.__setattr__(self, 'subreddit', ReplaySubreddit(
+            reddit_session, json_dict['subreddit'], fetch=False))
+
+    def _perform(self, action):
+        self.reddit_session.performed.append((action, self.name))
+
+    def remove(self, spam=False):
+        self._perform('spam' if spam else 'remove')
+
+    def approve(self):
+        self._perform('approve')
+
+    def report(self, *args, **kwargs):
+        self._perform('report')
+
+    def set_flair(self, *args, **kwargs):
+        self._perform('link_flair')
+
+    def add_comment(self, text):
+        self._perform('comment')
+        return ReplayReply()
+
+    def reply(self, text):
+        self._perform('comment')
+        return ReplayReply()
+
+
+class ReplaySubmission(_ReplayActions, Submission):
+    pass
+
+
+class ReplayComment(_ReplayActions, Comment):
+
+    def __init__(self, reddit_session, json_dict):
+        json_dict.setdefault('replies', '')
+        super(ReplayComment, self).__init__(reddit_session, json_dict)
+
+
+def load_listings(reddit_session, directory, shift_to_now=True):
+    """Loads the recorded items, returns a dict of item lists per queue.
+
+    If shift_to_now is set, the items' times are moved forwards so the
+    newest one was just posted, keeping their relative ages.
+    """
+    records = {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.jsonl'):
+            continue
+        queue = filename[:-len('.jsonl')]
+        with open(os.path.join(directory, filename)) as f:
+            records[queue] = [json.loads(line) for line in f if line.strip()]
+
+    offset = 0
+    if shift_to_now:
+        newest = max([rec['data']['created_utc']
+                      for recs in records.values() for rec in recs] or [0])
+        offset = time() - newest
+
+    listings = {}
+    for queue, recs in records.iteritems():
+        listings[queue] = []
+        for rec in recs:
+            data = rec['data']
+            data['created_utc'] += offset
+            if rec['kind'] == 't3':
+                listings[queue].append(ReplaySubmission(reddit_session, data))
+            elif rec['kind'] == 't1':
+                listings[queue].append(ReplayComment(reddit_session, data))
+        # listings are newest first
+        listings[queue].sort(key=lambda i: i.created_utc, reverse=True)
+    return listings
+
+
+def synthetic_listings(reddit_session, count, subreddits=('benchmark',),
+                       seed=0):
+    """Generates random submissions and comments, half of each."""
+    rand = random.Random(seed)
+    now = time()
+
+    def word():
+        # mostly filler, so only some items match the synthetic conditions
+        if rand.random() < 0.02:
+            return rand.choice(WORDS)
+        return 'word{0}'.format(rand.randint(1, 5000))
+
+    def text(min_words, max_words):
+        return ' '.join(word()
+                        for _ in range(rand.randint(min_words, max_words)))
+
+    listings = {'submission': [], 'comment': []}
+    for i in range(count):
+        data = {'id': '{0:x}'.format(i + 1),
+                'subreddit': rand.choice(subreddits),
+                'author': 'user{0}'.format(rand.randint(1, count // 4 + 1)),
+                'created_utc': now - (count - i),
+                'num_reports': 0,
+                'approved_by': None,
+                'banned_by': None,
+                'author_flair_text': None,
+                'author_flair_css_class': None}
+        if i % 2 == 0:
+            is_self = rand.random() < 0.5
+            data.update({'name': 't3_' + data['id'],
+                         'title': text(3, 12),
+                         'selftext': text(0, 80) if is_self else '',
+                         'is_self': is_self,
+                         'domain': ('self.' + data['subreddit'] if is_self
+                                    else rand.choice(WORDS) + '.com'),
+                         'url': 'http://example.com/' + text(1, 3),
+                         'permalink': '/r/{0}/comments/{1}/'
+                                      .format(data['subreddit'], data['id']),
+                         'link_flair_text': None,
+                         'link_flair_css_class': None,
+                         'media': None})
+            listings['submission'].append(
+                ReplaySubmission(reddit_session, data))
+        else:
+            data.update({'name': 't1_' + data['id'],
+                         'body': text(1, 120),
+                         'link_id': 't3_1',
+                         'parent_id': 't3_1',
+                         'link_title': text(3, 12)})
+            listings['comment'].append(ReplayComment(reddit_session, data))
+
+    for items in listings.values():
+        items.reverse()
+    return listings
+
+
+def synthetic_profile(username):
+    """Returns made up (but always the same) karma/age/gold for a user."""
+    value = int(md5(username.encode('utf-8')).hexdigest()[:8], 16)
+    return {'link_karma': value % 5000,
+            'comment_karma': (value // 5000) % 20000,
+            'created_utc': time() - (value % 1000) * 86400,
+            'is_gold': value % 10 == 0}
@@ -0,0 +1,231 @@
+"""Shares the subreddits between several bot processes.
+
+Each worker holds a lease in the worker_leases table, renewed by a
+heartbeat, which also lists the subreddits its account moderates.
+Subreddits are assigned to the live workers by consistent hashing on their
+names, skipping workers whose accounts don't moderate them, so workers can
+run as different accounts. When a worker joins, leaves or its lease
+expires, only the subreddits hashed to it move. For each account, the live
+worker with the lowest id is the leader, and is the only one to process
+that account's messages. How far the inbox has been read is kept in the
+database, so a new leader carries on from there.
+
+Checking a busy shard can take longer than the lease, so the lease is also
+renewed from a background thread, with its own database session. If it
+still runs out, the worker stops owning any subreddits until its next
+heartbeat, since the others may have taken them over.
+"""
+
+from bisect import bisect
+from datetime import datetime, timedelta
+from hashlib import md5
+import logging
+import os
+import socket
+from threading import Event, Thread
+from time import time
+
+from models import InboxState, session, Session, WorkerLease
+
+
+def _hash(key):
+    return int(md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+
+    """Consistent hash ring with a number of virtual points per node."""
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = sorted(nodes)
+        self._points = sorted((_hash(u'{0}#{1}'.format(node, i)), node)
+                              for node in self.nodes
+                              for i in range(replicas))
+        self._hashes = [point[0] for point in self._points]
+
+    def get(self, key, eligible=None):
+        """Returns the node that the key is assigned to.
+
+        If eligible is given, only those nodes are considered, the key goes
+        to the next one of them along the ring.
+        """
+        if not self._points:
+            return None
+        index = bisect(self._hashes, _hash(key))
+        for offset in range(len(self._points)):
+            node = self._points[(index + offset) % len(self._points)][1]
+            if eligible is None or node in eligible:
+                return node
+        return None
+
+
+class ShardCoordinator(object):
+
+    """Keeps this worker's lease alive and decides which subreddits it owns.
+
+    heartbeat() should be called more often than every lease_seconds, it
+    returns True if the set of live workers or the subreddits they moderate
+    changed (or this worker was asked to reload), in which case the
+    subreddits should be reloaded. start() also renews the lease in the
+    background in case heartbeat() is held up.
+    """
+
+    def __init__(self, worker_id=None, lease_seconds=60, replicas=100,
+                 username=None):
+        self.worker_id = (worker_id or
+                          '{0}-{1}'.format(socket.gethostname(), os.getpid()))
+        self.lease_seconds = lease_seconds
+        self.replicas = replicas
+        self.username = username
+        self.workers = []
+        self.usernames = {}
+        self.moderated = {}
+        self.ring = HashRing([])
+        self.lease_lost = False
+        self._renewed = None
+        self._stopped = Event()
+
+    def start(self):
+        """Starts renewing the lease from a background thread."""
+        thread = Thread(target=self._keep_renewing, name='lease')
+        thread.daemon = True
+        thread.start()
+
+    def _keep_renewing(self):
+        db_session = Session()
+        while not self._stopped.wait(self.lease_seconds / 3.0):
+            try:
+                self.renew(db_session)
+            except Exception as e:
+                db_session.rollback()
+                logging.error('Renewing the lease failed: {0}'.format(e))
+        db_session.close()
+
+    def renew(self, db_session=session):
+        """Extends the lease, if it hasn't already run out."""
+        renewed_at = time()
+        renewed = (db_session.query(WorkerLease)
+                             .filter(WorkerLease.worker_id == self.worker_id)
+                             .update({WorkerLease.heartbeat:
+                                      datetime.utcnow()},
+                                     synchronize_session=False))
+        db_session.commit()
+        if renewed:
+            self._renewed = renewed_at
+        else:
+            # expired and removed by another worker
+            self.lease_lost = True
+
+    def has_lease(self):
+        """Returns True if the lease can't have run out."""
+        return (not self.lease_lost and self._renewed is not None and
+                time() - self._renewed < self.lease_seconds)
+
+    def heartbeat(self):
+        renewed_at = time()
+        now = datetime.utcnow()
+        cutoff = now - timedelta(seconds=self.lease_seconds)
+
+        lease = self._lease()
+        lease.heartbeat = now
+        # a lease that ran out has to be taken again, and the subreddits
+        # reloaded, since the other workers will have taken them over
+        reload_requested = bool(lease.needs_reload) or self.lease_lost
+        lease.needs_reload = False
+        session.flush()
+
+        expired = (session.query(WorkerLease)
+                          .filter(WorkerLease.heartbeat < cutoff)
+                          .delete())
+        session.commit()
+        if self.lease_lost:
+            logging.warning('Lease of {0} ran out, taking it again'
+                            .format(self.worker_id))
+        self.lease_lost = False
+        self._renewed = renewed_at
+        if expired:
+            logging.info('Removed {0} expired worker leases'.format(expired))
+
+        usernames = {}
+        moderated = {}
+        for worker_id, username, names in session.query(
+                WorkerLease.worker_id, WorkerLease.username,
+                WorkerLease.moderated):
+            usernames[worker_id] = username
+            moderated[worker_id] = frozenset((names or '').split())
+
+        workers = sorted(usernames)
+        changed = workers != self.workers or moderated != self.moderated
+        if workers != self.workers:
+            logging.info('Live workers: {0}'.format(', '.join(workers)))
+            self.ring = HashRing(workers, self.replicas)
+        self.workers = workers
+        self.usernames = usernames
+        self.moderated = moderated
+        return changed or reload_requested
+
+    def _lease(self):
+        lease = session.query(WorkerLease).get(self.worker_id)
+        if not lease:
+            lease = WorkerLease(worker_id=self.worker_id,
+                                heartbeat=datetime.utcnow(),
+                                moderated='\n'.join(sorted(
+                                    self.moderated.get(self.worker_id, ()))))
+            session.add(lease)
+        lease.username = self.username
+        return lease
+
+    def set_moderated(self, sr_names):
+        """Publishes the subreddits this worker's account moderates."""
+        names = frozenset(name.lower() for name in sr_names)
+        self.moderated[self.worker_id] = names
+        self._lease().moderated = '\n'.join(sorted(names))
+        session.commit()
+
+    def owns(self, sr_name):
+        """Returns True if this worker should check the subreddit.
+
+        Nothing is owned while the lease may have run out, so this should
+        be checked again before acting on a subreddit's items.
+        """
+        if not self.has_lease():
+            return False
+        sr_name = sr_name.lower()
+        eligible = set(worker for worker, names in self.moderated.iteritems()
+                       if sr_name in names)
+        return self.ring.get(sr_name, eligible) == self.worker_id
+
+    def is_leader(self):
+        """Returns True if this worker handles its account's messages."""
+        same_account = [worker for worker in self.workers
+                        if self.usernames.get(worker) == self.username]
+        return bool(same_account) and same_account[0] == self.worker_id
+
+    def get_last_message(self, default):
+        """Returns the timestamp of the newest message processed."""
+        state = session.query(InboxState).get(self.username)
+        return state.last_message if state else default
+
+    def set_last_message(self, last_message):
+        state = session.query(InboxState).get(self.username)
+        if not state:
+            state = InboxState(username=self.username)
+            session.add(state)
+        state.last_message = last_message
+        session.commit()
+
+    def request_reload(self):
+        """Asks all the other workers to reload their subreddits."""
+        (session.query(WorkerLease)
+                .filter(WorkerLease.worker_id != self.worker_id)
+                .update({WorkerLease.needs_reload: True},
+                        synchronize_session=False))
+        session.commit()
+
+    def release(self):
+        """Gives up the lease, so the other workers take over right away."""
+        self._stopped.set()
+        (session.query(WorkerLease)
+                .filter(WorkerLease.worker_id == self.worker_id)
+                .delete())
+        session.commit()
@@ -0,0 +1,237 @@
+"""Checks the in-memory caches of users' ranks, subreddits' parsed
+conditions and the actions already performed.
+
+Run with: python -m unittest test_caches
+"""
+
+from datetime import datetime, timedelta
+import os
+import sqlite3
+import threading
+from time import time
+import unittest
+
+import testing
+import automoderator as am
+from caches import UserRankCache
+from models import Base, engine, Log, session
+from ratelimit import RequestScheduler
+from workers import WorkerPool
+
+
+class FakeUser(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeSubreddit(object):
+
+    """Records the session and thread each request was made through."""
+
+    def __init__(self, display_name, session, requests):
+        self.display_name = display_name
+        self.session = session
+        self.requests = requests
+
+    def _request(self, users):
+        self.requests.append((self.session, threading.current_thread().name))
+        return [FakeUser(name) for name in users]
+
+    def get_moderators(self):
+        return self._request(['mod'])
+
+    def get_contributors(self, limit=None):
+        return self._request(['contributor'])
+
+    def get_mod_log(self, action=None, limit=None):
+        return self._request([])
+
+
+class UserRankCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.pool = WorkerPool(1, 'ranks')
+
+        def thread_session():
+            return self
+
+        self.cache = UserRankCache(self.pool, RequestScheduler(0, 10, 0),
+                                   max_age=0, thread_session=thread_session)
+
+    def get_subreddit(self, sr_name):
+        return FakeSubreddit(sr_name, 'thread', self.requests)
+
+    def test_refresh_uses_thread_session(self):
+        subreddit = FakeSubreddit('Test', 'main', self.requests)
+        self.assertEqual(self.cache.get_rank(subreddit, 'mod'), 'moderator')
+        self.assertEqual(set(self.requests),
+                         set([('main', threading.current_thread().name)]))
+
+        del self.requests[:]
+        # served from the cache while it's refreshed in the background
+        self.assertEqual(self.cache.get_rank(subreddit, 'contributor'),
+                         'contributor')
+        # the pool runs its jobs in order, so the refresh is done after this
+        self.pool.submit(lambda: None).result()
+        self.assertTrue(self.requests)
+        self.assertEqual(set(self.requests), set([('thread', 'ranks-0')]))
+
+
+CONDITIONS = (u'title: [spam, "\u00fcn\u00efcode"]\n'
+              u'action: remove\n'
+              u'---\n'
+              u'body: (eggs|ham)\n'
+              u'comment: "matched {{match}}"\n')
+
+
+class ConditionSetCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(testing.TEMP_DIR, 'conditions.sqlite')
+        self.parsed = 0
+        self._parse_conditions = am.parse_conditions
+
+        def parse_conditions(conditions_yaml):
+            self.parsed += 1
+            return self._parse_conditions(conditions_yaml)
+        am.parse_conditions = parse_conditions
+
+    def tearDown(self):
+        am.parse_conditions = self._parse_conditions
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_same_yaml_is_shared(self):
+        cache = am.ConditionSetCache()
+        first = cache.get('a', CONDITIONS)
+        self.assertIs(cache.get('b', CONDITIONS), first)
+        self.assertEqual((cache.hits, cache.misses, self.parsed), (1, 1, 1))
+
+        # dropped once unused
+        cache.prune()
+        cache.prune()
+        self.assertIsNot(cache.get('a', CONDITIONS), first)
+
+    def test_definitions_survive_a_restart(self):
+        am.ConditionSetCache(self.path).get('a', CONDITIONS)
+        self.assertEqual(self.parsed, 1)
+
+        cache = am.ConditionSetCache(self.path)
+        definitions = cache._get_definitions(cache._key(CONDITIONS),
+                                             CONDITIONS)
+        self.assertEqual(self.parsed, 1)
+        # exactly the same values, including their types, and hashes
+        expected = self._parse_conditions(CONDITIONS)
+        self.assertEqual(definitions, expected)
+        self.assertEqual([[type(v) for v in values.itervalues()]
+                          for values, _ in definitions],
+                         [[type(v) for v in values.itervalues()]
+                          for values, _ in expected])
+        self.assertEqual([c.yaml_hash for c in cache.get('a', CONDITIONS)],
+                         [yaml_hash for _, yaml_hash in expected])
+
+    def test_old_entries_are_dropped(self):
+        am.ConditionSetCache(self.path).get('a', CONDITIONS)
+        db = sqlite3.connect(self.path)
+        db.execute('UPDATE condition_sets SET stored = ?', (time() - 120,))
+        db.commit()
+
+        am.ConditionSetCache(self.path, max_age=60).get('a', CONDITIONS)
+        self.assertEqual(self.parsed, 2)
+
+    def test_unreadable_entries_are_parsed_again(self):
+        am.ConditionSetCache(self.path).get('a', CONDITIONS)
+        db = sqlite3.connect(self.path)
+        db.execute('UPDATE condition_sets SET definitions = ?',
+                   (sqlite3.Binary('\x80 not marshalled'),))
+        db.commit()
+
+        conditions = am.ConditionSetCache(self.path).get('a', CONDITIONS)
+        self.assertEqual(self.parsed, 2)
+        self.assertEqual(len(conditions), 2)
+
+    def test_unstorable_values_are_not_stored(self):
+        # yaml loads dates, which marshal can't store
+        conditions_yaml = u'title: [spam]\nreports: 2014-01-01\n'
+        am.ConditionSetCache(self.path).get('a', conditions_yaml)
+        am.ConditionSetCache(self.path).get('a', conditions_yaml)
+        self.assertEqual(self.parsed, 2)
+
+
+class FakeItem(object):
+
+    def __init__(self, name, created):
+        self.name = name
+        self.created_utc = (created - datetime(1970, 1, 1)).total_seconds()
+
+
+class ActionIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+        self.now = datetime.utcnow()
+        self.index = am.ActionIndex(timedelta(days=1), 3)
+
+    def perform(self, name, minutes_ago):
+        """Logs and indexes a removal of an item made just before."""
+        logged = self.now - timedelta(minutes=minutes_ago)
+        session.add(Log(item_fullname=name, action='remove',
+                        condition_hash='hash', datetime=logged))
+        session.commit()
+        self.index.add_action(name, 'remove', logged)
+        return FakeItem(name, logged - timedelta(seconds=1))
+
+    def forget(self, item):
+        session.query(Log).filter(Log.item_fullname == item.name).delete()
+        session.commit()
+
+    def test_new_items_are_answered_from_memory(self):
+        item = self.perform('t3_a', 5)
+        self.assertTrue(self.index.covers(item))
+        self.forget(item)
+        self.assertTrue(self.index.has_action(item, 'remove'))
+        self.assertFalse(self.index.has_action(item, 'spam'))
+
+    def test_evicted_items_fall_back_to_the_database(self):
+        items = [self.perform('t3_{0}'.format(i), 50 - i) for i in range(5)]
+        self.assertEqual(len(self.index._entries), 3)
+
+        # the two oldest were evicted, so the index can't answer for them
+        for item in items[:2]:
+            self.assertFalse(self.index.covers(item))
+            self.assertTrue(self.index.has_action(item, 'remove'))
+        for item in items[2:]:
+            self.assertTrue(self.index.covers(item))
+            self.assertTrue(self.index.has_action(item, 'remove'))
+
+        # it really is the database answering
+        self.forget(items[0])
+        self.assertFalse(self.index.has_action(items[0], 'remove'))
+
+        # anything newer than the evicted entries is still covered
+        newer = FakeItem('t3_new', self.now - timedelta(minutes=40))
+        self.assertTrue(self.index.covers(newer))
+        self.assertFalse(self.index.has_action(newer, 'remove'))
+
+    def test_old_entries_expire(self):
+        item = self.perform('t3_old', 25 * 60)
+        self.assertEqual(len(self.index._entries), 0)
+        self.assertFalse(self.index.covers(item))
+        self.assertTrue(self.index.has_action(item, 'remove'))
+
+    def test_load_keeps_the_bound(self):
+        items = [self.perform('t3_{0}'.format(i), 50 - i) for i in range(5)]
+        self.index.load()
+        # each row has an action and a condition entry, so only the newest
+        # item's are all still there
+        self.assertEqual(len(self.index._entries), 3)
+        self.assertFalse(self.index.covers(items[3]))
+        self.assertTrue(self.index.has_action(items[3], 'remove'))
+        self.assertTrue(self.index.covers(items[4]))
+
+
+if __name__ == '__main__':
+    unittest.main()
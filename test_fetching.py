@@ -0,0 +1,283 @@
+"""Fetches listings in parallel from a local fake reddit server.
+
+Run with: python -m unittest test_fetching
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime, timedelta
+import json
+import threading
+import time
+import unittest
+
+import testing
+import praw
+
+import automoderator as am
+from caches import LRUCache
+from pipeline import ActionPipeline
+from ratelimit import BudgetHandler
+from models import Subreddit
+from workers import WorkerPool
+
+
+def submission(sr_name, number):
+    return {'kind': 't3',
+            'data': {'id': 'a{0}'.format(number),
+                     'name': 't3_a{0}'.format(number),
+                     'title': 'post {0}'.format(number),
+                     'permalink': '/r/{0}/comments/a{1}/'.format(sr_name,
+                                                                 number),
+                     'subreddit': sr_name,
+                     'author': 'user{0}'.format(number),
+                     'created_utc': time.time() - number,
+                     'approved_by': None,
+                     'banned_by': None}}
+
+
+class FakeReddit(BaseHTTPRequestHandler):
+
+    """Serves subreddit listings and user profiles, recording the requests."""
+
+    requests = []
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            self.requests.append((self.path, self.headers.get('Cookie', '')))
+        path = self.path.split('?')[0].strip('/').split('/')
+        if path[0] == 'r':
+            body = {'kind': 'Listing',
+                    'data': {'after': None, 'before': None,
+                             'children': [submission(sr_name, i)
+                                          for i, sr_name in enumerate(
+                                              path[1].split('+') * 2)]}}
+        elif path[0] == 'user':
+            body = {'kind': 't2',
+                    'data': {'name': path[1], 'link_karma': 5,
+                             'comment_karma': 7, 'created_utc': 0}}
+        else:
+            self.send_error(404)
+            return
+        content = json.dumps(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FakeReddit)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        FakeReddit.requests = []
+
+        am.r = praw.Reddit('AutoModerator tests', disable_update_check=True,
+                           handler=BudgetHandler(am.request_scheduler),
+                           domain='127.0.0.1:{0}'.format(
+                               self.server.server_port))
+        # as if logged in, the fetch threads' sessions should copy it
+        am.r.http.cookies.set('reddit_session', 'secret')
+        am.r.modhash = 'modhash'
+        am.r._authentication = True
+        am.user_profile_cache = LRUCache(100)
+        am.fetch_pool = WorkerPool(3, 'fetch')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        am.fetch_pool = None
+
+    def test_listings_use_thread_sessions(self):
+        since = datetime.utcnow() - timedelta(hours=1)
+        targets = [('submission', ('a', 'b')), ('submission', ('c',)),
+                   ('submission', ('d', 'e'))]
+        jobs = [am.fetch_pool.submit(am.fetch_listing, queue, multi,
+                                     'get_new',
+                                     dict((name, (since, None))
+                                          for name in multi))
+                for queue, multi in targets]
+        results = [job.result() for job in jobs]
+
+        for (_, multi), items in zip(targets, results):
+            self.assertEqual(len(items), 2 * len(multi))
+            for item in items:
+                # handed back to the global session for checking
+                self.assertIs(item.reddit_session, am.r)
+                self.assertIs(item.author.reddit_session, am.r)
+                self.assertIs(item.subreddit.reddit_session, am.r)
+                self.assertIn(item.subreddit.display_name, multi)
+
+        self.assertEqual(len(FakeReddit.requests), len(targets))
+        for _, cookie in FakeReddit.requests:
+            self.assertIn('reddit_session=secret', cookie)
+
+    def test_each_thread_has_its_own_session(self):
+        # the jobs wait for each other, so every thread gets one
+        started = []
+        all_started = threading.Event()
+
+        def session_of_thread():
+            started.append(True)
+            if len(started) == 3:
+                all_started.set()
+            all_started.wait(5)
+            return am.thread_session()
+
+        sessions = [job.result() for job in
+                    [am.fetch_pool.submit(session_of_thread)
+                     for _ in range(3)]]
+        self.assertEqual(len(set(id(s) for s in sessions)), 3)
+        self.assertTrue(all(s is not am.r for s in sessions))
+        self.assertTrue(all(s.is_logged_in() for s in sessions))
+
+    def test_actions_use_thread_sessions(self):
+        item = list(am.r.get_subreddit('a').get_new(limit=None))[0]
+        seen = []
+
+        def record(item, reddit):
+            seen.append((item.reddit_session, reddit))
+
+        pipeline = ActionPipeline(am.request_scheduler, 1, 1, 10,
+                                  am.bind_to_thread)
+        pipeline.submit(item, 'hash',
+                        [('remove', 'remove', record, (item, am.r)),
+                         ('comment', 'comment', record, (item, am.r))])
+        pipeline.join()
+        self.assertEqual([job.error for job in pipeline.completed()],
+                         [None, None])
+
+        # each lane thread acted on its own session, not the main thread's
+        self.assertEqual(len(seen), 2)
+        for item_session, reddit in seen:
+            self.assertIs(item_session, reddit)
+            self.assertIsNot(reddit, am.r)
+        self.assertIsNot(seen[0][1], seen[1][1])
+        self.assertIs(item.reddit_session, am.r)
+
+    def test_binding_does_not_fetch(self):
+        subreddit = am.r.get_subreddit('a')
+        bound = am.fetch_pool.submit(am.bind_to_thread, subreddit).result()
+        self.assertIsNot(bound.reddit_session, am.r)
+        self.assertEqual(bound.display_name, 'a')
+        self.assertEqual(FakeReddit.requests, [])
+
+    def test_user_profiles(self):
+        profile = am.fetch_pool.submit(am.fetch_user_profile,
+                                       'someone').result()
+        self.assertEqual(profile['link_karma'], 5)
+        self.assertEqual(profile['comment_karma'], 7)
+        self.assertEqual(am.user_profile_cache.get('someone'), profile)
+        self.assertEqual(FakeReddit.requests[0][0].split('?')[0],
+                         '/user/someone/about/.json')
+
+
+class CheckpointTest(unittest.TestCase):
+
+    """Which items are checked, and how the checkpoints move afterwards."""
+
+    NOW = 1400000000
+
+    def setUp(self):
+        self.reddit = praw.Reddit('AutoModerator tests',
+                                  disable_update_check=True)
+        am.log_writer = am.LogWriter('sync', 100, 10)
+        self.sr_dict = {}
+        self.cond_dict = {}
+
+    def item(self, sr_name, item_id, age, approved_by=None):
+        return praw.objects.Submission.from_api_response(self.reddit, {
+            'id': item_id, 'name': 't3_' + item_id, 'title': 'post',
+            'permalink': '/r/{0}/comments/{1}/'.format(sr_name, item_id),
+            'subreddit': sr_name, 'author': 'someone',
+            'created_utc': self.NOW - age, 'approved_by': approved_by,
+            'banned_by': None})
+
+    def time(self, age):
+        return datetime.utcfromtimestamp(self.NOW - age)
+
+    def subreddit(self, name, age, last_id=None):
+        sr = Subreddit(name=name)
+        for queue in ('submission', 'spam', 'comment'):
+            setattr(sr, 'last_' + queue, self.time(age))
+            setattr(sr, 'last_' + queue + '_id', last_id)
+        self.sr_dict[name] = sr
+        self.cond_dict[name] = am.load_conditions(name, '', ['submission',
+                                                             'report'])
+        return sr
+
+    def checkpoints(self, queue='submission'):
+        return dict((name, (getattr(sr, 'last_' + queue),
+                            getattr(sr, 'last_' + queue + '_id')))
+                    for name, sr in self.sr_dict.items())
+
+    def new_names(self, items, queue='submission'):
+        return [item.name for item in
+                am.new_items(queue, items, self.checkpoints(queue))]
+
+    def test_equal_timestamps_use_the_ids(self):
+        self.subreddit('a', 10, 't3_a5')
+        items = [self.item('a', 'a6', 10), self.item('a', 'a5', 10),
+                 self.item('a', 'a4', 10)]
+        self.assertEqual(self.new_names(items), ['t3_a6'])
+
+    def test_equal_timestamps_without_an_id_are_checked(self):
+        self.subreddit('a', 10)
+        items = [self.item('a', 'a6', 10), self.item('a', 'a5', 11)]
+        self.assertEqual(self.new_names(items), ['t3_a6'])
+
+    def test_reading_stops_at_the_oldest_checkpoint(self):
+        self.subreddit('a', 10, 't3_a5')
+        self.subreddit('b', 20, 't3_a1')
+        items = [self.item('a', 'a7', 5), self.item('b', 'a6', 6),
+                 self.item('a', 'a4', 15), self.item('b', 'a3', 16),
+                 self.item('b', 'a2', 25)]
+        # a4 is before its own subreddit's checkpoint, a2 before b's
+        self.assertEqual(self.new_names(items), ['t3_a7', 't3_a6', 't3_a3'])
+
+    def test_checkpoints_move_to_the_newest_item(self):
+        a = self.subreddit('a', 10, 't3_a1')
+        b = self.subreddit('b', 20, 't3_a0')
+        items = [self.item('a', 'a3', 2), self.item('a', 'a2', 5)]
+        am.check_items('submission', items, self.checkpoints(),
+                       self.sr_dict, self.cond_dict)
+
+        self.assertEqual((a.last_submission, a.last_submission_id),
+                         (self.time(2), 't3_a3'))
+        # the quiet subreddit's time is raised too, but not its fullname
+        self.assertEqual((b.last_submission, b.last_submission_id),
+                         (self.time(2), 't3_a0'))
+
+    def test_approved_items_dont_move_checkpoints(self):
+        a = self.subreddit('a', 10, 't3_a5')
+        # approved a while after being posted, so it's out of order
+        items = [self.item('a', 'a1', 30, approved_by='mod'),
+                 self.item('a', 'a6', 5)]
+        self.assertEqual(self.new_names(items), ['t3_a1', 't3_a6'])
+
+        am.check_items('submission', items, self.checkpoints(),
+                       self.sr_dict, self.cond_dict)
+        self.assertEqual((a.last_submission, a.last_submission_id),
+                         (self.time(5), 't3_a6'))
+
+    def test_reports_dont_touch_checkpoints(self):
+        a = self.subreddit('a', 10, 't3_a5')
+        items = [self.item('a', 'a7', 2), self.item('a', 'a6', 5)]
+        am.check_items('report', items, self.checkpoints(),
+                       self.sr_dict, self.cond_dict)
+        for queue in ('submission', 'spam', 'comment'):
+            self.assertEqual((getattr(a, 'last_' + queue),
+                              getattr(a, 'last_' + queue + '_id')),
+                             (self.time(10), 't3_a5'))
+        self.assertFalse(hasattr(a, 'last_report'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Checks the literal prefilter against plain regex evaluation.
+
+Run with: python -m unittest test_literals
+"""
+
+import random
+import re
+import sre_compile
+import unittest
+
+import literals
+from literals import LiteralSearcher, fold_case, required_literals
+
+try:
+    import regex
+except ImportError:
+    regex = None
+
+FLAGS = re.IGNORECASE | re.UNICODE
+
+# letters that fold in unusual ways alongside plain ascii ones
+ALPHABET = (u'aeiksxyz ' u'AEIKSXYZ' u'ſıİK'
+            u'σςΣµμθϑṡẛ')
+
+
+def could_match(pattern, text):
+    """Whether the prefilter lets text through for pattern."""
+    literals = required_literals(pattern, FLAGS)
+    if literals is None:
+        return True
+    return bool(LiteralSearcher(literals).search(fold_case(text)))
+
+
+def random_word(rng, max_length):
+    return u''.join(rng.choice(ALPHABET)
+                    for _ in range(rng.randint(1, max_length)))
+
+
+def random_pattern(rng):
+    words = [re.escape(random_word(rng, 4))
+             for _ in range(rng.randint(1, 3))]
+    template = rng.choice([u'{0}', u'({0})', u'\\b({0})\\b', u'{0}s?',
+                           u'(x|{0})+', u'^.*({0})'])
+    return template.format(u'|'.join(words))
+
+
+class LiteralPrefilterTest(unittest.TestCase):
+
+    def assertConsistent(self, pattern, text):
+        engines = [re] + ([regex] if regex else [])
+        for engine in engines:
+            if engine.search(pattern, text, FLAGS):
+                self.assertTrue(could_match(pattern, text),
+                                u'%r matches %r with %s but was filtered out'
+                                % (pattern, text, engine.__name__))
+
+    def test_special_case_folding(self):
+        cases = [(u'sex', u'free ſex'),
+                 (u'k', u'K'),
+                 (u'i', u'İ'),
+                 (u'i', u'ı'),
+                 (u'σ', u'ς'),
+                 (u'µ', u'μ'),
+                 (u'ṡ', u'ẛ'),
+                 ('\xb5', '\xb5'.decode('latin-1')),
+                 ]
+        for pattern, text in cases:
+            self.assertConsistent(pattern, text)
+
+    def test_non_ascii_pattern_folds_like_regex_module(self):
+        # the regex module (used with a time budget) folds with unicode's
+        # simple case folding, which joins these even where sre doesn't
+        cases = [(u'\u017fpam', u'SPAM'),
+                 (u'spam', u'\u017fpam'),
+                 (u'\u212a\u212a', u'kk'),
+                 (u'\u0130stanbul', u'ISTANBUL'),
+                 (u'\u0131d', u'ID'),
+                 (u'\u1e9b', u'\u1e60'),
+                 (u'\u0345', u'\u0399'),
+                 ]
+        for pattern, text in cases:
+            self.assertTrue(could_match(pattern, text),
+                            u'%r filtered out %r' % (pattern, text))
+            self.assertConsistent(pattern, text)
+
+    def test_groups_without_sre_special_cases(self):
+        # older 2.7 releases don't have them, the case mappings still join
+        # everything the regex module folds together
+        saved = sre_compile.__dict__.pop('_ignorecase_fixes', None)
+        try:
+            groups = literals._case_groups()
+        finally:
+            if saved is not None:
+                sre_compile._ignorecase_fixes = saved
+        for a, b in [(u's', u'\u017f'), (u'i', u'\u0131'),
+                     (u'\u03c3', u'\u03c2'), (u'\u03b9', u'\u0345'),
+                     (u'\u1e61', u'\u1e9b')]:
+            self.assertEqual(a.translate(groups), b.lower().translate(groups))
+
+    def test_unrelated_text_is_filtered(self):
+        self.assertFalse(could_match(u'(spam|eggs)', u'nothing to see'))
+
+    def test_random_against_re(self):
+        rng = random.Random(1234)
+        for _ in range(3000):
+            pattern = random_pattern(rng)
+            for _ in range(5):
+                self.assertConsistent(pattern, random_word(rng, 12))
+
+
+if __name__ == '__main__':
+    unittest.main()
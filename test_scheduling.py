@@ -0,0 +1,224 @@
+"""Checks the request budget and the listings' poll intervals on a fake clock.
+
+Run with: python -m unittest test_scheduling
+"""
+
+import threading
+import time
+import unittest
+
+from testing import FakeClock
+from polling import PollScheduler
+from ratelimit import RequestScheduler
+
+
+class RequestSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def scheduler(self, requests_per_minute=60, burst=10, reserve=5):
+        return RequestScheduler(requests_per_minute, burst, reserve,
+                                clock=self.clock)
+
+    def test_invalid_settings(self):
+        self.assertRaises(ValueError, self.scheduler, -1)
+        self.assertRaises(ValueError, self.scheduler, 60, 0, 0)
+        self.assertRaises(ValueError, self.scheduler, 60, 10, 11)
+        self.assertRaises(ValueError, self.scheduler, 60, 10, -1)
+
+    def test_refills_up_to_burst(self):
+        scheduler = self.scheduler()
+        for _ in range(10):
+            scheduler.acquire()
+        self.assertEqual(scheduler.tokens, 0)
+
+        self.clock.advance(3)
+        self.assertTrue(scheduler.budget_low())
+        self.assertAlmostEqual(scheduler.tokens, 3)
+
+        self.clock.advance(600)
+        self.assertFalse(scheduler.budget_low())
+        self.assertEqual(scheduler.tokens, 10)
+
+    def test_no_rate_is_unlimited(self):
+        scheduler = self.scheduler(0)
+        for _ in range(100):
+            scheduler.acquire()
+        self.assertEqual(scheduler.counts['fetch'], 100)
+
+    def test_counts_by_type(self):
+        scheduler = self.scheduler()
+        with scheduler.request_type('remove'):
+            scheduler.acquire()
+            with scheduler.request_type('comment'):
+                scheduler.acquire()
+            scheduler.acquire()
+        scheduler.acquire()
+        self.assertEqual(dict(scheduler.counts),
+                         {'remove': 2, 'comment': 1, 'fetch': 1})
+        self.assertEqual(scheduler.stats(),
+                         'comment: 1, fetch: 1, remove: 2')
+
+    def test_messages_wait_for_the_reserve(self):
+        scheduler = self.scheduler()
+        sent = []
+        finished = []
+        for _ in range(6):
+            scheduler.acquire()
+
+        # 4 tokens left, under the reserve of 5
+        self.assertTrue(scheduler.defer('message', sent.append, 'first',
+                                        done=finished.append))
+        self.assertFalse(scheduler.defer('remove', sent.append, 'removal'))
+        self.assertEqual(sent, ['removal'])
+
+        scheduler.run_deferred()
+        self.assertEqual(sent, ['removal'])
+
+        self.clock.advance(2)
+        # queued behind the first, even though there's budget again
+        self.assertTrue(scheduler.defer('modmail', sent.append, 'second'))
+        scheduler.run_deferred()
+        self.assertEqual(sent, ['removal', 'first', 'second'])
+        self.assertEqual(finished, [None])
+        self.assertEqual(scheduler.num_deferred(), 0)
+        self.assertEqual(dict(scheduler.deferred_counts),
+                         {'message': 1, 'modmail': 1})
+
+    def test_failed_deferred_calls_report_the_error(self):
+        scheduler = self.scheduler(reserve=10)
+        scheduler.acquire()
+        errors = []
+
+        def fail():
+            raise ValueError('nope')
+
+        scheduler.defer('message', fail, done=errors.append)
+        self.clock.advance(1)
+        scheduler.run_deferred()
+        self.assertEqual([str(e) for e in errors], ['nope'])
+
+    def test_urgent_requests_go_first(self):
+        scheduler = self.scheduler(60, burst=1, reserve=0)
+        scheduler.acquire()
+        order = []
+
+        def request(req_type):
+            with scheduler.request_type(req_type):
+                scheduler.acquire()
+            order.append(req_type)
+
+        def wait_for_waiting(count):
+            deadline = time.time() + 5
+            while sum(scheduler._waiting.values()) < count:
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.01)
+
+        def release_token():
+            self.clock.advance(1)
+            with scheduler._cond:
+                scheduler._cond.notify_all()
+
+        threads = [threading.Thread(target=request, args=(req_type,))
+                   for req_type in ('message', 'remove')]
+        threads[0].start()
+        wait_for_waiting(1)
+        threads[1].start()
+        wait_for_waiting(2)
+
+        # the removal gets the first token, though it started waiting later
+        release_token()
+        threads[1].join(5)
+        self.assertEqual(order, ['remove'])
+        release_token()
+        threads[0].join(5)
+        self.assertEqual(order, ['remove', 'message'])
+
+
+class PollSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = PollScheduler(min_interval=1, max_interval=300,
+                                       target_items=5, backoff=1.5,
+                                       idle_fraction=0.25, jitter=0,
+                                       smoothing=0.5, clock=self.clock)
+        self.scheduler.set_targets(['new'], {'reports': 60})
+
+    def interval(self, key='new'):
+        return self.scheduler._states[key].interval
+
+    def poll(self, seconds, new_items, key='new'):
+        self.clock.advance(seconds)
+        self.scheduler.polled(key, new_items)
+
+    def test_everything_is_due_at_first(self):
+        self.assertEqual(sorted(self.scheduler.due()), ['new', 'reports'])
+        self.assertEqual(self.scheduler.seconds_until_due(), 0)
+
+    def test_interval_follows_the_rate(self):
+        self.poll(0, 3)
+        self.assertEqual(self.interval(), 1)
+
+        # 20 items in 10s, 5 should be waiting after 2.5s
+        self.poll(10, 20)
+        self.assertEqual(self.interval(), 2.5)
+        self.assertEqual(self.scheduler.due(), ['reports'])
+        self.clock.advance(2.4)
+        self.assertNotIn('new', self.scheduler.due())
+        self.clock.advance(0.1)
+        self.assertIn('new', self.scheduler.due())
+
+        # 5 items in 5s, averaged with the previous rate of 2/s
+        self.poll(2.5, 5)
+        self.assertEqual(self.interval(), 5 / 1.5)
+
+    def test_quiet_listings_back_off(self):
+        self.poll(0, 3)
+        self.poll(1, 0)
+        self.assertEqual(self.interval(), 1.5)
+        self.poll(1.5, 0)
+        self.assertEqual(self.interval(), 2.25)
+
+        # at least a quarter of the time since the last new item
+        self.poll(100, 0)
+        self.assertEqual(self.interval(), 0.25 * 102.5)
+
+        for _ in range(20):
+            self.poll(self.interval(), 0)
+        self.assertEqual(self.interval(), 300)
+
+    def test_failures_back_off(self):
+        self.scheduler.failed('new')
+        self.scheduler.failed('new')
+        self.assertEqual(self.interval(), 2.25)
+        self.assertEqual(self.scheduler._states['new'].next_poll,
+                         self.clock() + 2.25)
+
+    def test_fixed_intervals_dont_change(self):
+        self.poll(0, 0, 'reports')
+        self.poll(60, 100, 'reports')
+        self.scheduler.failed('reports')
+        self.assertEqual(self.interval('reports'), 60)
+        self.clock.advance(59)
+        self.assertNotIn('reports', self.scheduler.due())
+        self.clock.advance(1)
+        self.assertIn('reports', self.scheduler.due())
+
+    def test_targets_keep_their_state(self):
+        self.scheduler.failed('new')
+        self.scheduler.set_targets(['new', 'other'], {'reports': 30})
+        self.assertEqual(self.interval(), 1.5)
+        self.assertEqual(self.interval('other'), 1)
+        self.assertEqual(self.interval('reports'), 30)
+
+        # switching to a fixed interval starts over
+        self.scheduler.set_targets([], {'new': 10})
+        self.assertEqual(self.interval(), 10)
+        self.scheduler.polled('new', 50)
+        self.assertEqual(self.interval(), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
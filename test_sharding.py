@@ -0,0 +1,160 @@
+"""Runs several sharded workers as local processes against sqlite.
+
+Run with: python -m unittest test_sharding
+"""
+
+from multiprocessing import Process, Queue
+from Queue import Empty
+import time
+import unittest
+
+import testing
+from models import Base, engine, session
+from sharding import ShardCoordinator
+
+LEASE_SECONDS = 2
+SUBREDDITS = ['sub{0}'.format(i) for i in range(60)]
+
+
+def run_worker(worker_id, username, moderated, commands, results):
+    shard = ShardCoordinator(worker_id, LEASE_SECONDS, username=username)
+    shard.set_moderated(moderated)
+    while True:
+        shard.heartbeat()
+        try:
+            command = commands.get(timeout=0.1)
+        except Empty:
+            continue
+        if command == 'report':
+            owned = [name for name in SUBREDDITS if shard.owns(name)]
+            results.put((worker_id, shard.workers, owned, shard.is_leader()))
+        elif command == 'crash':
+            # exits without releasing the lease
+            return
+
+
+class ShardingTest(unittest.TestCase):
+
+    def setUp(self):
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+        self.workers = {}
+        self.results = Queue()
+
+    def tearDown(self):
+        for process, _ in self.workers.values():
+            process.terminate()
+            process.join()
+
+    def start_workers(self, workers):
+        # they're forked, so they need their own connections
+        session.close()
+        engine.dispose()
+        for worker_id, username, moderated in workers:
+            commands = Queue()
+            process = Process(target=run_worker,
+                              args=(worker_id, username, moderated,
+                                    commands, self.results))
+            process.start()
+            self.workers[worker_id] = (process, commands)
+
+    def report(self, live):
+        """Returns the live workers' views once they agree on who's live."""
+        deadline = time.time() + 10 * LEASE_SECONDS
+        while time.time() < deadline:
+            for worker_id in live:
+                self.workers[worker_id][1].put('report')
+            reports = dict((r[0], r[1:])
+                           for r in [self.results.get(timeout=5)
+                                     for _ in live])
+            if all(report[0] == sorted(live) for report in reports.values()):
+                return reports
+            time.sleep(0.2)
+        self.fail('workers never agreed on {0}'.format(live))
+
+    def assertAssigned(self, reports, moderated_by):
+        owners = {}
+        for worker_id, (_, owned, _) in reports.items():
+            for name in owned:
+                owners.setdefault(name, []).append(worker_id)
+        for name in SUBREDDITS:
+            self.assertEqual(len(owners.get(name, [])), 1,
+                             '{0} owned by {1}'.format(name, owners.get(name)))
+            self.assertIn(owners[name][0], moderated_by(name))
+
+    def test_assignment_and_failover(self):
+        def moderated_by(name):
+            if SUBREDDITS.index(name) % 2 == 0:
+                return live + ['w3']
+            return live
+
+        # two workers share account a, which moderates everything, the
+        # third runs as b and only moderates half of the subreddits
+        self.start_workers([('w1', 'a', SUBREDDITS),
+                            ('w2', 'a', SUBREDDITS),
+                            ('w3', 'b', SUBREDDITS[::2])])
+        live = ['w1', 'w2']
+        reports = self.report(live + ['w3'])
+        self.assertAssigned(reports, moderated_by)
+        self.assertTrue(reports['w1'][2])
+        self.assertFalse(reports['w2'][2])
+        self.assertTrue(reports['w3'][2])
+
+        # w1's subreddits and the leadership of account a move to w2 once
+        # its lease expires
+        self.workers['w1'][1].put('crash')
+        self.workers['w1'][0].join()
+        live = ['w2']
+        reports = self.report(live + ['w3'])
+        self.assertAssigned(reports, moderated_by)
+        self.assertTrue(reports['w2'][2])
+
+    def test_lease_renewed_in_background(self):
+        shard = ShardCoordinator('w7', LEASE_SECONDS, username='a')
+        shard.set_moderated(SUBREDDITS)
+        shard.heartbeat()
+        shard.start()
+        other = ShardCoordinator('w8', LEASE_SECONDS, username='a')
+        other.set_moderated(SUBREDDITS)
+
+        # still live without a heartbeat, e.g. while checking a long listing
+        time.sleep(LEASE_SECONDS * 1.5)
+        other.heartbeat()
+        self.assertEqual(other.workers, ['w7', 'w8'])
+        self.assertTrue(shard.has_lease())
+        shard.release()
+
+    def test_nothing_owned_after_losing_the_lease(self):
+        shard = ShardCoordinator('w7', LEASE_SECONDS, username='a')
+        shard.set_moderated(SUBREDDITS)
+        shard.heartbeat()
+        self.assertTrue(any(shard.owns(name) for name in SUBREDDITS))
+
+        time.sleep(LEASE_SECONDS * 1.2)
+        other = ShardCoordinator('w8', LEASE_SECONDS, username='a')
+        other.set_moderated(SUBREDDITS)
+        other.heartbeat()
+        self.assertEqual(other.workers, ['w8'])
+        self.assertTrue(all(other.owns(name) for name in SUBREDDITS))
+
+        # it ran out, and renewing it doesn't bring it back
+        self.assertFalse(any(shard.owns(name) for name in SUBREDDITS))
+        shard.renew()
+        self.assertTrue(shard.lease_lost)
+        self.assertFalse(any(shard.owns(name) for name in SUBREDDITS))
+
+        # until the next heartbeat takes it again and reloads
+        self.assertTrue(shard.heartbeat())
+        self.assertEqual(shard.workers, ['w7', 'w8'])
+        self.assertTrue(any(shard.owns(name) for name in SUBREDDITS))
+
+    def test_last_message_is_shared(self):
+        ShardCoordinator('w4', username='a').set_last_message(1234)
+        self.assertEqual(
+            ShardCoordinator('w5', username='a').get_last_message(0), 1234)
+        self.assertEqual(
+            ShardCoordinator('w6', username='b').get_last_message(0), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
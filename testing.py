@@ -0,0 +1,39 @@
+"""Config and helpers shared by the tests, import it before any of the
+bot's modules.
+
+models sets up the database from the config file when it's first imported,
+so all the tests in a run share this one, with a throwaway sqlite database.
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+
+TEMP_DIR = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, TEMP_DIR, True)
+
+CFG_PATH = os.path.join(TEMP_DIR, 'automoderator.cfg')
+with open(CFG_PATH, 'w') as cfg:
+    cfg.write('[database]\n'
+              'system = sqlite\n'
+              'database = {0}\n'
+              '[reddit]\n'
+              'user_agent = AutoModerator tests\n'
+              'username = AutoModerator\n'
+              .format(os.path.join(TEMP_DIR, 'test.db')))
+os.environ['AUTOMODERATOR_CFG'] = CFG_PATH
+
+
+class FakeClock(object):
+
+    """A clock that only moves when told to, in place of time.time()."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
@@ -0,0 +1,69 @@
+"""Thread pool used for running network-bound work in the background."""
+
+import logging
+import sys
+from Queue import Queue
+from threading import Event, Thread
+
+
+class Job(object):
+
+    """A function call submitted to a WorkerPool."""
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self._done = Event()
+        self._result = None
+        self._exc_info = None
+
+    def run(self):
+        try:
+            self._result = self.func(*self.args)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        """Waits for the job to finish and returns its result.
+
+        Any exception raised by the job is re-raised in the caller.
+        """
+        # wait in short intervals so KeyboardInterrupt is still handled
+        while not self._done.wait(1):
+            pass
+
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class WorkerPool(object):
+
+    """A fixed number of daemon threads running submitted jobs in order."""
+
+    def __init__(self, num_workers, name='worker'):
+        self._jobs = Queue()
+        for i in range(num_workers):
+            thread = Thread(target=self._work,
+                            name='{0}-{1}'.format(name, i))
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                job.run()
+            except Exception as e:
+                logging.error('ERROR: {0}'.format(e))
+
+    def submit(self, func, *args):
+        """Queues func(*args) to be run, returns a Job for the result."""
+        job = Job(func, args)
+        self._jobs.put(job)
+        return job